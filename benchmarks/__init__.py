@@ -0,0 +1,20 @@
+"""
+Benchmarks for the Promotion service
+
+Every benchmark seeds its own data, dropping the promotion table first, so
+point BENCHMARK_DATABASE_URI at a throwaway database. It defaults to a
+SQLite file in /tmp.
+"""
+import os
+
+BENCHMARK_DATABASE_URI = os.getenv(
+    "BENCHMARK_DATABASE_URI", "sqlite:////tmp/promotions-benchmark.db"
+)
+# the service connects to DATABASE_URI as soon as it is imported
+os.environ["DATABASE_URI"] = BENCHMARK_DATABASE_URI
+
+
+def percentile(values:list, percent:float) -> float:
+    """ Returns the nearest-rank percentile of sorted values """
+    index = max(int(round(percent / 100 * len(values) + 0.5)) - 1, 0)
+    return values[min(index, len(values) - 1)]
@@ -0,0 +1,74 @@
+"""
+Benchmark for listing Promotions
+
+Compares reading every Promotion as ORM instances, as find_by_multi_attributes
+does, with the read-only PromotionRecord path used by GET /promotions.
+
+    python -m benchmarks.list_promotions --rows 20000 --repeat 5
+"""
+import argparse
+import logging
+import time
+from benchmarks import BENCHMARK_DATABASE_URI
+from service import app
+from service.models import db, Promotion
+from tests.factories import PromotionFactory
+
+
+def seed(rows:int):
+    """ Replaces the promotion table with rows fake Promotions """
+    db.drop_all()
+    db.create_all()
+    for start in range(0, rows, 10000):
+        Promotion.create_many(PromotionFactory.build_batch(min(10000, rows - start)))
+
+
+def list_orm(args):
+    promotions = Promotion.find_by_multi_attributes(args).order_by(Promotion.id)
+    results = [promotion.serialize() for promotion in promotions]
+    db.session.remove()
+    return results
+
+
+def list_records(args):
+    statement = Promotion.select_by_multi_attributes(args).order_by(Promotion.id)
+    results = [record.serialize() for record in Promotion.fetch_records(statement)]
+    db.session.remove()
+    return results
+
+
+def measure(function, args, repeat:int) -> float:
+    """ Returns the best time in seconds of repeat calls """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=20000, help="Promotions to seed")
+    parser.add_argument("--repeat", type=int, default=5, help="runs of each path, the best is kept")
+    options = parser.parse_args()
+
+    app.logger.setLevel(logging.CRITICAL)
+    print("Seeding {} promotions into {}".format(options.rows, BENCHMARK_DATABASE_URI))
+    seed(options.rows)
+    for name, args in [("all", {}), ("category", {"category": "Discount"})]:
+        results = list_records(args)
+        assert list_orm(args) == results
+        count = max(len(results), 1)
+        orm = measure(list_orm, args, options.repeat)
+        records = measure(list_records, args, options.repeat)
+        print(
+            "{:<10} orm {:>10.0f} rows/s  records {:>10.0f} rows/s  speedup {:.2f}x".format(
+                name, count / orm, count / records, orm / records
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+"""
+Load generator for the Promotion service
+
+Sends a weighted mix of list, get, best, create and expire requests to a
+running instance from many concurrent workers for a while, then reports
+the p50/p95/p99 latency, throughput and error rate of each route. Run it
+against a staging instance to size the gunicorn workers and the database
+pool before a release:
+
+    python -m benchmarks.loadgen --url http://localhost:5000 --workers 32 --duration 60
+    python -m benchmarks.loadgen --mix list=70,get=20,best=10 --output load.json
+
+Every worker has its own HTTP session and random generator, seeded from
+--seed, and records its own samples, so workers never wait on each other.
+A single client process is bound by the GIL, run several of them for more
+than a few thousand requests per second.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import requests
+from benchmarks import percentile
+
+DEFAULT_URL = os.getenv("BASE_URL", "http://localhost:5000")
+
+DEFAULT_MIX = "list=50,get=25,best=15,create=5,expire=5"
+
+# Promotions created when the service has none to read
+SEED_PROMOTIONS = 1000
+
+# Statuses that are answers rather than errors, by route
+EXPECTED = {
+    "list": (200,),
+    "get": (200, 404),  # another worker may have deleted it
+    "best": (200, 404),  # not every product has a promotion
+    "create": (201,),
+    "expire": (200, 404),
+}
+
+
+class Worker:
+    """ Sends requests for one thread and keeps their samples """
+
+    def __init__(self, url:str, promotion_ids:list, product_ids:list, seed:int, timeout:float):
+        self.url = url
+        self.promotion_ids = promotion_ids
+        self.product_ids = product_ids
+        self.rng = random.Random(seed)
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.samples = []  # (route, seconds, ok)
+
+    def run(self, routes:list, weights:list, deadline:float, stop:threading.Event):
+        while not stop.is_set() and time.monotonic() < deadline:
+            route = self.rng.choices(routes, weights)[0]
+            start = time.perf_counter()
+            try:
+                ok = getattr(self, route)() in EXPECTED[route]
+            except requests.RequestException:
+                ok = False
+            self.samples.append((route, time.perf_counter() - start, ok))
+        self.session.close()
+        return self.samples
+
+    def request(self, method:str, path:str, **kwargs):
+        return self.session.request(method, self.url + path, timeout=self.timeout, **kwargs)
+
+    ######################################################################
+    #  R O U T E S
+    ######################################################################
+
+    def list(self) -> int:
+        params = self.rng.choice([
+            {},
+            {"category": self.rng.choice(["Discount", "BOGOF", "Unknown"])},
+            {"product_id": self.rng.choice(self.product_ids)},
+            {"available": 1},
+        ])
+        params["limit"] = 100
+        return self.request("GET", "/promotions", params=params).status_code
+
+    def get(self) -> int:
+        return self.request("GET", "/promotions/{}".format(self.rng.choice(self.promotion_ids))).status_code
+
+    def best(self) -> int:
+        return self.request("GET", "/promotions/{}/best".format(self.rng.choice(self.product_ids))).status_code
+
+    def create(self) -> int:
+        resp = self.request("POST", "/promotions", json=make_promotion(self.rng, self.product_ids))
+        if resp.status_code == 201:
+            self.promotion_ids.append(resp.json()["id"])
+        return resp.status_code
+
+    def expire(self) -> int:
+        return self.request(
+            "PUT", "/promotions/{}/expire".format(self.rng.choice(self.promotion_ids))
+        ).status_code
+
+
+def make_promotion(rng:random.Random, product_ids:list) -> dict:
+    """ Returns a fake Promotion that is available about half of the time """
+    from_date = datetime.now() + timedelta(days=rng.randint(-30, 10))
+    return {
+        "product_name": "loadgen",
+        "category": rng.choice(["Discount", "BOGOF", "Unknown"]),
+        "product_id": rng.choice(product_ids),
+        "amount": rng.choice([5, 10, 15, 20, 25, 30, 35, 40, 45, 50]),
+        "description": "made by the load generator",
+        "from_date": from_date.isoformat(),
+        "to_date": (from_date + timedelta(days=rng.randint(1, 30))).isoformat(),
+    }
+
+
+def discover(url:str, rng:random.Random, timeout:float) -> tuple:
+    """Returns the ids and product ids of up to 1000 Promotions of the service
+
+    Promotions are created in bulk first when there are none
+    """
+    resp = requests.get(url + "/promotions", params={"limit": 1000, "fields": "id,product_id"}, timeout=timeout)
+    resp.raise_for_status()
+    promotions = resp.json()
+    if not promotions:
+        print("Creating {} promotions".format(SEED_PROMOTIONS), file=sys.stderr)
+        product_ids = list(range(1, SEED_PROMOTIONS // 10 + 1))
+        resp = requests.post(
+            url + "/promotions/bulk",
+            json=[make_promotion(rng, product_ids) for _ in range(SEED_PROMOTIONS)],
+            timeout=timeout,
+        )
+        resp.raise_for_status()
+        promotions = [result["promotion"] for result in resp.json()["results"]]
+    return (
+        [promotion["id"] for promotion in promotions],
+        sorted({promotion["product_id"] for promotion in promotions}),
+    )
+
+
+def parse_mix(value:str) -> dict:
+    """ Returns the weight of each route of a mix written as route=weight,... """
+    mix = {}
+    for item in value.split(","):
+        route, _, weight = item.partition("=")
+        route = route.strip()
+        if route not in EXPECTED:
+            raise argparse.ArgumentTypeError(
+                "unknown route {!r}, must be some of {}".format(route, ", ".join(EXPECTED))
+            )
+        try:
+            mix[route] = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError("invalid weight for {}: {!r}".format(route, weight))
+    if not any(weight > 0 for weight in mix.values()):
+        raise argparse.ArgumentTypeError("at least one route needs a weight above 0")
+    return mix
+
+
+def summarize(samples:list, elapsed:float) -> dict:
+    """ Returns the latency percentiles in milliseconds, throughput and error rate of each route """
+    by_route = {}
+    for route, seconds, ok in samples:
+        by_route.setdefault(route, []).append((seconds, ok))
+    by_route["all"] = [(seconds, ok) for _, seconds, ok in samples]
+    summary = {}
+    for route, route_samples in by_route.items():
+        if not route_samples:
+            continue
+        latencies = sorted(seconds for seconds, _ in route_samples)
+        errors = sum(1 for _, ok in route_samples if not ok)
+        summary[route] = {
+            "requests": len(route_samples),
+            "errors": errors,
+            "error_rate": errors / len(route_samples),
+            "throughput_rps": len(route_samples) / elapsed,
+            "p50_ms": percentile(latencies, 50) * 1e3,
+            "p95_ms": percentile(latencies, 95) * 1e3,
+            "p99_ms": percentile(latencies, 99) * 1e3,
+            "max_ms": latencies[-1] * 1e3,
+        }
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--url", default=DEFAULT_URL, help="base url of the service (default %(default)s)")
+    parser.add_argument("--workers", type=int, default=16, help="concurrent workers (default %(default)s)")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to send requests for")
+    parser.add_argument("--warmup", type=float, default=5, help="seconds of requests sent before measuring")
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX,
+                        help="weights of the routes (default %(default)s)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random choices")
+    parser.add_argument("--timeout", type=float, default=10, help="seconds before a request fails")
+    parser.add_argument("--output", default=None, help="file to write the JSON report to")
+    options = parser.parse_args()
+
+    url = options.url.rstrip("/")
+    promotion_ids, product_ids = discover(url, random.Random(options.seed), options.timeout)
+    routes = [route for route, weight in options.mix.items() if weight > 0]
+    weights = [options.mix[route] for route in routes]
+    stop = threading.Event()
+
+    def run(duration:float) -> tuple:
+        workers = [
+            Worker(url, promotion_ids, product_ids, options.seed * 1000 + index, options.timeout)
+            for index in range(options.workers)
+        ]
+        deadline = time.monotonic() + duration
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options.workers) as pool:
+            futures = [pool.submit(worker.run, routes, weights, deadline, stop) for worker in workers]
+            try:
+                samples = [sample for future in futures for sample in future.result()]
+            except KeyboardInterrupt:
+                stop.set()
+                samples = [sample for future in futures for sample in future.result()]
+        return samples, time.perf_counter() - start
+
+    if options.warmup > 0:
+        print("Warming up for {}s".format(options.warmup), file=sys.stderr)
+        run(options.warmup)
+    print("Sending {} for {}s from {} workers to {}".format(
+        ",".join("{}={:g}".format(route, weight) for route, weight in zip(routes, weights)),
+        options.duration, options.workers, url,
+    ), file=sys.stderr)
+    samples, elapsed = run(options.duration)
+    summary = summarize(samples, elapsed)
+
+    print("{:<8} {:>9} {:>8} {:>9} {:>9} {:>9} {:>9}".format(
+        "route", "requests", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms"
+    ))
+    for route, result in summary.items():
+        print("{:<8} {:>9} {:>7.2%} {:>9.1f} {:>9.2f} {:>9.2f} {:>9.2f}".format(
+            route, result["requests"], result["error_rate"], result["throughput_rps"],
+            result["p50_ms"], result["p95_ms"], result["p99_ms"],
+        ))
+    if options.output:
+        report = {
+            "created": datetime.now().isoformat(),
+            "url": url,
+            "workers": options.workers,
+            "duration": elapsed,
+            "mix": dict(zip(routes, weights)),
+            "routes": summary,
+        }
+        with open(options.output, "w") as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+            output.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+Benchmark for serializing Promotions
+
+Compares writing Promotions out with serialize(), marshal() and the
+Flask-RESTX JSON encoder, as the routes used to, with the compiled
+single-pass serializer, for one Promotion and for a list of them.
+
+    python -m benchmarks.serialize_promotions --rows 10000 --repeat 5
+"""
+import argparse
+import json
+import logging
+import time
+from service import app, serializer
+from service.routes import api, promotion_model
+from tests.factories import PromotionFactory
+
+
+def marshal_then_encode(promotions):
+    data = api.marshal([promotion.serialize() for promotion in promotions], promotion_model)
+    return json.dumps(data) + "\n"
+
+
+def single_pass(promotions):
+    return serializer.to_json(promotions)
+
+
+def measure(function, promotions, repeat:int, number:int=1) -> float:
+    """ Returns the best time in seconds of one call, over repeat runs of number calls """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            function(promotions)
+        elapsed = (time.perf_counter() - start) / number
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=10000, help="Promotions in the list")
+    parser.add_argument("--repeat", type=int, default=5, help="runs of each path, the best is kept")
+    options = parser.parse_args()
+
+    app.logger.setLevel(logging.CRITICAL)
+    print("JSON backend: {}".format("orjson" if serializer.orjson else "json"))
+    records = [promotion.to_record() for promotion in PromotionFactory.build_batch(options.rows)]
+    for name, promotions, number in [("single", records[:1], 10000), ("list", records, 1)]:
+        assert json.loads(marshal_then_encode(promotions)) == json.loads(single_pass(promotions))
+        before = measure(marshal_then_encode, promotions, options.repeat, number)
+        after = measure(single_pass, promotions, options.repeat, number)
+        print(
+            "{:<7} {:>6} rows  marshal {:>10.1f} us  single pass {:>10.1f} us  speedup {:.2f}x".format(
+                name, len(promotions), before * 1e6, after * 1e6, before / after
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
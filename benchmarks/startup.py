@@ -0,0 +1,97 @@
+"""
+Benchmark for the cold start of the Promotion service
+
+Starts fresh interpreters that import the service and answer their first
+requests, and reports the median milliseconds spent in each phase:
+
+    frameworks      importing Flask, Flask-RESTX, Flask-SQLAlchemy and Flask-Migrate
+    service         importing the service: its modules, the Swagger models
+                    and the database check made by init_db
+    first_request   the first GET /promotions
+    swagger         the first GET /swagger.json, which builds the API spec
+
+    python -m benchmarks.startup --repeat 10 --modules 15
+
+The database is migrated once before timing so every run starts from the
+same schema, as a deployment that restarts does. BENCHMARK_DATABASE_URI
+picks the database.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+PHASES = ("frameworks", "service", "first_request", "swagger", "total")
+
+PROBE = """
+import json, time
+start = time.perf_counter()
+import flask, flask_restx, flask_sqlalchemy, flask_migrate
+frameworks = time.perf_counter()
+from service import app
+imported = time.perf_counter()
+client = app.test_client()
+status = client.get("/promotions").status_code
+first = time.perf_counter()
+client.get("/swagger.json")
+swagger = time.perf_counter()
+print(json.dumps({
+    "frameworks": frameworks - start, "service": imported - frameworks,
+    "first_request": first - imported, "swagger": swagger - first, "total": swagger - start,
+    "status": status,
+}))
+"""
+
+
+def probe(importtime:bool=False) -> tuple:
+    """ Starts the service in a new interpreter and returns its phases and stderr """
+    command = [sys.executable] + (["-X", "importtime"] if importtime else []) + ["-c", PROBE]
+    # the master of gunicorn sets these for its workers, a plain start has one process
+    env = dict(os.environ, WEB_CONCURRENCY="1")
+    done = subprocess.run(
+        command, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True
+    )
+    phases = json.loads(done.stdout.strip().splitlines()[-1])
+    if phases.pop("status") != 200:
+        raise RuntimeError("The first request failed:\n" + done.stderr)
+    return {name: seconds * 1e3 for name, seconds in phases.items()}, done.stderr
+
+
+def slowest_modules(stderr:str, count:int) -> list:
+    """ Returns the modules that took the longest to import, with their imports """
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        modules.append((int(cumulative) / 1e3, name.rstrip()))
+    return sorted(modules, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=10, help="interpreters started")
+    parser.add_argument("--modules", type=int, default=0,
+                        help="also list the slowest imports, this many (default none)")
+    parser.add_argument("--output", default=None, help="file to write the JSON results to")
+    options = parser.parse_args()
+
+    probe()  # migrates the database and warms the disk cache
+    runs = [probe()[0] for _ in range(options.repeat)]
+    results = {name: round(statistics.median(run[name] for run in runs), 1) for name in PHASES}
+    print("{:<16}{:>10}".format("phase", "ms"))
+    for name in PHASES:
+        print("{:<16}{:>10.1f}".format(name, results[name]))
+    if options.modules:
+        print()
+        for milliseconds, name in slowest_modules(probe(importtime=True)[1], options.modules):
+            print("{:>10.1f}  {}".format(milliseconds, name))
+    if options.output:
+        with open(options.output, "w") as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
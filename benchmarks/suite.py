@@ -0,0 +1,309 @@
+"""
+Benchmark suite for the Promotion service
+
+Seeds the promotion table with 10k, 100k and 1M Promotions made by the
+PromotionFactory, and times the model finders, list serialization and
+every REST route through the Flask test client at each size. Random
+choices are seeded so two runs make the same data and the same calls.
+
+The routes that delete or expire Promotions work on rows made for them
+before each call, outside of the time measured, so they neither eat into
+the seeded data nor time a call that finds nothing to do.
+
+The results are written as JSON and can be compared with a baseline saved
+by an earlier run, exiting with 1 when any operation got slower than the
+tolerance allows:
+
+    python -m benchmarks.suite --output results.json
+    python -m benchmarks.suite --sizes 10000 --baseline results.json --tolerance 0.25
+
+Latencies are in milliseconds. Compare runs made on the same machine and
+database only, BENCHMARK_DATABASE_URI picks the database.
+"""
+import argparse
+import json
+import logging
+import platform
+import itertools
+import random
+import sys
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+import factory.random
+import sqlalchemy
+from benchmarks import BENCHMARK_DATABASE_URI, percentile
+from service import app, serializer
+from service.models import db, Promotion, TypeOfPromo
+from service.routes import init_db
+from tests.factories import PromotionFactory
+
+DEFAULT_SIZES = "10000,100000,1000000"
+
+# Promotions created by each call to create_many while seeding
+SEED_BATCH_SIZE = 10000
+
+# Promotions per product, so best promotion lookups have several to rank
+PROMOTIONS_PER_PRODUCT = 10
+
+# Promotions serialized by the list serialization benchmark, a large page
+SERIALIZE_ROWS = 1000
+
+# Promotions posted by each call of the bulk create benchmark
+BULK_ROWS = 100
+
+# An operation to time, and what to prepare before each call, None for nothing
+Case = namedtuple("Case", ["call", "setup"])
+
+
+def seed(rows:int, rng:random.Random):
+    """Replaces the promotion table with rows fake Promotions
+
+    Promotions spread over rows / PROMOTIONS_PER_PRODUCT products, and
+    start and end within a few weeks of now so about half are available
+    """
+    db.drop_all()
+    db.create_all()
+    products = max(rows // PROMOTIONS_PER_PRODUCT, 1)
+    now = datetime.now()
+    for start in range(0, rows, SEED_BATCH_SIZE):
+        promotions = PromotionFactory.build_batch(min(SEED_BATCH_SIZE, rows - start))
+        for promotion in promotions:
+            promotion.product_id = rng.randrange(products)
+            promotion.from_date = now + timedelta(days=rng.randint(-30, 10))
+            promotion.to_date = promotion.from_date + timedelta(days=rng.randint(1, 30))
+        Promotion.create_many(promotions)
+    return products
+
+
+def time_calls(call, number:int, setup=None) -> dict:
+    """Times number calls and returns their latency percentiles and throughput
+
+    The session is removed after every call, as it is after every request.
+    The setup runs before each call and is left out of the latencies and
+    the throughput
+    """
+    latencies = []
+    preparing = 0.
+    started = time.perf_counter()
+    for _ in range(number):
+        if setup is not None:
+            start = time.perf_counter()
+            setup()
+            db.session.remove()
+            preparing += time.perf_counter() - start
+        start = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - start)
+        db.session.remove()
+    elapsed = time.perf_counter() - started - preparing
+    latencies.sort()
+    return {
+        "calls": number,
+        "mean_ms": sum(latencies) / number * 1e3,
+        "p50_ms": percentile(latencies, 50) * 1e3,
+        "p95_ms": percentile(latencies, 95) * 1e3,
+        "p99_ms": percentile(latencies, 99) * 1e3,
+        "ops_per_sec": number / elapsed,
+    }
+
+
+def checked(client, method:str, url, expected:tuple, body=None):
+    """Returns a call to a route that fails unless it answers with an expected status
+
+    Args:
+        url (callable): returns the url of each call
+        body (callable): returns the JSON body of each call, None for none
+    """
+    def call():
+        resp = client.open(url(), method=method, json=None if body is None else body())
+        if resp.status_code not in expected:
+            raise AssertionError("{} {} returned {}".format(method, resp.request.path, resp.status_code))
+    return call
+
+
+def cases(rows:int, products:int, rng:random.Random) -> dict:
+    """ Returns the operations to time, by name """
+    client = app.test_client()
+    promotion_id = lambda: rng.randint(1, rows)
+    product_id = lambda: rng.randrange(products)
+    category = lambda: rng.choice(list(TypeOfPromo))
+    page = [promotion.to_record() for promotion in Promotion.query.limit(SERIALIZE_ROWS)]
+    db.session.remove()
+    product_ids = lambda: {"product_ids": [product_id() for _ in range(100)]}
+    cart = lambda: {"lines": [
+        {"product_id": product_id(), "quantity": rng.randint(1, 5), "unit_price": "19.99"}
+        for _ in range(100)
+    ]}
+    promotion = lambda: PromotionFactory.build(id=None).serialize()
+    bulk = lambda: [promotion() for _ in range(BULK_ROWS)]
+    update = lambda: dict(promotion(), product_id=product_id())
+
+    # ids of the promotions and products made for the next destructive call,
+    # the products are past the seeded ones so no other operation reads them
+    fixtures = []
+    fixture_products = itertools.count(products)
+
+    def make_promotion():
+        promotion = PromotionFactory.build(id=None, product_id=product_id())
+        promotion.create()
+        fixtures.append(promotion.id)
+
+    def make_product():
+        product = next(fixture_products)
+        now = datetime.now()
+        Promotion.create_many(PromotionFactory.build_batch(
+            PROMOTIONS_PER_PRODUCT, id=None, product_id=product,
+            from_date=now - timedelta(days=1), to_date=now + timedelta(days=1),
+        ))
+        fixtures.append(product)
+
+    return {
+        "model.find": lambda: Promotion.find(promotion_id()),
+        "model.find_by_multi_attributes": lambda: Promotion.find_by_multi_attributes(
+            {"product_id": product_id(), "category": category()}
+        ).all(),
+        "model.find_best_promotion_for_product": lambda: Promotion.find_best_promotion_for_product(product_id()),
+        "model.find_best_in_index": lambda: Promotion.find_best_in_index(product_id()),
+        "serializer.to_json": lambda: serializer.to_json(page),
+        "GET /promotions/{id}": checked(
+            client, "GET", lambda: "/promotions/{}".format(promotion_id()), (200,)
+        ),
+        "GET /promotions?limit=100": checked(
+            client, "GET", lambda: "/promotions?limit=100&category={}".format(category().name), (200,)
+        ),
+        "GET /promotions?product_id": checked(
+            client, "GET", lambda: "/promotions?product_id={}".format(product_id()), (200,)
+        ),
+        "GET /promotions?available=1": checked(
+            client, "GET", lambda: "/promotions?available=1&limit=100&product_id={}".format(product_id()), (200,)
+        ),
+        "GET /promotions/{product_id}/best": checked(
+            client, "GET", lambda: "/promotions/{}/best".format(product_id()), (200, 404)
+        ),
+        "POST /promotions/best": checked(client, "POST", lambda: "/promotions/best", (200,), product_ids),
+        "POST /promotions/price": checked(client, "POST", lambda: "/promotions/price", (200,), cart),
+        "POST /promotions": checked(client, "POST", lambda: "/promotions", (201,), promotion),
+        "PUT /promotions/{id}/expire": checked(
+            client, "PUT", lambda: "/promotions/{}/expire".format(promotion_id()), (200,)
+        ),
+        "PUT /promotions/{id}": checked(
+            client, "PUT", lambda: "/promotions/{}".format(promotion_id()), (200,), update
+        ),
+        "POST /promotions/bulk": checked(client, "POST", lambda: "/promotions/bulk", (201,), bulk),
+        "DELETE /promotions/{id}": Case(
+            checked(client, "DELETE", lambda: "/promotions/{}".format(fixtures.pop()), (204,)),
+            make_promotion,
+        ),
+        "PUT /promotions/expire": Case(
+            checked(client, "PUT", lambda: "/promotions/expire?product_id={}".format(fixtures.pop()), (200,)),
+            make_product,
+        ),
+        "DELETE /promotions": Case(
+            checked(client, "DELETE", lambda: "/promotions?product_id={}".format(fixtures.pop()), (200,)),
+            make_product,
+        ),
+    }
+
+
+def run(sizes:list, number:int, only=None) -> dict:
+    """ Seeds each size and times every operation, returning the results by size then name """
+    results = {}
+    for rows in sizes:
+        rng = random.Random(rows)
+        factory.random.reseed_random(rows)
+        print("Seeding {} promotions into {}".format(rows, BENCHMARK_DATABASE_URI), file=sys.stderr)
+        start = time.perf_counter()
+        products = seed(rows, rng)
+        print("  seeded in {:.1f}s".format(time.perf_counter() - start), file=sys.stderr)
+        results[str(rows)] = {}
+        for name, case in cases(rows, products, rng).items():
+            if only and not any(word in name for word in only):
+                continue
+            call, setup = case if isinstance(case, Case) else (case, None)
+            if setup is not None:
+                setup()
+            call()  # warm up caches and compiled statements
+            db.session.remove()
+            results[str(rows)][name] = time_calls(call, number, setup)
+            print("  {:<40} p50 {:>9.3f} ms  p99 {:>9.3f} ms  {:>9.1f} ops/s".format(
+                name,
+                results[str(rows)][name]["p50_ms"],
+                results[str(rows)][name]["p99_ms"],
+                results[str(rows)][name]["ops_per_sec"],
+            ), file=sys.stderr)
+    return results
+
+
+def compare(results:dict, baseline:dict, tolerance:float) -> list:
+    """Returns the operations slower than the baseline by more than the tolerance
+
+    The median latency is compared, operations missing from either side are skipped
+
+    :return: (size, name, baseline p50, p50) of every regression
+    :rtype: list
+    """
+    regressions = []
+    for size, operations in results.items():
+        for name, result in operations.items():
+            before = baseline.get("results", {}).get(size, {}).get(name)
+            if before is None:
+                continue
+            ratio = result["p50_ms"] / before["p50_ms"] if before["p50_ms"] else 1.0
+            print("{:>8} {:<40} {:>9.3f} -> {:>9.3f} ms  {:+.0%}".format(
+                size, name, before["p50_ms"], result["p50_ms"], ratio - 1
+            ), file=sys.stderr)
+            if ratio > 1 + tolerance:
+                regressions.append((size, name, before["p50_ms"], result["p50_ms"]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default=DEFAULT_SIZES,
+                        help="comma separated numbers of Promotions to seed (default %(default)s)")
+    parser.add_argument("--number", type=int, default=200, help="calls timed for each operation")
+    parser.add_argument("--only", default=None,
+                        help="comma separated words, time only the operations whose name has one")
+    parser.add_argument("--output", default=None, help="file to write the JSON results to, stdout by default")
+    parser.add_argument("--baseline", default=None, help="JSON results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="slowdown of the median allowed over the baseline (default %(default)s)")
+    options = parser.parse_args()
+
+    app.logger.setLevel(logging.CRITICAL)
+    app.config["TESTING"] = True
+    init_db()
+    results = {
+        "meta": {
+            "created": datetime.now().isoformat(),
+            "database": db.engine.dialect.name,
+            "python": platform.python_version(),
+            "sqlalchemy": sqlalchemy.__version__,
+            "json": "orjson" if serializer.orjson else "json",
+            "number": options.number,
+        },
+        "results": run(
+            [int(size) for size in options.sizes.split(",")],
+            options.number,
+            options.only.split(",") if options.only else None,
+        ),
+    }
+    body = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, "w") as output:
+            output.write(body + "\n")
+    else:
+        print(body)
+
+    if options.baseline:
+        with open(options.baseline) as baseline:
+            regressions = compare(results["results"], json.load(baseline), options.tolerance)
+        for size, name, before, after in regressions:
+            print("REGRESSION {} rows {}: {:.3f} -> {:.3f} ms".format(size, name, before, after), file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -19,5 +19,47 @@ if 'VCAP_SERVICES' in os.environ:
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# Connections this instance may hold to the database, shared by its
+# gunicorn workers, which gunicorn.conf.py counts into WEB_CONCURRENCY and
+# GUNICORN_THREADS. Each worker keeps a connection per thread and one for
+# the promotion scheduler, and opens the rest of its share only under load
+DB_MAX_CONNECTIONS = int(os.getenv("DB_MAX_CONNECTIONS", "20"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+WORKER_CONNECTIONS = max(1, DB_MAX_CONNECTIONS // int(os.getenv("WEB_CONCURRENCY", "1")))
+WORKER_POOL_SIZE = min(int(os.getenv("GUNICORN_THREADS", "1")) + 1, WORKER_CONNECTIONS)
+
+# SQLite connections cannot be shared by threads, it keeps its own pool
+SQLALCHEMY_ENGINE_OPTIONS = {} if DATABASE_URI.startswith("sqlite") else {
+    "pool_size": WORKER_POOL_SIZE,
+    "max_overflow": WORKER_CONNECTIONS - WORKER_POOL_SIZE,
+    "pool_recycle": DB_POOL_RECYCLE,
+    "pool_pre_ping": True,
+}
+
+# Seconds before a product in the in-memory promotion index, or the
+# promotion schedule, is reloaded to pick up writes from other workers
+PROMOTION_INDEX_TTL = int(os.getenv("PROMOTION_INDEX_TTL", "60"))
+
+# Seconds between two runs of the promotion scheduler in the background,
+# 0 to only bring the active promotions up to date when they are read
+PROMOTION_SCHEDULER_INTERVAL = float(os.getenv("PROMOTION_SCHEDULER_INTERVAL", "0"))
+
+# Size of the GET /promotions result cache, 0 turns it off, and the
+# seconds a result is kept at most, which bounds staleness across workers
+PROMOTION_CACHE_SIZE = int(os.getenv("PROMOTION_CACHE_SIZE", "256"))
+PROMOTION_CACHE_TTL = int(os.getenv("PROMOTION_CACHE_TTL", "30"))
+
+# Statements slower than this many milliseconds are logged, and requests
+# that run more statements than the limit are logged as likely N+1 queries
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "100"))
+QUERY_COUNT_LIMIT = int(os.getenv("QUERY_COUNT_LIMIT", "20"))
+
+# Logged values and messages are cut to this many characters, records are
+# dropped when more than LOG_QUEUE_SIZE wait to be written, and only this
+# fraction of the requests have their debug and info records kept
+LOG_MESSAGE_LIMIT = int(os.getenv("LOG_MESSAGE_LIMIT", "2000"))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))
+
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "s3cr3t-key-shhhh")
@@ -0,0 +1,112 @@
+"""
+Gunicorn Configuration
+
+Read by gunicorn from the working directory, or with --config:
+
+    gunicorn --config gunicorn.conf.py service:app
+
+The settings come from the environment, defaulting to the CPU cores the
+process may run on:
+
+    GUNICORN_WORKER_CLASS   sync, gthread or gevent, gthread by default
+    WEB_CONCURRENCY         worker processes, 2 * cores + 1 for sync workers,
+                            cores + 1 for the others, at most DB_MAX_CONNECTIONS
+    GUNICORN_THREADS        threads of a gthread worker, 4 by default
+    GUNICORN_PRELOAD        load the app once in the master before forking the
+                            workers, true by default except for gevent
+    GUNICORN_BIND           the address to listen on, 0.0.0.0:$PORT by default
+    GUNICORN_TIMEOUT        seconds before a silent worker is restarted
+    GUNICORN_WORKER_CONNECTIONS
+                            requests a gevent worker serves at once, 1000
+
+The workers and threads are written back to the environment before the app
+is loaded, config.py shares DB_MAX_CONNECTIONS between them to size the
+pool of every worker.
+
+With the app preloaded the master runs the database upgrade once, then
+drops its connections and stops the promotion scheduler before forking:
+a thread does not survive a fork, and a connection shared by processes
+mixes up their statements. Every worker starts its own scheduler.
+"""
+import os
+import tempfile
+
+WORKER_CLASSES = ("sync", "gthread", "gevent")
+
+
+def cores() -> int:
+    """ Returns the number of CPU cores this process may run on """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # not on Linux
+        return os.cpu_count() or 1
+
+
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+if worker_class not in WORKER_CLASSES:
+    raise RuntimeError(
+        "GUNICORN_WORKER_CLASS must be one of {}, not {}".format(", ".join(WORKER_CLASSES), worker_class)
+    )
+# every worker holds at least one connection, see config.py, which has the same default
+max_connections = int(os.getenv("DB_MAX_CONNECTIONS", "20"))
+if os.getenv("WEB_CONCURRENCY"):
+    workers = int(os.getenv("WEB_CONCURRENCY"))
+    if workers > max_connections:
+        raise RuntimeError(
+            "WEB_CONCURRENCY={} workers would need more than DB_MAX_CONNECTIONS={} connections".format(
+                workers, max_connections
+            )
+        )
+else:
+    workers = min(2 * cores() + 1 if worker_class == "sync" else cores() + 1, max_connections)
+threads = int(os.getenv("GUNICORN_THREADS", "4")) if worker_class == "gthread" else 1
+# gevent patches the standard library in the worker, after a preloaded app took its locks
+preload_app = os.getenv("GUNICORN_PRELOAD", str(worker_class != "gevent")).lower() in ("true", "1", "yes")
+bind = os.getenv("GUNICORN_BIND") or "0.0.0.0:{}".format(os.getenv("PORT", "5000"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "1000"))
+keepalive = 5
+loglevel = "info"
+accesslog = None  # every request is logged by the service with its request id
+
+os.environ["WEB_CONCURRENCY"] = str(workers)
+# a gevent worker serves as many requests at once as it accepts connections
+os.environ["GUNICORN_THREADS"] = str(worker_connections if worker_class == "gevent" else threads)
+
+# The workers add up their metrics in files, see service.metrics. This
+# runs before a preloaded app writes any, so the files of an earlier run
+# can be removed
+if workers > 1 and not os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="promotions-metrics-")
+if os.path.isdir(os.getenv("PROMETHEUS_MULTIPROC_DIR", "")):
+    for name in os.listdir(os.environ["PROMETHEUS_MULTIPROC_DIR"]):
+        if name.endswith(".db"):
+            os.remove(os.path.join(os.environ["PROMETHEUS_MULTIPROC_DIR"], name))
+
+
+######################################################################
+#  S E R V E R   H O O K S
+######################################################################
+def when_ready(server):
+    """ Leaves the preloaded master without connections or threads to fork """
+    if server.cfg.preload_app:
+        from service.models import Promotion, db
+        Promotion.scheduler.stop()
+        db.engine.dispose()
+
+
+def post_fork(server, worker):
+    """ Starts the promotion scheduler of a worker forked from a preloaded master """
+    if server.cfg.preload_app:
+        from service import app
+        interval = app.config.get("PROMOTION_SCHEDULER_INTERVAL")
+        if interval:
+            from service.models import Promotion
+            Promotion.scheduler.start(interval, app.app_context)
+
+
+def child_exit(server, worker):
+    """ Drops the live gauges of a worker that exited """
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,45 @@
+"""add promotion indexes
+
+Revision ID: 3858764b93b1
+Revises: e4b6303598df
+Create Date: 2026-10-18 03:21:07.406342
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3858764b93b1'
+down_revision = 'e4b6303598df'
+branch_labels = None
+depends_on = None
+
+INDEXES = {
+    # best promotion, product id filters and the promotion index loader
+    'ix_promotion_product_id_window': ['product_id', 'from_date', 'to_date'],
+    # category filters, usually combined with availability
+    'ix_promotion_category_to_date': ['category', 'to_date'],
+    # availability filters, to_date first as most rows have ended
+    'ix_promotion_to_date_from_date': ['to_date', 'from_date'],
+    'ix_promotion_product_name': ['product_name'],
+}
+
+
+def upgrade():
+    bind = op.get_bind()
+    existing = {index['name'] for index in sa.inspect(bind).get_indexes('promotion')}
+    indexes = {name: columns for name, columns in INDEXES.items() if name not in existing}
+    if bind.dialect.name == 'postgresql':
+        # build the indexes without locking out writes to a live table
+        with op.get_context().autocommit_block():
+            for name, columns in indexes.items():
+                op.create_index(name, 'promotion', columns, postgresql_concurrently=True)
+    else:
+        for name, columns in indexes.items():
+            op.create_index(name, 'promotion', columns)
+
+
+def downgrade():
+    for name in INDEXES:
+        op.drop_index(name, table_name='promotion')
@@ -0,0 +1,32 @@
+"""add promotion version
+
+Revision ID: a6f0c2d9b417
+Revises: 3858764b93b1
+Create Date: 2026-10-18 09:12:44.518203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a6f0c2d9b417'
+down_revision = '3858764b93b1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    if 'version' in {column['name'] for column in inspector.get_columns('promotion')}:
+        return
+    # every existing row starts at the first version
+    op.add_column(
+        'promotion',
+        sa.Column('version', sa.Integer(), server_default='1', nullable=False),
+    )
+
+
+def downgrade():
+    with op.batch_alter_table('promotion') as batch_op:
+        batch_op.drop_column('version')
@@ -0,0 +1,36 @@
+"""add promotion from_date index
+
+Revision ID: c17e5b8f03a2
+Revises: a6f0c2d9b417
+Create Date: 2026-10-18 10:41:03.227915
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c17e5b8f03a2'
+down_revision = 'a6f0c2d9b417'
+branch_labels = None
+depends_on = None
+
+# start date ranges, and the end of active ranges
+INDEX = 'ix_promotion_from_date'
+
+
+def upgrade():
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    if INDEX in {index['name'] for index in inspector.get_indexes('promotion')}:
+        return
+    if bind.dialect.name == 'postgresql':
+        # build the index without locking out writes to a live table
+        with op.get_context().autocommit_block():
+            op.create_index(INDEX, 'promotion', ['from_date'], postgresql_concurrently=True)
+    else:
+        op.create_index(INDEX, 'promotion', ['from_date'])
+
+
+def downgrade():
+    op.drop_index(INDEX, table_name='promotion')
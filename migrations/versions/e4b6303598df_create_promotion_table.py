@@ -0,0 +1,40 @@
+"""create promotion table
+
+Revision ID: e4b6303598df
+Revises: 
+Create Date: 2026-10-18 03:20:41.112086
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4b6303598df'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # deployments made before migrations were added already have the table
+    if 'promotion' in sa.inspect(op.get_bind()).get_table_names():
+        return
+    op.create_table(
+        'promotion',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('product_name', sa.String(length=63), nullable=False),
+        sa.Column('category', sa.Enum('Discount', 'BOGOF', 'Unknown', name='typeofpromo'),
+                  server_default='Unknown', nullable=False),
+        sa.Column('product_id', sa.Integer(), nullable=False),
+        sa.Column('amount', sa.Integer(), nullable=False),
+        sa.Column('description', sa.String(length=63), nullable=True),
+        sa.Column('from_date', sa.DateTime(), nullable=False),
+        sa.Column('to_date', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('promotion')
+    sa.Enum(name='typeofpromo').drop(op.get_bind(), checkfirst=True)
@@ -20,32 +20,32 @@ and SQL database
 """
 import os
 import sys
+import time
 import logging
 from flask import Flask
 
+started = time.perf_counter()
+
 # Create Flask application
 app = Flask(__name__)
 app.config.from_object("config")
 
 # Import the rutes After the Flask app is created
-from service import routes, models
+from service import routes, models, commands, query_stats, logs
 
 # Set up logging for production
 print(f"Setting log level to {logging.INFO}")
 app.logger.setLevel(logging.INFO)
 app.logger.propagate = False
-# Make all log formats consistent
-formatter = logging.Formatter(
-    "[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z"
-)
-for handler in app.logger.handlers:
-    handler.setFormatter(formatter)
+# Write all logs as JSON lines from a background thread
+logs.init_logging()
 app.logger.info("Logging handler established")
 
 app.logger.info(70 * "*")
 app.logger.info("PROMOTION SERVICE RUNNING  ".center(70, "*"))
 app.logger.info(70 * "*")
 
+imported = time.perf_counter()
 try:
     routes.init_db()  # make our sqlalchemy tables
 except Exception as error:
@@ -53,4 +53,7 @@ except Exception as error:
     # gunicorn requires exit code 4 to stop spawning workers when they die
     sys.exit(4)
 
-app.logger.info("Service inititalized!")
+app.logger.info(
+    "Service inititalized in %.0f ms, %.0f ms of it checking the database!",
+    (time.perf_counter() - started) * 1e3, (time.perf_counter() - imported) * 1e3,
+)
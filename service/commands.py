@@ -0,0 +1,193 @@
+"""
+Promotion Commands
+
+Flask CLI commands that import and export Promotions as CSV or newline
+delimited JSON, streaming them so millions of rows never sit in memory:
+
+    flask promotions import promotions.csv
+    flask promotions import --skip-invalid - --format ndjson < promotions.ndjson
+    flask promotions export --category Discount promotions.csv
+
+Imported rows are checked with the deserialize and validate rules of the
+model, without building a Promotion for each, and written BATCH_SIZE at a
+time with COPY FROM STDIN on PostgreSQL, or executemany on other databases,
+all in one transaction. Errors are reported with the line of each row.
+"""
+import csv
+import json
+import time
+import click
+from flask.cli import AppGroup
+from service import app, serializer
+from service.models import Promotion, PromotionValues, DataValidationError, db
+
+# The rows written by each COPY or executemany of an import
+BATCH_SIZE = 10000
+
+# The most row errors printed by an import, the others are only counted
+ERRORS_SHOWN = 100
+
+FORMATS = ("csv", "ndjson")
+
+# The columns of a CSV file, the fields of a serialized Promotion
+CSV_FIELDS = serializer.FIELDS
+
+promotions_cli = AppGroup("promotions", help="Import and export Promotions.")
+
+
+def file_format(path:str, value:str) -> str:
+    """ Returns the format asked for, or the one of the file extension """
+    if value:
+        return value
+    return "csv" if path.lower().endswith(".csv") else "ndjson"
+
+
+def open_stream(path:str, mode:str):
+    """ Opens a file, or stdin or stdout for -, leaving line endings to the csv module """
+    if path == "-":
+        return click.open_file(path, mode)
+    return open(path, mode, encoding="utf-8", newline="")
+
+
+def read_rows(stream, format_:str):
+    """Yields the line number and data of every row of a CSV or NDJSON file
+
+    Data that cannot be read is yielded as a DataValidationError, so it is
+    reported with the other rows
+    """
+    if format_ == "csv":
+        reader = csv.DictReader(stream)
+        for data in reader:
+            yield reader.line_num, from_csv(data)
+        return
+    for line_number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            yield line_number, json.loads(line)
+        except ValueError:
+            yield line_number, DataValidationError("Invalid Promotion: line is not valid JSON")
+
+
+def from_csv(data:dict) -> dict:
+    """ Returns the values of a CSV row with the types of the JSON of a Promotion """
+    for field in ("product_id", "amount"):
+        value = data.get(field)
+        if value is not None:
+            try:
+                data[field] = int(value)
+            except ValueError:
+                pass  # reported by the checks of the row
+    if data.get("description") == "":
+        data["description"] = None
+    return data
+
+
+def check_row(data) -> tuple:
+    """Returns the values of a row to load once they pass the rules of the model
+
+    Raises:
+        DataValidationError: if the row is not a valid Promotion
+    """
+    if isinstance(data, DataValidationError):
+        raise data
+    if not isinstance(data, dict):
+        raise DataValidationError("Invalid Promotion: row must be an object")
+    values = PromotionValues().deserialize(data)
+    values.validate()
+    return values.row()
+
+
+@promotions_cli.command("import")
+@click.argument("path", type=click.Path(allow_dash=True))
+@click.option("--format", "format_", type=click.Choice(FORMATS), default=None,
+              help="Format of the file, from its extension by default.")
+@click.option("--skip-invalid", is_flag=True, default=False,
+              help="Load the valid rows when some are not valid, instead of none.")
+@click.option("--batch-size", type=click.IntRange(min=1), default=BATCH_SIZE, show_default=True,
+              help="Rows written at a time.")
+def import_promotions(path, format_, skip_invalid, batch_size):
+    """Import Promotions from a CSV or NDJSON file, - for stdin
+
+    Nothing is imported when any row is not valid, unless --skip-invalid
+    """
+    format_ = file_format(path, format_)
+    start = time.perf_counter()
+    loaded = errors = 0
+    batch = []
+    try:
+        with open_stream(path, "r") as stream:
+            for line_number, data in read_rows(stream, format_):
+                try:
+                    batch.append(check_row(data))
+                except DataValidationError as error:
+                    errors += 1
+                    if errors <= ERRORS_SHOWN:
+                        click.echo("line {}: {}".format(line_number, error), err=True)
+                    continue
+                if len(batch) >= batch_size:
+                    if skip_invalid or not errors:
+                        Promotion.load_rows(batch)
+                        loaded += len(batch)
+                    batch = []
+            if batch and (skip_invalid or not errors):
+                Promotion.load_rows(batch)
+                loaded += len(batch)
+        if errors and not skip_invalid:
+            db.session.rollback()
+            raise click.ClickException(
+                "{} rows not valid, no Promotions imported, use --skip-invalid to import the others".format(errors)
+            )
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    Promotion.notify_changed_in_bulk()
+    elapsed = time.perf_counter() - start
+    app.logger.info("Imported %d promotions from %s, %d not valid", loaded, path, errors)
+    click.echo("Imported {} promotions in {:.1f}s ({:.0f} rows/s), {} not valid".format(
+        loaded, elapsed, loaded / elapsed if elapsed else 0, errors
+    ), err=True)
+
+
+@promotions_cli.command("export")
+@click.argument("path", type=click.Path(allow_dash=True))
+@click.option("--format", "format_", type=click.Choice(FORMATS), default=None,
+              help="Format of the file, from its extension by default.")
+@click.option("--category", default=None, help="Only export Promotions of this category.")
+@click.option("--product-id", type=int, default=None, help="Only export Promotions for this product.")
+@click.option("--available", is_flag=True, default=False, help="Only export Promotions available now.")
+@click.option("--batch-size", type=click.IntRange(min=1), default=BATCH_SIZE, show_default=True,
+              help="Rows read at a time.")
+def export_promotions(path, format_, category, product_id, available, batch_size):
+    """Export Promotions to a CSV or NDJSON file, - for stdout, ordered by id
+
+    Rows are read through a server-side cursor and written as they come
+    """
+    format_ = file_format(path, format_)
+    args = {"category": category, "product_id": product_id, "available": 1 if available else None}
+    try:
+        statement = Promotion.select_by_multi_attributes(args).order_by(Promotion.id)
+    except DataValidationError as error:
+        raise click.BadParameter(str(error))
+    start = time.perf_counter()
+    count = 0
+    serialize = serializer.serializer(None)
+    with open_stream(path, "w") as stream:
+        if format_ == "csv":
+            writer = csv.DictWriter(stream, CSV_FIELDS)
+            writer.writeheader()
+            write = writer.writerow
+        else:
+            write = lambda data: stream.write(json.dumps(data) + "\n")
+        for record in Promotion.stream_records(statement, batch_size):
+            write(serialize(record))
+            count += 1
+    db.session.remove()
+    elapsed = time.perf_counter() - start
+    click.echo("Exported {} promotions in {:.1f}s ({:.0f} rows/s)".format(
+        count, elapsed, count / elapsed if elapsed else 0
+    ), err=True)
+
+
+app.cli.add_command(promotions_cli)
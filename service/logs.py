@@ -0,0 +1,240 @@
+"""
+Structured Logs
+
+The records of the service are written as one JSON object per line:
+
+    {"time": "2021-12-01T10:00:00.123-05:00", "level": "INFO", "logger": "flask.app",
+     "module": "routes", "message": "Returning 20 promotions", "request_id": "5f0c...",
+     "method": "GET", "route": "/promotions", "elapsed_ms": 2.41}
+
+Handlers only put their records on a queue, a background thread formats
+and writes them, so logging on the request thread costs the same whatever
+is logged. The values a record is made from are cut to LOG_MESSAGE_LIMIT
+characters before they are queued, through reprlib for anything but
+strings and numbers, and the message is cut again once formatted. When the
+queue is full records are dropped and counted rather than waiting for it.
+
+Every record logged while handling a request carries its request id, taken
+from the X-Request-ID header or made up and sent back in the response, its
+route and the milliseconds since it started. LOG_SAMPLE_RATE keeps the
+debug and info records of only that fraction of the requests, warnings and
+errors are always kept.
+"""
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import random
+import reprlib
+import sys
+import time
+import uuid
+from datetime import date, datetime
+from decimal import Decimal
+from enum import Enum
+from logging.handlers import QueueHandler, QueueListener
+from flask import _request_ctx_stack
+from prometheus_client import Counter
+from service import app
+from service.metrics import NAMESPACE
+
+REQUEST_ID_HEADER = "X-Request-ID"
+
+# Values kept as they are in queued records, they cannot change before being written
+IMMUTABLE = (int, float, type(None), date, Decimal, Enum)
+
+DROPPED_RECORDS = Counter(
+    "log_records_dropped_total", "Log records dropped because the log queue was full",
+    namespace=NAMESPACE,
+)
+
+
+class RequestLog:
+    """
+    Class that holds the logging context of a request
+    """
+
+    __slots__ = ("request_id", "method", "route", "start", "sampled")
+
+    def __init__(self, request_id:str, method:str, route:str, sampled:bool=True):
+        self.request_id = request_id
+        self.method = method
+        self.route = route
+        self.start = time.perf_counter()
+        self.sampled = sampled
+
+
+class RequestQueueHandler(QueueHandler):
+    """
+    Handler that puts records on a queue with the context of their request
+
+    The records are not formatted here: their values are bounded so the
+    cost does not depend on them, and the writer thread formats them.
+    """
+
+    def __init__(self, log_queue, limit:int=2000):
+        super().__init__(log_queue)
+        self.limit = limit
+        self.repr = reprlib.Repr()
+        self.repr.maxstring = self.repr.maxother = self.repr.maxlong = limit
+        self.repr.maxlist = self.repr.maxtuple = self.repr.maxdict = self.repr.maxset = 20
+
+    def bound(self, value):
+        """ Returns a value that costs at most about limit characters to format """
+        if isinstance(value, str):
+            return value if len(value) <= self.limit else value[:self.limit] + "..."
+        if isinstance(value, IMMUTABLE):
+            return value
+        if isinstance(value, (bytes, bytearray)) and len(value) > self.limit:
+            # repr of anything but a container is made in full before it is cut
+            return self.repr.repr(value[:self.limit]) + "..."
+        return self.repr.repr(value)
+
+    def prepare(self, record):
+        """ Returns a copy of the record that is safe to format on another thread """
+        context = _request_ctx_stack.top
+        log = None if context is None else getattr(context, "request_log", None)
+        if log is not None and not log.sampled and record.levelno < logging.WARNING:
+            return None
+        record = copy.copy(record)
+        record.msg = self.bound(record.msg)
+        if isinstance(record.args, dict):
+            record.args = {key: self.bound(value) for key, value in record.args.items()}
+        elif record.args:
+            record.args = tuple(self.bound(value) for value in record.args)
+        if record.exc_info:
+            # the traceback refers to frames that go on running
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        if log is not None:
+            record.request_id = log.request_id
+            record.method = log.method
+            record.route = log.route
+            record.elapsed_ms = round((time.perf_counter() - log.start) * 1e3, 2)
+        return record
+
+    def enqueue(self, record):
+        """ Puts the record on the queue, dropping it when the queue is full """
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DROPPED_RECORDS.inc()
+
+    def emit(self, record):
+        try:
+            record = self.prepare(record)
+            if record is not None:
+                self.enqueue(record)
+        except Exception:
+            self.handleError(record)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formatter that writes a record as a line of JSON
+    """
+
+    FIELDS = ("request_id", "method", "route", "elapsed_ms")
+
+    def __init__(self, limit:int=2000):
+        super().__init__()
+        self.limit = limit
+
+    def format(self, record) -> str:
+        message = record.getMessage()
+        if len(message) > self.limit:
+            message = "{}... ({} characters)".format(message[:self.limit], len(message))
+        entry = {
+            "time": datetime.fromtimestamp(record.created).astimezone().isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "message": message,
+        }
+        for name in self.FIELDS:
+            value = getattr(record, name, None)
+            if value is not None:
+                entry[name] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        if record.stack_info:
+            entry["stack"] = record.stack_info
+        return json.dumps(entry, default=str)
+
+
+######################################################################
+#  Q U E U E   A N D   W R I T E R
+######################################################################
+_handler = None
+_listener = None
+
+
+def start_writer():
+    """ Starts the thread that writes the queued records """
+    global _listener
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setFormatter(JsonFormatter(app.config["LOG_MESSAGE_LIMIT"]))
+    _listener = QueueListener(_handler.queue, stream)
+    _listener.start()
+
+
+def init_logging():
+    """ Sends the records of the app logger through the queue, once """
+    global _handler
+    if _handler is not None:
+        return
+    _handler = RequestQueueHandler(
+        queue.Queue(app.config["LOG_QUEUE_SIZE"]), app.config["LOG_MESSAGE_LIMIT"]
+    )
+    # the modules log to flask.app, the logger the app had before Flask 1.1
+    for logger in (app.logger, logging.getLogger("flask.app")):
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+        logger.addHandler(_handler)
+        logger.propagate = False
+    start_writer()
+    atexit.register(flush_logs)
+    # a forked worker has no writer thread, and the queue lock may be held
+    os.register_at_fork(after_in_child=_restart_in_child)
+
+
+def _restart_in_child():
+    _handler.queue = queue.Queue(app.config["LOG_QUEUE_SIZE"])
+    start_writer()
+
+
+def flush_logs():
+    """ Writes every queued record and stops the writer thread """
+    if _listener is not None and _listener._thread is not None:
+        _listener.stop()
+
+
+######################################################################
+#  R E Q U E S T   H O O K S
+######################################################################
+@app.before_request
+def start_request_log():
+    """ Gives the request an id and the context its records carry """
+    context = _request_ctx_stack.top
+    request = context.request
+    request_id = request.headers.get(REQUEST_ID_HEADER) or uuid.uuid4().hex
+    rate = app.config["LOG_SAMPLE_RATE"]
+    context.request_log = RequestLog(
+        request_id[:64], request.method,
+        request.url_rule.rule if request.url_rule is not None else request.path,
+        rate >= 1 or random.random() < rate,
+    )
+
+
+@app.after_request
+def end_request_log(response):
+    """ Sends the request id back and logs the request with its status """
+    log = getattr(_request_ctx_stack.top, "request_log", None)
+    if log is not None:
+        response.headers[REQUEST_ID_HEADER] = log.request_id
+        app.logger.info("%s %s %d", log.method, log.route, response.status_code)
+    return response
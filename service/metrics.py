@@ -0,0 +1,167 @@
+"""
+Service Metrics
+
+Prometheus metrics of the service, served at GET /metrics:
+
+    promotions_http_requests_total{resource, method, status}
+    promotions_http_request_duration_seconds{resource, method}
+    promotions_http_request_errors_total{resource, method, status}
+    promotions_db_pool_connections{state}
+    promotions_query_cache_lookups_total{result}
+
+The resource label is the Flask-RESTX Resource that handled the request,
+such as PromotionResource, or the endpoint of a plain Flask route. The
+duration is measured until the handler returns, a streamed body is not
+waited for.
+
+Under gunicorn every worker is a process with its own metrics. When the
+PROMETHEUS_MULTIPROC_DIR environment variable names a directory before the
+service starts, the workers write their metrics there and /metrics adds
+them up, see prometheus_client multiprocess mode.
+
+Metric children are looked up once per resource and method, so a request
+only pays for one observe and one or two increments.
+"""
+import os
+import time
+from flask import Response, _request_ctx_stack
+from prometheus_client import (
+    CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest,
+)
+from prometheus_client import multiprocess
+from sqlalchemy import event
+from sqlalchemy.pool import Pool
+from service import app
+
+NAMESPACE = "promotions"
+
+# Latency buckets in seconds, finer than the default below 5ms
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REQUESTS = Counter(
+    "http_requests_total", "Requests handled", ["resource", "method", "status"], namespace=NAMESPACE
+)
+REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds", "Seconds spent handling requests", ["resource", "method"],
+    namespace=NAMESPACE, buckets=BUCKETS,
+)
+REQUEST_ERRORS = Counter(
+    "http_request_errors_total", "Requests answered with a 4xx or 5xx status",
+    ["resource", "method", "status"], namespace=NAMESPACE,
+)
+POOL_CONNECTIONS = Gauge(
+    "db_pool_connections", "Database connections of the pool, open or checked out by a request",
+    ["state"], namespace=NAMESPACE, multiprocess_mode="livesum",
+)
+CACHE_LOOKUPS = Counter(
+    "query_cache_lookups_total", "Lookups in the GET /promotions result cache", ["result"],
+    namespace=NAMESPACE,
+)
+
+CACHE_HITS = CACHE_LOOKUPS.labels("hit")
+CACHE_MISSES = CACHE_LOOKUPS.labels("miss")
+_POOL_OPEN = POOL_CONNECTIONS.labels("open")
+_POOL_CHECKED_OUT = POOL_CONNECTIONS.labels("checked_out")
+
+# (resource, method) -> (requests by status, duration), and (resource, method, status) -> errors
+_children = {}
+_error_children = {}
+_resources = {}  # endpoint -> resource label
+
+
+def count_cache_lookup(hit:bool):
+    """ Counts a lookup in the query cache """
+    (CACHE_HITS if hit else CACHE_MISSES).inc()
+
+
+def resource_of(endpoint) -> str:
+    """ Returns the resource label of an endpoint, its Resource class when it has one """
+    resource = _resources.get(endpoint)
+    if resource is None:
+        if endpoint is None:
+            return "unmatched"
+        view = app.view_functions.get(endpoint)
+        resource = getattr(getattr(view, "view_class", None), "__name__", endpoint)
+        _resources[endpoint] = resource
+    return resource
+
+
+######################################################################
+#  R E Q U E S T   H O O K S
+######################################################################
+# The request context is read from its stack once, going through the
+# request and g proxies costs more than recording the metrics
+@app.before_request
+def start_timer():
+    """ Notes when the request started """
+    _request_ctx_stack.top.metrics_start = time.perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    """ Records the duration and status of a request """
+    context = _request_ctx_stack.top
+    start = getattr(context, "metrics_start", None)
+    if start is None:
+        return response
+    elapsed = time.perf_counter() - start
+    key = (resource_of(context.request.endpoint), context.request.method)
+    children = _children.get(key)
+    if children is None:
+        children = _children[key] = ({}, REQUEST_DURATION.labels(*key))
+    counters, duration = children
+    code = response.status_code
+    counter = counters.get(code)
+    if counter is None:
+        counter = counters[code] = REQUESTS.labels(key[0], key[1], str(code))
+    counter.inc()
+    duration.observe(elapsed)
+    if code >= 400:
+        error_key = key + (code,)
+        errors = _error_children.get(error_key)
+        if errors is None:
+            errors = _error_children[error_key] = REQUEST_ERRORS.labels(key[0], key[1], str(code))
+        errors.inc()
+    return response
+
+
+######################################################################
+#  D A T A B A S E   P O O L
+######################################################################
+@event.listens_for(Pool, "connect")
+def _connected(dbapi_connection, connection_record):
+    _POOL_OPEN.inc()
+
+
+@event.listens_for(Pool, "close")
+@event.listens_for(Pool, "close_detached")
+def _closed(dbapi_connection, *args):
+    _POOL_OPEN.dec()
+
+
+@event.listens_for(Pool, "checkout")
+def _checked_out(dbapi_connection, connection_record, connection_proxy):
+    _POOL_CHECKED_OUT.inc()
+
+
+@event.listens_for(Pool, "checkin")
+def _checked_in(dbapi_connection, connection_record):
+    _POOL_CHECKED_OUT.dec()
+
+
+######################################################################
+#  M E T R I C S   E N D P O I N T
+######################################################################
+def multiprocess_dir():
+    """ Returns the directory the workers share their metrics in, None when not set """
+    return os.getenv("PROMETHEUS_MULTIPROC_DIR") or os.getenv("prometheus_multiproc_dir")
+
+
+@app.route("/metrics")
+def metrics():
+    """ Returns the metrics in the Prometheus text format """
+    registry = REGISTRY
+    if multiprocess_dir():
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
@@ -3,22 +3,142 @@ Models for Promotion
 
 All of the models are stored in this module
 """
-from datetime import datetime
+import io
+import os
+import operator
+from collections import namedtuple
+from functools import lru_cache
+from datetime import datetime, timedelta
 import logging
 from flask_sqlalchemy import SQLAlchemy
+from flask_migrate import Migrate, upgrade
+from alembic.runtime.migration import MigrationContext
+from alembic.script import ScriptDirectory
+from sqlalchemy import case, event, func
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
 from enum import Enum
 import dateutil.parser
+from service.promotion_index import PromotionIndex
+from service.scheduler import PromotionScheduler
 
 logger = logging.getLogger("flask.app")
 
+# The number of rows written by each multi-row INSERT of a bulk create
+BULK_INSERT_SIZE = 1000
+
+# The columns of the rows written by Promotion.load_rows(), in order
+LOAD_COLUMNS = ("product_name", "category", "product_id", "amount", "description", "from_date", "to_date")
+
 # Create the SQLAlchemy object to be initialized later in init_db()
 db = SQLAlchemy()
 
+# Schema changes are made by the migrations in this directory
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "migrations")
+migrate = Migrate(directory=MIGRATIONS_DIR)
+
+# Key of the PostgreSQL advisory lock taken while the schema is checked, so
+# processes starting together upgrade it one at a time
+SCHEMA_LOCK_KEY = 7_052_017
+
+
+def latest_revisions() -> set:
+    """ Returns the head revisions of the migrations """
+    return set(ScriptDirectory.from_config(migrate.get_config()).get_heads())
+
+
+def upgrade_schema():
+    """Upgrades the database to the latest migration unless it is there already
+
+    Reading the revision of the database is one query, running the
+    migrations environment to find there is nothing to do is many more
+    """
+    latest = latest_revisions()
+    with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        # autocommit leaves no transaction open for CREATE INDEX CONCURRENTLY to wait on
+        locked = connection.dialect.name == "postgresql"
+        if locked:
+            connection.execute(db.select([func.pg_advisory_lock(SCHEMA_LOCK_KEY)]))
+        try:
+            current = set(MigrationContext.configure(connection).get_current_heads())
+            if current == latest:
+                logger.info("Database schema is at %s", ", ".join(sorted(current)))
+                return
+            logger.info("Upgrading the database schema from %s to %s",
+                        ", ".join(sorted(current)) or "nothing", ", ".join(sorted(latest)))
+            upgrade()
+        finally:
+            if locked:
+                connection.execute(db.select([func.pg_advisory_unlock(SCHEMA_LOCK_KEY)]))
+
 
 class DataValidationError(Exception):
     """ Used for an data validation errors when deserializing """
 
 
+class VersionConflictError(Exception):
+    """ Used when a Promotion was changed by someone else since it was read """
+
+
+class day_before(FunctionElement):
+    """ SQL expression for the datetime one day before another """
+    type = db.DateTime()
+    name = "day_before"
+
+
+@compiles(day_before)
+def _compile_day_before(element, compiler, **kw):
+    return "(%s - INTERVAL '1 day')" % compiler.process(element.clauses, **kw)
+
+
+@compiles(day_before, "sqlite")
+def _compile_day_before_sqlite(element, compiler, **kw):
+    # SQLite stores datetimes as text, keep the microseconds that strftime drops
+    value = compiler.process(element.clauses, **kw)
+    return "(strftime('%%Y-%%m-%%d %%H:%%M:%%S', %s, '-1 day') || substr(%s, 20))" % (value, value)
+
+
+def parse_date(value):
+    """Returns the datetime of an ISO date, or of any date dateutil understands
+
+    datetime.fromisoformat() is tried first as it is much faster. Dates
+with a time zone are converted to local time, which Promotions are kept in
+
+    Raises:
+        DataValidationError: if the value is not a date
+    """
+    if value is None:
+        return None
+    if not isinstance(value, datetime):
+        try:
+            value = datetime.fromisoformat(value)
+        except ValueError:
+            try:
+                value = dateutil.parser.parse(value)
+            except (ValueError, OverflowError):
+                raise DataValidationError("Invalid date: " + value)
+    if value.tzinfo is not None:
+        value = value.astimezone().replace(tzinfo=None)
+    return value
+
+
+# The attributes that bound the dates of Promotions, both bounds are included.
+# A Promotion is active at some point in [active_from, active_to] when the
+# two intervals overlap. Each is a range on one indexed date column
+DATE_BOUNDS = {
+    "from_date_after": ("from_date", operator.ge),
+    "from_date_before": ("from_date", operator.le),
+    "to_date_after": ("to_date", operator.ge),
+    "to_date_before": ("to_date", operator.le),
+    "active_from": ("to_date", operator.ge),
+    "active_to": ("from_date", operator.le),
+}
+
+# The attributes that hold a date
+DATE_ATTRIBUTES = ("from_date", "to_date") + tuple(DATE_BOUNDS)
+
+
 # Different kinds of promotions
 class TypeOfPromo(Enum):
     """Enumeration of valid Promotions's type"""
@@ -27,6 +147,21 @@ class TypeOfPromo(Enum):
     Unknown = 3
 
 
+# The fields a Promotion is written out with, in order, and the Python
+# expression that writes each one out, see service.serializer. The
+# promotion_model of the API lists the same fields
+FIELD_EXPRESSIONS = {
+    "id": "promotion.id",
+    "product_name": "promotion.product_name",
+    "category": "promotion.category.name",
+    "product_id": "promotion.product_id",
+    "amount": "promotion.amount",
+    "description": "promotion.description",
+    "from_date": "promotion.from_date.isoformat()",
+    "to_date": "promotion.to_date.isoformat()",
+}
+
+
 class Promotion(db.Model):
     """
     Class that represents a Promotion
@@ -34,6 +169,9 @@ class Promotion(db.Model):
     
     app = None
 
+    # Objects told about every change to Promotions, see notify_changed()
+    listeners = []
+
     # Table Schema
     id = db.Column(db.Integer, primary_key=True)
     product_name = db.Column(db.String(63), nullable=False)
@@ -45,7 +183,20 @@ class Promotion(db.Model):
     description = db.Column(db.String(63), nullable=True)
     from_date = db.Column(db.DateTime(), nullable=False)
     to_date = db.Column(db.DateTime(), nullable=False)
-    
+    # bumped by every change, used for ETags and optimistic concurrency
+    version = db.Column(db.Integer, nullable=False, server_default="1")
+
+    # Indexes for the ways promotions are looked up, see the migrations
+    __table_args__ = (
+        db.Index("ix_promotion_product_id_window", "product_id", "from_date", "to_date"),
+        db.Index("ix_promotion_category_to_date", "category", "to_date"),
+        db.Index("ix_promotion_to_date_from_date", "to_date", "from_date"),
+        db.Index("ix_promotion_product_name", "product_name"),
+        db.Index("ix_promotion_from_date", "from_date"),
+    )
+
+    # UPDATEs and DELETEs only match the version that was read
+    __mapper_args__ = {"version_id_col": version}
 
     def __repr__(self):
         return "<Promotion for %r id=[%s]>" % (self.product_name, self.id)
@@ -56,38 +207,201 @@ class Promotion(db.Model):
         """
         logger.info("Creating Promotion for %s", self.product_name)
         self.id = None  # id must be none to generate next primary key
+        self.validate()
+        db.session.add(self)
+        db.session.commit()
+        Promotion.notify_changed([(None, self.to_record())])
+
+    @classmethod
+    def create_many(cls, promotions:list):
+        """
+        Creates many Promotions to the database in a single transaction
+
+        On PostgreSQL the ids are taken from the sequence in one query and the
+        rows written BULK_INSERT_SIZE at a time with multi-row INSERTs, other
+        databases insert them with one executemany and the ids are read back
+        after it. The Promotions are left detached from the session with their
+        ids set
+        """
+        logger.info("Creating %d Promotions", len(promotions))
+        for promotion in promotions:
+            promotion.id = None  # id must be none to generate next primary key
+            promotion.validate()
+            promotion.version = 1  # the first version, as the ORM would set it
+        table = cls.__table__
+        try:
+            if db.engine.dialect.name == "postgresql":
+                # the ids are taken from the sequence first, the rows a multi-row
+                # INSERT returns are not guaranteed to be in the order of its values
+                ids = db.session.execute(
+                    db.text("SELECT nextval(pg_get_serial_sequence(:table, 'id')) FROM generate_series(1, :count)"),
+                    {"table": cls.__tablename__, "count": len(promotions)},
+                )
+                for promotion, (promotion_id,) in zip(promotions, ids):
+                    promotion.id = promotion_id
+                for start in range(0, len(promotions), BULK_INSERT_SIZE):
+                    chunk = promotions[start:start + BULK_INSERT_SIZE]
+                    db.session.execute(
+                        table.insert().values([dict(promotion.row(), id=promotion.id) for promotion in chunk])
+                    )
+            elif promotions:
+                db.session.execute(table.insert(), [promotion.row() for promotion in promotions])
+                # the rows are given the next ids in order and the database is
+                # locked for writing until the commit, so the last ids are theirs
+                ids = db.session.execute(
+                    db.select([table.c.id]).order_by(table.c.id.desc()).limit(len(promotions))
+                ).fetchall()
+                for promotion, (promotion_id,) in zip(promotions, reversed(ids)):
+                    promotion.id = promotion_id
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        Promotion.notify_changed([(None, promotion.to_record()) for promotion in promotions])
+
+    @classmethod
+    def load_rows(cls, rows:list):
+        """Writes rows of new Promotions in the current transaction, without committing
+
+        On PostgreSQL they are streamed with COPY FROM STDIN, other databases
+        insert them with one executemany. Nothing is validated and the
+        listeners are not told, callers must do both
+
+        Args:
+            rows (list): tuples of the values of LOAD_COLUMNS
+        """
+        if db.engine.dialect.name == "postgresql":
+            buffer = io.StringIO("".join(_copy_line(row) for row in rows))
+            cursor = db.session.connection().connection.cursor()
+            try:
+                cursor.copy_expert(
+                    "COPY {} ({}) FROM STDIN".format(cls.__tablename__, ", ".join(LOAD_COLUMNS)), buffer
+                )
+            finally:
+                cursor.close()
+        else:
+            db.session.execute(cls.__table__.insert(), [dict(zip(LOAD_COLUMNS, row)) for row in rows])
+
+    def validate(self):
+        """
+        Checks a Promotion against the rules it must pass before it is saved
+
+        The types are checked as well, so a value the database would reject
+        is reported for its Promotion instead of failing the whole statement
+        """
+        if not isinstance(self.product_name, str):
+            raise DataValidationError("product_name must be a string")
+        if not isinstance(self.product_id, int) or isinstance(self.product_id, bool):
+            raise DataValidationError("product_id must be an integer")
+        if self.description is not None and not isinstance(self.description, str):
+            raise DataValidationError("description must be a string")
+        if not isinstance(self.from_date, datetime) or not isinstance(self.to_date, datetime):
+            raise DataValidationError("from_date and to_date must be dates, e.g. 2021-01-01")
+        if not isinstance(self.amount, int) or isinstance(self.amount, bool):
+            raise DataValidationError("amount must be an integer")
+        if not isinstance(self.category, TypeOfPromo):
+            raise DataValidationError("category must be one of " + ", ".join(TypeOfPromo.__members__))
+        for name in ("product_name", "description"):
+            value, length = getattr(self, name), Promotion.__table__.columns[name].type.length
+            if value is not None and len(value) > length:
+                raise DataValidationError("{} must be at most {} characters".format(name, length))
         if self.category == TypeOfPromo.Discount and self.amount > 100:
             raise DataValidationError("Discount cannot exceed 100%")
         if self.amount <= 0:
             raise DataValidationError("amount must be grater than 0")
-        db.session.add(self)
-        db.session.commit()
+
+    def row(self) -> dict:
+        """ Returns the column values of a Promotion without its id """
+        return {
+            column.key: getattr(self, column.key)
+            for column in self.__table__.columns
+            if column.key != "id"
+        }
 
     def update(self):
         """
         Updates a Promotion to the database
         """
         logger.info("Saving Promotion for %s", self.product_name)
-        db.session.commit()
+        before = self.committed_record()
+        self.commit_version()
+        Promotion.notify_changed([(before, self.to_record())])
 
     def delete(self):
         """ Removes a Promotion from the data store """
         logger.info("Deleting Promotion for %s", self.product_name)
+        before = self.to_record()
         db.session.delete(self)
-        db.session.commit()
+        self.commit_version()
+        Promotion.notify_changed([(before, None)])
 
-    def serialize(self):
-        """ Serializes a Promotion into a dictionary """
-        return {
-            "id": self.id,
-            "product_name": self.product_name,
-            "category": self.category.name,
-            "product_id": self.product_id,
-            "amount": self.amount,
-            "description": self.description,
-            "from_date": self.from_date.isoformat(),
-            "to_date": self.to_date.isoformat(),
-        }
+    def commit_version(self):
+        """Commits a change to a Promotion made on the version that was read
+
+        Raises:
+            VersionConflictError: if the Promotion was changed or deleted since
+        """
+        try:
+            db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            raise VersionConflictError(
+                "Promotion with id '{}' was changed by another request".format(self.id)
+            )
+
+    def etag(self, fields=None) -> str:
+        """Returns the strong entity tag of a Promotion, as read or serialized with fields
+
+        Args:
+            fields (list): the fields of the representation, all of them when None
+        """
+        tag = "{}-{}".format(self.id, self.version)
+        if fields is not None:
+            tag += "-" + "-".join(fields)
+        return tag
+
+    def to_record(self):
+        """ Returns the values of a Promotion as a read-only PromotionRecord """
+        return PromotionRecord._make(getattr(self, field) for field in PromotionRecord._fields)
+
+    def committed_record(self):
+        """ Returns the values a Promotion has in the database, before any unsaved change """
+        state = db.inspect(self)
+        values = []
+        for field in PromotionRecord._fields:
+            history = state.attrs[field].history
+            values.append(history.deleted[0] if history.deleted else getattr(self, field))
+        return PromotionRecord._make(values)
+
+    @classmethod
+    def notify_changed(cls, changes:list):
+        """Tells the listeners that Promotions were created, updated or deleted
+
+        Args:
+            changes (list): the (before, after) PromotionRecords of each changed
+                Promotion, None before a create and after a delete
+        """
+        for listener in cls.listeners:
+            listener.changed(changes)
+
+    @classmethod
+    def notify_changed_in_bulk(cls, product_ids=None):
+        """Tells the listeners that unknown Promotions were changed by a bulk action
+
+        Args:
+            product_ids (list): the products of the changed Promotions, None for any product
+        """
+        for listener in cls.listeners:
+            listener.changed_in_bulk(product_ids)
+
+    def serialize(self, fields=None):
+        """Serializes a Promotion into a dictionary
+
+        Args:
+            fields (list): the only fields to serialize, all of them when None
+        """
+        from service import serializer  # it reads FIELD_EXPRESSIONS from this module
+        return serializer.to_dict(self, fields)
 
     def deserialize(self, data):
         """
@@ -134,18 +448,44 @@ class Promotion(db.Model):
             )
         return self
 
-    def is_available(self):
-        return self.from_date <= datetime.now() and self.to_date >= datetime.now()
+    def is_available(self, at:datetime=None):
+        """ Returns if a Promotion is available at a time, now when None """
+        at = at or datetime.now()
+        return self.from_date <= at <= self.to_date
+
+    def score(self) -> float:
+        """Returns how much a Promotion takes off, used to rank promotions
+
+        Discount takes off amount percent and BOGOF one item out of amount,
+        any other category never takes anything off
+        """
+        if self.category == TypeOfPromo.Discount:
+            return self.amount / 100.
+        if self.category == TypeOfPromo.BOGOF:
+            return 1. / self.amount
+        return 0.
    
     @classmethod
     def init_db(cls, app):
-        """ Initializes the database session """
+        """Initializes the database session
+
+        The engine is bound and the schema checked once per app, calling it
+        again only reads the settings of the indexes
+        """
+        cls.index.ttl = app.config.get("PROMOTION_INDEX_TTL")
+        cls.scheduler.ttl = app.config.get("PROMOTION_INDEX_TTL")
+        if cls.app is app:
+            return
         logger.info("Initializing database")
         cls.app = app
         # This is where we initialize SQLAlchemy from the Flask app
         db.init_app(app)
+        migrate.init_app(app, db)
         app.app_context().push()
-        db.create_all()  # make our sqlalchemy tables
+        upgrade_schema()  # migrate our sqlalchemy tables to the latest schema
+        interval = app.config.get("PROMOTION_SCHEDULER_INTERVAL")
+        if interval:
+            cls.scheduler.start(interval, app.app_context)
 
     @classmethod
     def all(cls):
@@ -210,7 +550,7 @@ class Promotion(db.Model):
             from_date (str): the start date of the Promotions you want to match
         """ 
         logger.info("Processing start date query for %s ...", from_date)
-        return cls.query.filter(cls.from_date == dateutil.parser.parse(from_date))
+        return cls.query.filter(cls.from_date == parse_date(from_date))
 
     @classmethod
     def find_by_to_date(cls, to_date:str) -> list:
@@ -220,79 +560,552 @@ class Promotion(db.Model):
             to_date (str): the end date of the Promotions you want to match
         """ 
         logger.info("Processing end date query for %s ...", to_date)
-        return cls.query.filter(cls.to_date == dateutil.parser.parse(to_date))
+        return cls.query.filter(cls.to_date == parse_date(to_date))
+
+    @classmethod
+    def find_by_from_date_range(cls, start=None, end=None) -> list:
+        """Returns all Promotions that start between two dates, both included
+
+        Args:
+            start (str): the earliest start date, unbounded when None
+            end (str): the latest start date, unbounded when None
+        """
+        logger.info("Processing start date range query for %s to %s ...", start, end)
+        return cls.find_by_multi_attributes({"from_date_after": start, "from_date_before": end})
+
+    @classmethod
+    def find_by_to_date_range(cls, start=None, end=None) -> list:
+        """Returns all Promotions that end between two dates, both included
+
+        Args:
+            start (str): the earliest end date, unbounded when None
+            end (str): the latest end date, unbounded when None
+        """
+        logger.info("Processing end date range query for %s to %s ...", start, end)
+        return cls.find_by_multi_attributes({"to_date_after": start, "to_date_before": end})
 
     @classmethod
-    def find_by_availability(cls, available:bool=True) -> list:
+    def find_active_between(cls, start=None, end=None) -> list:
+        """Returns all Promotions active at any point between two dates
+
+        That is every Promotion whose dates overlap the range, both ends included
+
+        Args:
+            start (str): the start of the range, unbounded when None
+            end (str): the end of the range, unbounded when None
+        """
+        logger.info("Processing active range query for %s to %s ...", start, end)
+        return cls.find_by_multi_attributes({"active_from": start, "active_to": end})
+
+    @classmethod
+    def find_by_availability(cls, available:bool=True, at:datetime=None) -> list:
         """Returns all Promotions by their availability
 
         :param available: True for promotions that are available
         :type available: boolean
-
+        :param at: the time to check the availability at, now when None
+        :type at: datetime
 
         :return: a collection of Promotions that are available
         :rtype: list
 
         """
-        logger.info("Processing available query for %s ...", available)
+        logger.info("Processing available query for %s at %s ...", available, at)
+        return cls.query.filter(*cls.availability_criteria(available, at))
+
+    @classmethod
+    def availability_criteria(cls, available:bool=True, at:datetime=None) -> list:
+        """Returns the SQL criteria that match Promotions by their availability
+
+        The clock is read once, so every criterion is checked at the same time
+
+        :param available: True for promotions that are available
+        :param at: the time to check the availability at, now when None
+        """
+        at = at or datetime.now()
         if available:
-            return cls.query.filter(
-                cls.from_date <= datetime.now()
-                ).filter(
-                    cls.to_date >= datetime.now()
-                )
-        else:
-            return cls.query.filter(
-                (cls.from_date > datetime.now()) | (cls.to_date < datetime.now())
-            )
+            return [cls.from_date <= at, cls.to_date >= at]
+        return [(cls.from_date > at) | (cls.to_date < at)]
+
+    @classmethod
+    def score_expression(cls):
+        """Returns the SQL expression that scores a Promotion like score() does
+
+        Both divisions are done in floating point so the database ranks
+        promotions exactly as the in-memory index does
+        """
+        amount = db.cast(cls.amount, db.Float)
+        return case(
+            [
+                (cls.category == TypeOfPromo.Discount, amount / 100),
+                (cls.category == TypeOfPromo.BOGOF, 1 / amount),
+            ],
+            else_=0.,
+        )
 
     @classmethod
-    def find_best_promotion_for_product(cls, product_id:int):
-        """Returns the best available Promotion for a product""" 
+    def find_best_promotion_for_product(cls, product_id:int, at:datetime=None):
+        """Returns the best Promotion available for a product at a time, now when None
 
-        promotions = cls.query.filter(
+        Promotions are ranked by the database so only the winner is loaded,
+        ties go to the promotion with the lowest id
+        """
+        logger.info("Processing best promotion query for product %s ...", product_id)
+        now = at or datetime.now()
+        score = cls.score_expression()
+        return cls.query.filter(
             cls.product_id == product_id
             ).filter(
-            cls.from_date <= datetime.now()).filter(
-                cls.to_date >= datetime.now()
-            )
-        promotion_list = [promotion for promotion in promotions]
-        max_off = 0
-        best_promotion = None
-        for promotion in promotion_list:
-            if promotion.category == TypeOfPromo.Discount:
-                off = promotion.amount / 100.
-            elif promotion.category == TypeOfPromo.BOGOF:
-                off = 1. / promotion.amount
-            if off > max_off:
-                max_off = off
-                best_promotion = promotion
-        return best_promotion
+                cls.from_date <= now
+            ).filter(
+                cls.to_date >= now
+            ).filter(
+                score > 0
+            ).order_by(score.desc(), cls.id).first()
 
     @classmethod
-    def find_by_multi_attributes(cls, args) -> list:
-        result = cls.query
+    def find_best_promotions_for_products(cls, product_ids, at:datetime=None) -> dict:
+        """Returns the best available Promotion for many products
+
+        Every product is ranked in one query with a window function,
+        products without an available promotion map to None
+
+        Args:
+            product_ids (list): the product ids of the Promotions you want to match
+            at (datetime): the time the Promotions must be available at, now when None
+        """
+        logger.info("Processing best promotion query for %d products ...", len(product_ids))
+        now = at or datetime.now()
+        score = cls.score_expression()
+        ranked = db.session.query(
+            cls.id.label("id"),
+            func.row_number().over(
+                partition_by=cls.product_id, order_by=(score.desc(), cls.id)
+            ).label("rank"),
+        ).filter(
+            cls.product_id.in_(product_ids)
+            ).filter(
+                cls.from_date <= now
+            ).filter(
+                cls.to_date >= now
+            ).filter(
+                score > 0
+            ).subquery()
+        best = cls.query.join(ranked, cls.id == ranked.c.id).filter(ranked.c.rank == 1)
+        promotions = dict.fromkeys(product_ids)
+        promotions.update((promotion.product_id, promotion) for promotion in best)
+        return promotions
+
+    @classmethod
+    def find_best_in_index(cls, product_id:int, at:datetime=None) -> dict:
+        """Returns the serialized best Promotion available for a product at a time, now when None
+
+        The lookup is answered in memory: by the active set of the scheduler
+        for now, and by the promotion index at other times, which apart from
+        the first lookup of a product does not query the database
+        """
+        logger.info("Processing best promotion lookup for product %s ...", product_id)
+        if at is None:
+            return cls.scheduler.best(product_id)
+        return cls.index.best(product_id, at)
+
+    @classmethod
+    def find_best_many_in_index(cls, product_ids, at:datetime=None) -> dict:
+        """Returns the serialized best available Promotion for many products
+
+        Products missing from the index are loaded together with one query,
+        products without an available promotion map to None
+
+        Args:
+            product_ids (list): the product ids of the Promotions you want to match
+            at (datetime): the time the Promotions must be available at, now when None
+        """
+        logger.info("Processing best promotion lookup for %d products ...", len(product_ids))
+        if at is None:
+            return cls.scheduler.best_many(product_ids)
+        return cls.index.best_many(product_ids, at)
+
+    @classmethod
+    def find_available_records(cls, args) -> list:
+        """Returns the Promotions available now that match the other attributes
+
+        They are read from the active set of the scheduler, without
+        querying the database or looking at Promotions that have ended
+
+        :param args: the attributes, as taken by find_by_multi_attributes
+        :return: the matching PromotionRecords, in no particular order
+        :rtype: list
+        """
+        logger.info("Processing available lookup for %s ...", args)
+        cls.multi_attribute_criteria(args)  # the same validation as a query
+        return [
+            record
+            for record in cls.scheduler.active()
+            if cls.matches_multi_attributes(args, record)
+        ]
+
+    @classmethod
+    def find_available_by_product_ids(cls, product_ids, at:datetime=None) -> dict:
+        """Returns every Promotion available for each product at a time, now when None
+
+        For now they come from the active set of the scheduler, at other
+        times all of the products are read with one query
+
+        Args:
+            product_ids (list): the product ids of the Promotions you want to match
+            at (datetime): the time the Promotions must be available at
+
+        :return: a map of product id to a list of PromotionRecords, empty on a miss
+        :rtype: dict
+        """
+        logger.info("Processing available lookup for %d products ...", len(product_ids))
+        if at is None:
+            return cls.scheduler.active_by_product(product_ids)
+        statement = cls.select_fields().where(cls.product_id.in_(product_ids))
+        for criterion in cls.availability_criteria(True, at):
+            statement = statement.where(criterion)
+        promotions = {product_id: [] for product_id in product_ids}
+        for record in cls.fetch_records(statement):
+            promotions[record.product_id].append(record)
+        return promotions
+
+    @classmethod
+    def find_scheduled_records(cls, at:datetime) -> list:
+        """ Returns the Promotions that have not ended at a time, the ones the scheduler keeps """
+        logger.info("Processing scheduled query at %s ...", at)
+        return cls.fetch_records(cls.select_fields().where(cls.to_date >= at))
+
+    @classmethod
+    def find_by_product_ids(cls, product_ids) -> list:
+        """Returns all Promotions for any of the product ids
+
+        Args:
+            product_ids (list): the product ids of the Promotions you want to match
+        """
+        logger.info("Processing product query for %d ids ...", len(product_ids))
+        return cls.query.filter(cls.product_id.in_(product_ids)).order_by(cls.id)
+
+    @classmethod
+    def find_ranked_by_product_ids(cls, product_ids) -> list:
+        """Returns the Promotions that can be the best for any of the product ids
+
+        They are ranked by the database like find_best_promotion_for_product()
+        does, best first, and the ones that never win are left out. The
+        promotion index is loaded with them
+
+        Args:
+            product_ids (list): the product ids of the Promotions you want to match
+        """
+        logger.info("Processing ranked product query for %d ids ...", len(product_ids))
+        score = cls.score_expression()
+        return cls.query.filter(
+            cls.product_id.in_(product_ids)
+            ).filter(
+                score > 0
+            ).order_by(score.desc(), cls.id)
+
+    @classmethod
+    def expire_by_multi_attributes(cls, args, dry_run:bool=False) -> int:
+        """Expires every Promotion matching the attributes with one UPDATE
+
+        Like the expire action, the end date is set to 1 day before the start date
+
+        :param args: the attributes, as taken by find_by_multi_attributes
+        :param dry_run: only count the Promotions that would be expired
+
+        :return: the number of Promotions expired
+        :rtype: int
+        """
+        logger.info("Processing expire query for %s, dry run %s ...", args, dry_run)
+        promotions = cls.find_by_multi_attributes(args)
+        if dry_run:
+            return promotions.count()
+        product_ids = [product_id for (product_id,) in promotions.with_entities(cls.product_id).distinct()]
+        count = promotions.update(
+            {cls.to_date: day_before(cls.from_date), cls.version: cls.version + 1},
+            synchronize_session=False,
+        )
+        db.session.commit()
+        cls.notify_changed_in_bulk(product_ids)
+        return count
+
+    @classmethod
+    def delete_by_multi_attributes(cls, args, dry_run:bool=False) -> int:
+        """Deletes every Promotion matching the attributes with one DELETE
+
+        :param args: the attributes, as taken by find_by_multi_attributes
+        :param dry_run: only count the Promotions that would be deleted
+
+        :return: the number of Promotions deleted
+        :rtype: int
+        """
+        logger.info("Processing delete query for %s, dry run %s ...", args, dry_run)
+        promotions = cls.find_by_multi_attributes(args)
+        if dry_run:
+            return promotions.count()
+        product_ids = [product_id for (product_id,) in promotions.with_entities(cls.product_id).distinct()]
+        count = promotions.delete(synchronize_session=False)
+        db.session.commit()
+        cls.notify_changed_in_bulk(product_ids)
+        return count
+
+    @classmethod
+    def multi_attribute_criteria(cls, args) -> list:
+        """Returns the SQL criteria that match Promotions by their attributes
+
+        Availability is checked at the time in args["at"], now when it is missing
+
+        :param args: the attributes to match, missing or None ones are ignored
+        :return: the criteria, all of which must hold
+        :rtype: list
+        """
+        criteria = []
         if "category" in args and args["category"] is not None:
             category = args["category"]
             if isinstance(category, str):
-                category = TypeOfPromo[category.split('.')[-1]]
-            result = result.filter(cls.category == category)
+                try:
+                    category = TypeOfPromo[category.split('.')[-1]]
+                except KeyError:
+                    raise DataValidationError("Invalid category: " + category)
+            criteria.append(cls.category == category)
         if "product_name" in args and args["product_name"] is not None:
-            result = result.filter(cls.product_name == args["product_name"])
+            criteria.append(cls.product_name == args["product_name"])
         if "product_id" in args and args["product_id"] is not None:
-            result = result.filter(cls.product_id == args["product_id"])
+            criteria.append(cls.product_id == args["product_id"])
         if "from_date" in args and args["from_date"] is not None:
-            result = result.filter(cls.from_date == args["from_date"])
+            criteria.append(cls.from_date == parse_date(args["from_date"]))
         if "to_date" in args and args["to_date"] is not None:
-            result = result.filter(cls.to_date == args["to_date"])
+            criteria.append(cls.to_date == parse_date(args["to_date"]))
+        for name, (field, compare) in DATE_BOUNDS.items():
+            if args.get(name) is not None:
+                criteria.append(compare(getattr(cls, field), parse_date(args[name])))
         if "available" in args and args["available"] is not None:
-            if int(args["available"]) > 0:
-                result = result.filter(
-                cls.from_date <= datetime.now()).filter(
-                    cls.to_date >= datetime.now()
-                )
-            else:
-                result = result.filter(
-                    (cls.from_date > datetime.now()) | (datetime.now() > cls.to_date)
-                )
-        return result
\ No newline at end of file
+            criteria.extend(
+                cls.availability_criteria(int(args["available"]) > 0, parse_date(args.get("at")))
+            )
+        return criteria
+
+    @classmethod
+    def matches_multi_attributes(cls, args, promotion) -> bool:
+        """Returns if a Promotion could be matched by find_by_multi_attributes
+
+        Availability changes with time so it is not checked, and dates that
+        cannot be parsed are taken to match. The answer errs on the side of
+        a match, which is what caches need to tell what a change affects
+
+        :param args: the attributes, as taken by find_by_multi_attributes
+        :param promotion: a Promotion or PromotionRecord
+        """
+        if args.get("category") is not None:
+            category = args["category"]
+            if isinstance(category, str):
+                category = TypeOfPromo.__members__.get(category.split('.')[-1])
+            if category is not None and promotion.category != category:
+                return False
+        if args.get("product_name") is not None and promotion.product_name != args["product_name"]:
+            return False
+        if args.get("product_id") is not None and promotion.product_id != args["product_id"]:
+            return False
+        bounds = [(field, field, operator.eq) for field in ("from_date", "to_date")]
+        bounds.extend((name, field, compare) for name, (field, compare) in DATE_BOUNDS.items())
+        for name, field, compare in bounds:
+            if args.get(name) is None:
+                continue
+            try:
+                value = parse_date(args[name])
+            except DataValidationError:
+                continue
+            if not compare(getattr(promotion, field), value):
+                return False
+        return True
+
+    @classmethod
+    def next_availability_change(cls, args, now:datetime):
+        """Returns when the availability of the Promotions matching the attributes next changes
+
+        That is the earliest start date after now or end date from now on,
+        and None when no Promotion will ever become available or unavailable
+
+        :param args: the attributes, as taken by find_by_multi_attributes
+        :param now: the time to look after
+        """
+        criteria = cls.multi_attribute_criteria(
+            {key: value for key, value in args.items() if key not in ("available", "at")}
+        )
+        starts, ends = db.session.query(
+            func.min(case([(cls.from_date > now, cls.from_date)])),
+            func.min(case([(cls.to_date >= now, cls.to_date)])),
+        ).filter(*criteria).filter((cls.from_date > now) | (cls.to_date >= now)).one()
+        if ends is not None:
+            # a Promotion is still available at its end date
+            ends += timedelta(microseconds=1)
+        changes = [change for change in (starts, ends) if change is not None]
+        return min(changes) if changes else None
+
+    @classmethod
+    def find_by_multi_attributes(cls, args) -> list:
+        return cls.query.filter(*cls.multi_attribute_criteria(args))
+
+    @classmethod
+    def version_of_multi_attributes(cls, args) -> tuple:
+        """Returns an aggregate of the ids and versions of the Promotions matching the attributes
+
+        Any create, update or delete among them changes the aggregate, as
+        new ids are always greater than the ones before and every update
+        bumps a version, so it can stand for the version of the whole list
+
+        :param args: the attributes, as taken by find_by_multi_attributes
+        :return: the count, sum of the ids and sum of the versions
+        :rtype: tuple
+        """
+        count, ids, versions = db.session.query(
+            func.count(cls.id), func.sum(cls.id), func.sum(cls.version)
+        ).filter(*cls.multi_attribute_criteria(args)).one()
+        return count, ids or 0, versions or 0
+
+    @classmethod
+    def select_fields(cls, fields=None):
+        """Returns a Core SELECT of some of the columns of Promotions
+
+        The statement is run with fetch_records() to read the Promotions
+        as read-only records, without building ORM instances
+
+        Args:
+            fields (list): the columns to select, all of them when None
+        """
+        columns = cls.__table__.columns
+        if fields is None:
+            return db.select(list(columns))
+        unknown = set(fields).difference(columns.keys())
+        if unknown:
+            raise DataValidationError("Invalid fields: " + ", ".join(sorted(unknown)))
+        return db.select([column for column in columns if column.key in fields])
+
+    @classmethod
+    def select_by_multi_attributes(cls, args, fields=None):
+        """Returns a Core SELECT of the Promotions matching the attributes
+
+        :param args: the attributes, as taken by find_by_multi_attributes
+        :param fields: the columns to select, all of them when None
+        """
+        statement = cls.select_fields(fields)
+        for criterion in cls.multi_attribute_criteria(args):
+            statement = statement.where(criterion)
+        return statement
+
+    @classmethod
+    def find_record(cls, by_id, fields=None):
+        """ Finds a Promotion by it's ID and returns it as a read-only record """
+        logger.info("Processing record lookup for id %s ...", by_id)
+        try:
+            by_id = int(by_id)
+        except (TypeError, ValueError):
+            return None
+        records = cls.fetch_records(cls.select_fields(fields).where(cls.id == by_id))
+        return records[0] if records else None
+
+    @classmethod
+    def fetch_records(cls, statement) -> list:
+        """ Runs a SELECT of Promotions and returns them as read-only records """
+        result = db.session.execute(statement)
+        make = record_type(tuple(result.keys()))._make
+        return [make(row) for row in result]
+
+    @classmethod
+    def stream_records(cls, statement, batch_size:int):
+        """Runs a SELECT of Promotions and yields them as read-only records
+
+        Rows are fetched batch_size at a time through a server-side cursor
+        where the database supports one, so memory use stays flat
+        """
+        result = db.session.execute(statement.execution_options(stream_results=True))
+        try:
+            make = record_type(tuple(result.keys()))._make
+            rows = result.fetchmany(batch_size)
+            while rows:
+                for row in rows:
+                    yield make(row)
+                rows = result.fetchmany(batch_size)
+        finally:
+            result.close()
+
+
+class PromotionRecord(namedtuple("PromotionRecord", [column.key for column in Promotion.__table__.columns])):
+    """
+    A read-only Promotion read straight from a row, for listing Promotions
+    """
+    __slots__ = ()
+
+    # the same representation as a Promotion
+    serialize = Promotion.serialize
+    is_available = Promotion.is_available
+    score = Promotion.score
+    etag = Promotion.etag
+
+
+@lru_cache(maxsize=None)
+def record_type(fields:tuple):
+    """Returns the record class for rows with some of the columns of Promotions
+
+    Records with only some of the columns can only be serialized with the
+    fields they hold, and only tagged when they hold the id and version
+    """
+    if fields == PromotionRecord._fields:
+        return PromotionRecord
+    return type(
+        "PromotionRecord",
+        (namedtuple("PromotionRecord", fields),),
+        {"__slots__": (), "serialize": Promotion.serialize, "etag": Promotion.etag},
+    )
+
+
+class PromotionValues:
+    """
+    The values of a new Promotion, deserialized and validated by the rules
+    of the model without building an instance of it, for loading many
+    """
+    __slots__ = LOAD_COLUMNS
+
+    deserialize = Promotion.deserialize
+    validate = Promotion.validate
+
+    def row(self) -> tuple:
+        """ Returns the values as a row for Promotion.load_rows() """
+        return _get_row(self)
+
+
+_get_row = operator.attrgetter(*LOAD_COLUMNS)
+
+
+# Characters escaped in the text format of COPY
+_COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+
+def _copy_line(row) -> str:
+    """ Writes a row of LOAD_COLUMNS as a line in the text format of COPY """
+    product_name, category, product_id, amount, description, from_date, to_date = row
+    return "%s\t%s\t%d\t%d\t%s\t%s\t%s\n" % (
+        product_name.translate(_COPY_ESCAPES),
+        category.name,
+        product_id,
+        amount,
+        "\\N" if description is None else description.translate(_COPY_ESCAPES),
+        from_date.isoformat(),
+        to_date.isoformat(),
+    )
+
+
+# The in-memory index of promotions used to answer best promotion lookups
+Promotion.index = PromotionIndex(Promotion.find_ranked_by_product_ids)
+Promotion.listeners.append(Promotion.index)
+
+# The active and upcoming promotions, used to answer reads of the ones available now
+Promotion.scheduler = PromotionScheduler(Promotion.find_scheduled_records)
+Promotion.listeners.append(Promotion.scheduler)
+
+
+@event.listens_for(Promotion.__table__, "after_create")
+@event.listens_for(Promotion.__table__, "after_drop")
+def _reset_listeners(*args, **kwargs):
+    """ Tells the listeners every Promotion changed when the table is created or dropped """
+    Promotion.notify_changed_in_bulk()
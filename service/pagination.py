@@ -0,0 +1,138 @@
+"""
+Keyset Pagination
+
+Helpers to page through Promotions with an opaque cursor. A page is ordered
+by a sort key with the id breaking ties, and the cursor remembers the sort
+key and id of the last Promotion returned. The next page is then selected
+with a range condition on (sort key, id) instead of an OFFSET, so every page
+costs the same no matter how deep into the table it is.
+"""
+import base64
+import binascii
+import json
+from datetime import datetime
+from sqlalchemy import literal, tuple_
+from service.models import Promotion, DataValidationError
+
+# The columns a page can be ordered by
+SORT_KEYS = ("id", "product_id", "from_date", "to_date")
+
+# The most Promotions that can be returned on one page
+MAX_PAGE_SIZE = 1000
+
+_DATE_KEYS = ("from_date", "to_date")
+
+
+def encode_cursor(sort:str, promotion) -> str:
+    """ Returns the cursor that points just after a Promotion """
+    value = getattr(promotion, sort)
+    if sort in _DATE_KEYS:
+        value = value.isoformat()
+    data = json.dumps([sort, value, promotion.id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(data.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor:str, sort:str) -> tuple:
+    """Returns the (sort value, id) a cursor points after
+
+    Raises:
+        DataValidationError: if the cursor is malformed or was made for another sort
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        key, value, promotion_id = json.loads(base64.urlsafe_b64decode(padded))
+        if sort in _DATE_KEYS:
+            value = datetime.fromisoformat(value)
+        elif not isinstance(value, int):
+            raise ValueError(value)
+        if not isinstance(promotion_id, int):
+            raise ValueError(promotion_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError, TypeError):
+        raise DataValidationError("Invalid cursor: " + cursor)
+    if key != sort:
+        raise DataValidationError("Invalid cursor: it was made for sort=" + str(key))
+    return value, promotion_id
+
+
+def validate_page(sort:str, limit:int):
+    """ Checks the sort key and page size of a request """
+    if sort not in SORT_KEYS:
+        raise DataValidationError(
+            "Invalid sort: must be one of " + ", ".join(SORT_KEYS)
+        )
+    if limit is not None and not 0 < limit <= MAX_PAGE_SIZE:
+        raise DataValidationError(
+            "Invalid limit: must be between 1 and {}".format(MAX_PAGE_SIZE)
+        )
+
+
+def order_by(sort:str) -> tuple:
+    """ Returns the ORDER BY clauses of a page """
+    column = getattr(Promotion, sort)
+    if sort == "id":
+        return (column,)
+    return (column, Promotion.id)
+
+
+def after(sort:str, position:tuple):
+    """ Returns the condition that selects the rows after a (sort value, id) """
+    value, promotion_id = position
+    if sort == "id":
+        return Promotion.id > promotion_id
+    column = getattr(Promotion, sort)
+    return tuple_(column, Promotion.id) > tuple_(
+        literal(value, column.type), literal(promotion_id, Promotion.id.type)
+    )
+
+
+def paginate(statement, sort:str="id", cursor:str=None, limit:int=None):
+    """Returns one page of a SELECT of Promotions
+
+    Args:
+        statement: the Promotions to page through, from select_by_multi_attributes
+        sort (str): the column the pages are ordered by
+        cursor (str): the cursor returned with the previous page, None for the first
+        limit (int): the most Promotions to return, None for all of them
+
+    :return: the PromotionRecords on the page and the cursor of the next
+        page, which is None on the last page
+    :rtype: tuple
+    """
+    validate_page(sort, limit)
+    if cursor:
+        statement = statement.where(after(sort, decode_cursor(cursor, sort)))
+    statement = statement.order_by(*order_by(sort))
+    if limit is None:
+        return Promotion.fetch_records(statement), None
+    return _page(Promotion.fetch_records(statement.limit(limit + 1)), sort, limit)
+
+
+def paginate_records(records, sort:str="id", cursor:str=None, limit:int=None):
+    """Returns one page of a list of PromotionRecords held in memory
+
+    The records are ordered and cut like paginate() does in the database,
+    and the cursors of both can be used with either
+
+    :return: the PromotionRecords on the page and the cursor of the next page
+    :rtype: tuple
+    """
+    validate_page(sort, limit)
+
+    def key(record):
+        return (getattr(record, sort), record.id)
+
+    records = sorted(records, key=key)
+    if cursor:
+        position = decode_cursor(cursor, sort)
+        records = [record for record in records if key(record) > position]
+    if limit is None:
+        return records, None
+    return _page(records[:limit + 1], sort, limit)
+
+
+def _page(promotions, sort, limit):
+    """ Cuts the limit + 1 Promotions read down to a page and the cursor of the next one """
+    if len(promotions) <= limit:
+        return promotions, None
+    promotions = promotions[:limit]
+    return promotions, encode_cursor(sort, promotions[-1])
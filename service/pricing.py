@@ -0,0 +1,120 @@
+"""
+Cart Pricing
+
+Prices the lines of a cart with the Promotions available for their
+products. A Discount takes ``amount`` percent off a line, and a BOGOF
+("buy ``amount`` get one free") makes one item free out of every
+``amount + 1``. Each line gets the one Promotion that saves the most on
+it, ties going to the lowest id, and no Promotion when none saves anything.
+
+The Promotions of every line are looked up together, and all money is
+computed with Decimal and rounded to the cent.
+"""
+import logging
+from collections import namedtuple
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from service.models import Promotion, TypeOfPromo, DataValidationError
+
+logger = logging.getLogger("flask.app")
+
+# The most lines a cart can have
+MAX_CART_LINES = 1000
+
+CENT = Decimal("0.01")
+ZERO = Decimal("0.00")
+
+Line = namedtuple("Line", ["product_id", "quantity", "unit_price"])
+
+
+def parse_lines(data) -> list:
+    """Returns the Lines of a cart posted as {"lines": [{product_id, quantity, unit_price}]}
+
+    Unit prices can be given as numbers or as strings, which keep them exact
+
+    Raises:
+        DataValidationError: if the cart or any of its lines is not valid
+    """
+    try:
+        items = data["lines"]
+    except (KeyError, TypeError):
+        raise DataValidationError("Invalid cart: lines must be a list of lines")
+    if not isinstance(items, list) or not items:
+        raise DataValidationError("Invalid cart: lines must be a non empty list of lines")
+    if len(items) > MAX_CART_LINES:
+        raise DataValidationError(
+            "Invalid cart: at most {} lines can be priced at once".format(MAX_CART_LINES)
+        )
+    lines = []
+    for position, item in enumerate(items):
+        try:
+            product_id = item["product_id"]
+            quantity = item["quantity"]
+            unit_price = Decimal(str(item["unit_price"]))
+        except (KeyError, TypeError, InvalidOperation):
+            raise DataValidationError(
+                "Invalid line {}: product_id, quantity and unit_price are required".format(position)
+            )
+        if not isinstance(product_id, int) or not isinstance(quantity, int) or quantity <= 0:
+            raise DataValidationError(
+                "Invalid line {}: product_id and quantity must be integers, quantity above 0".format(position)
+            )
+        if not unit_price.is_finite() or unit_price < 0:
+            raise DataValidationError("Invalid line {}: unit_price must not be negative".format(position))
+        lines.append(Line(product_id, quantity, unit_price))
+    return lines
+
+
+def saving(promotion, line:Line) -> Decimal:
+    """ Returns how much a Promotion takes off a line, rounded to the cent """
+    if promotion.category == TypeOfPromo.Discount:
+        total = line.unit_price * line.quantity
+        return (total * promotion.amount / 100).quantize(CENT, rounding=ROUND_HALF_UP)
+    if promotion.category == TypeOfPromo.BOGOF:
+        free = line.quantity // (promotion.amount + 1)
+        return (line.unit_price * free).quantize(CENT, rounding=ROUND_HALF_UP)
+    return ZERO
+
+
+def best_saving(promotions, line:Line) -> tuple:
+    """ Returns the Promotion that saves the most on a line and its saving, None when none saves """
+    best, best_saving_ = None, ZERO
+    for promotion in sorted(promotions, key=lambda promotion: promotion.id):
+        amount = saving(promotion, line)
+        if amount > best_saving_:
+            best, best_saving_ = promotion, amount
+    return best, best_saving_
+
+
+def price_cart(lines, at=None) -> dict:
+    """Prices the lines of a cart with the Promotions available at a time, now when None
+
+    :return: the subtotal, discount, price and Promotion of every line, and
+        the totals of the cart, with money written as strings
+    :rtype: dict
+    """
+    promotions = Promotion.find_available_by_product_ids(
+        list(dict.fromkeys(line.product_id for line in lines)), at
+    )
+    results = []
+    subtotal = discount = ZERO
+    for line in lines:
+        line_subtotal = (line.unit_price * line.quantity).quantize(CENT, rounding=ROUND_HALF_UP)
+        promotion, line_discount = best_saving(promotions[line.product_id], line)
+        subtotal += line_subtotal
+        discount += line_discount
+        results.append({
+            "product_id": line.product_id,
+            "quantity": line.quantity,
+            "unit_price": str(line.unit_price),
+            "subtotal": str(line_subtotal),
+            "discount": str(line_discount),
+            "price": str(line_subtotal - line_discount),
+            "promotion_id": None if promotion is None else promotion.id,
+        })
+    logger.info("Priced %d lines, %s off", len(lines), discount)
+    return {
+        "lines": results,
+        "subtotal": str(subtotal),
+        "discount": str(discount),
+        "total": str(subtotal - discount),
+    }
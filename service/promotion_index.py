@@ -0,0 +1,222 @@
+"""
+Promotion Index
+
+An in-process index of Promotions keyed by product id. Each product keeps its
+promotions as date intervals with a precomputed score, so the best active
+promotion at any point in time can be answered without touching the database.
+
+Products are loaded lazily on first lookup and kept current by the model,
+which tells the index about every promotion that is created, updated or
+deleted. Because the index lives in
+a single process, every product is reloaded once it is older than ``ttl``
+seconds so that writes made by other workers are eventually picked up.
+"""
+import logging
+import threading
+import time
+from collections import namedtuple
+
+logger = logging.getLogger("flask.app")
+
+# A single promotion stored as a date interval with its score and the
+# serialized representation that is handed back to callers
+Interval = namedtuple("Interval", ["from_date", "to_date", "score", "id", "data"])
+
+
+class PromotionIndex:
+    """
+    Class that represents the in-memory interval index of Promotions
+    """
+
+    def __init__(self, loader, ttl=None):
+        """
+        Args:
+            loader (callable): returns the Promotions for a list of product ids, best first
+            ttl (int): seconds before a product is reloaded, None to never reload
+        """
+        self._loader = loader
+        self.ttl = ttl
+        self._intervals = {}  # product_id -> [Interval] ordered best first
+        self._loaded_at = {}  # product_id -> time the product was loaded
+        self._owners = {}  # promotion id -> product_id
+        self._pending = []  # a list of the changes told during each load that runs
+        self._generation = 0  # bumped when products are invalidated
+        self._lock = threading.RLock()
+
+    def best(self, product_id:int, at):
+        """ Returns the serialized best Promotion for a product active at a time """
+        return self.best_many([product_id], at)[product_id]
+
+    def best_many(self, product_ids, at) -> dict:
+        """Returns the serialized best Promotion for many products
+
+        Args:
+            product_ids (list): the product ids to look up
+            at (datetime): the point in time the promotions must be active
+
+        :return: a map of product id to serialized Promotion, or None on a miss
+        :rtype: dict
+        """
+        intervals = self._lookup(product_ids)
+        return {
+            product_id: next(
+                (
+                    interval.data
+                    for interval in intervals[product_id]
+                    if interval.from_date <= at <= interval.to_date
+                ),
+                None,
+            )
+            for product_id in product_ids
+        }
+
+    def add(self, promotion):
+        """ Adds or replaces a Promotion in the index """
+        with self._lock:
+            self._discard(promotion.id)
+            product_id = promotion.product_id
+            # promotions for products that were never looked up are loaded
+            # together with the rest of the product on its first lookup
+            if product_id not in self._loaded_at:
+                return
+            interval = _to_interval(promotion)
+            if interval is None:
+                return
+            intervals = self._intervals[product_id] + [interval]
+            intervals.sort(key=_rank)
+            self._intervals[product_id] = intervals
+            self._owners[promotion.id] = product_id
+
+    def discard(self, promotion_id:int):
+        """ Removes a Promotion from the index if it is present """
+        with self._lock:
+            self._discard(promotion_id)
+
+    def changed(self, changes):
+        """ Applies the (before, after) records of changed Promotions """
+        with self._lock:
+            for pending in self._pending:
+                pending.extend(changes)  # applied again once loaded
+            self._apply(changes)
+
+    def changed_in_bulk(self, product_ids=None):
+        """ Reloads the products changed by a bulk action, or all of them """
+        self.invalidate(product_ids)
+
+    def invalidate(self, product_ids=None):
+        """ Forgets products so they are reloaded on their next lookup """
+        with self._lock:
+            self._generation += 1
+            if product_ids is None:
+                self.clear()
+                return
+            for product_id in product_ids:
+                self._forget(product_id)
+
+    def clear(self):
+        """ Removes every product from the index """
+        with self._lock:
+            self._generation += 1
+            self._intervals.clear()
+            self._loaded_at.clear()
+            self._owners.clear()
+
+    ######################################################################
+    #  P R I V A T E   M E T H O D S
+    ######################################################################
+
+    def _lookup(self, product_ids) -> dict:
+        """Returns the intervals of each product, loading the missing ones
+
+        The loader runs without holding the lock, so lookups and changes go on
+        meanwhile, and its products are merged in once it is done. The changes
+        told while it ran are applied again after them, as it may have read
+        the Promotions before them, and products invalidated meanwhile are
+        loaded again
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                missing = [
+                    product_id
+                    for product_id in set(product_ids)
+                    if product_id not in self._loaded_at
+                    or (self.ttl is not None and now - self._loaded_at[product_id] > self.ttl)
+                ]
+                if not missing:
+                    return {product_id: self._intervals[product_id] for product_id in product_ids}
+                generation, changes = self._generation, []
+                self._pending.append(changes)
+            try:
+                loaded = self._load(missing)
+            except Exception:
+                with self._lock:
+                    self._pending.remove(changes)
+                raise
+            with self._lock:
+                self._pending.remove(changes)
+                if self._generation == generation:
+                    self._merge(loaded, now)
+                    self._apply(changes)
+
+    def _load(self, product_ids) -> dict:
+        """ Returns the intervals of products from the loader, best first """
+        logger.info("Loading %d products into the promotion index", len(product_ids))
+        loaded = {product_id: [] for product_id in product_ids}
+        # the loader ranks them, so each product is appended to best first
+        for promotion in self._loader(product_ids):
+            interval = _to_interval(promotion)
+            if interval is not None:
+                loaded[promotion.product_id].append(interval)
+        return loaded
+
+    def _merge(self, loaded, now):
+        """ Replaces the intervals of products with the loaded ones """
+        for product_id, intervals in loaded.items():
+            self._forget(product_id)
+            self._intervals[product_id] = intervals
+            self._loaded_at[product_id] = now
+            for interval in intervals:
+                self._owners[interval.id] = product_id
+
+    def _apply(self, changes):
+        for before, after in changes:
+            if after is None:
+                self._discard(before.id)
+            else:
+                self.add(after)
+
+    def _discard(self, promotion_id):
+        product_id = self._owners.pop(promotion_id, None)
+        if product_id is None:
+            return
+        self._intervals[product_id] = [
+            interval
+            for interval in self._intervals[product_id]
+            if interval.id != promotion_id
+        ]
+
+    def _forget(self, product_id):
+        for interval in self._intervals.pop(product_id, []):
+            self._owners.pop(interval.id, None)
+        self._loaded_at.pop(product_id, None)
+
+
+def _to_interval(promotion):
+    """ Converts a Promotion to an Interval, None if it can never be the best """
+    score = promotion.score()
+    if score <= 0:
+        return None
+    return Interval(
+        promotion.from_date, promotion.to_date, score, promotion.id, promotion.serialize()
+    )
+
+
+def rank(score:float, promotion_id:int) -> tuple:
+    """ Orders promotions by best score first, lowest id breaking ties """
+    return (-score, promotion_id)
+
+
+def _rank(interval):
+    """ Ranks an interval, see rank() """
+    return rank(interval.score, interval.id)
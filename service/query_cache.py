@@ -0,0 +1,118 @@
+"""
+Query Cache
+
+A bounded LRU cache of query results keyed by the normalized query string
+arguments. Entries are kept for at most ``ttl`` seconds, and until any
+deadline given when they were stored, such as the next time the
+availability of the promotions they hold changes.
+
+The cache listens to the model: an entry is evicted as soon as a Promotion
+it could hold, before or after the change, is created, updated or deleted.
+Bulk actions do not say which Promotions they changed, so they empty it.
+
+Every change also moves the cache to a new generation. A caller notes the
+generation before it reads the database and hands it to put(), which drops
+the result when a change came in between, as the eviction it would have
+needed has already happened.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from datetime import datetime
+
+logger = logging.getLogger("flask.app")
+
+Entry = namedtuple("Entry", ["args", "value", "expires", "stale_at"])
+
+
+class QueryCache:
+    """
+    Class that represents a cache of query results
+    """
+
+    def __init__(self, matches, maxsize:int=256, ttl:float=None):
+        """
+        Args:
+            matches (callable): tells if a Promotion could be in the result for the args
+            maxsize (int): the most entries kept, 0 turns the cache off
+            ttl (float): the most seconds an entry is kept, None to keep it until evicted
+        """
+        self._matches = matches
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.generation = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def key(args) -> tuple:
+        """ Returns the cache key of query arguments, ignoring the unset ones """
+        return tuple(sorted((name, value) for name, value in args.items() if value is not None))
+
+    def get(self, key):
+        """ Returns the value cached for a key, None on a miss """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (
+                (entry.expires is not None and time.monotonic() >= entry.expires)
+                or (entry.stale_at is not None and datetime.now() >= entry.stale_at)
+            ):
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry.value
+
+    def put(self, key, args, value, generation:int, stale_at:datetime=None):
+        """Caches the value of a query
+
+        Args:
+            key (tuple): the key made by key()
+            args (dict): the query arguments, used to tell which changes affect it
+            value: the result to cache
+            generation (int): the generation of the cache before the value was read
+            stale_at (datetime): when the result stops being correct, None if it never does
+        """
+        if self.maxsize <= 0:
+            return
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            if generation != self.generation:
+                return  # the value may have been read before a change
+            self._entries[key] = Entry(args, value, expires, stale_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def changed(self, changes):
+        """ Evicts the entries that could hold any of the changed Promotions """
+        with self._lock:
+            self.generation += 1
+            stale = [
+                key
+                for key, entry in self._entries.items()
+                if any(
+                    promotion is not None and self._matches(entry.args, promotion)
+                    for change in changes
+                    for promotion in change
+                )
+            ]
+            for key in stale:
+                del self._entries[key]
+        if stale:
+            logger.debug("Evicted %d cached queries", len(stale))
+
+    def changed_in_bulk(self, product_ids=None):
+        """ Empties the cache as any entry could hold the changed Promotions """
+        self.clear()
+
+    def clear(self):
+        """ Removes every entry """
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
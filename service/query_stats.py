@@ -0,0 +1,179 @@
+"""
+Query Statistics
+
+Times every SQL statement through the engine events of SQLAlchemy and adds
+them up for the request that ran them. Each response gets a Server-Timing
+header with the number of statements, the time spent in the database and
+the slowest statement, which browser dev tools show with the request:
+
+    Server-Timing: db;dur=3.42;desc="4 queries", db-slowest;dur=1.90
+
+The statements are also recorded as metrics, see service.metrics:
+
+    promotions_db_query_duration_seconds{operation}
+    promotions_db_queries_per_request{resource}
+    promotions_db_query_heavy_requests_total{resource}
+
+Statements slower than SLOW_QUERY_MS are logged with their parameters
+redacted to their types, and requests that run more than QUERY_COUNT_LIMIT
+statements, which usually means a query made in a loop, are logged with
+the statements they ran.
+"""
+import logging
+import time
+from flask import _request_ctx_stack
+from prometheus_client import Counter, Histogram
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from service import app
+from service.metrics import NAMESPACE, BUCKETS, resource_of
+
+logger = logging.getLogger("flask.app")
+
+# The characters of a statement written in logs and headers at most
+STATEMENT_LENGTH = 500
+
+QUERY_DURATION = Histogram(
+    "db_query_duration_seconds", "Seconds spent running SQL statements", ["operation"],
+    namespace=NAMESPACE, buckets=BUCKETS,
+)
+QUERIES_PER_REQUEST = Histogram(
+    "db_queries_per_request", "SQL statements run by each request", ["resource"],
+    namespace=NAMESPACE, buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100),
+)
+HEAVY_REQUESTS = Counter(
+    "db_query_heavy_requests_total", "Requests that ran more than QUERY_COUNT_LIMIT statements",
+    ["resource"], namespace=NAMESPACE,
+)
+
+_durations = {}  # operation -> QUERY_DURATION child
+
+
+class QueryStats:
+    """
+    Class that adds up the SQL statements run by a request
+    """
+
+    __slots__ = ("count", "total", "slowest", "slowest_statement", "statements")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.slowest = 0.0
+        self.slowest_statement = None
+        self.statements = []  # the first QUERY_COUNT_LIMIT + 1 statements, to tell a heavy request
+
+    def add(self, statement:str, elapsed:float, limit:int):
+        """ Counts a statement that took elapsed seconds """
+        self.count += 1
+        self.total += elapsed
+        if elapsed > self.slowest:
+            self.slowest = elapsed
+            self.slowest_statement = statement
+        if len(self.statements) <= limit:
+            self.statements.append(statement)
+
+    def server_timing(self) -> str:
+        """ Returns the statistics as the value of a Server-Timing header, in milliseconds """
+        return 'db;dur={:.2f};desc="{} queries", db-slowest;dur={:.2f}'.format(
+            self.total * 1e3, self.count, self.slowest * 1e3
+        )
+
+
+def current_stats():
+    """ Returns the statistics of the request being handled, None outside of a request """
+    context = _request_ctx_stack.top
+    return None if context is None else getattr(context, "query_stats", None)
+
+
+def operation_of(statement:str) -> str:
+    """ Returns the kind of a statement, such as SELECT or INSERT """
+    operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ""
+    return operation if operation in ("SELECT", "INSERT", "UPDATE", "DELETE") else "OTHER"
+
+
+def redact(parameters, executemany:bool=False) -> str:
+    """ Returns the parameters of a statement with their values replaced by their types """
+    if executemany:
+        return "<{} rows>".format(len(parameters))
+    if isinstance(parameters, dict):
+        return "{" + ", ".join(
+            "{}: <{}>".format(name, type(value).__name__) for name, value in parameters.items()
+        ) + "}"
+    if isinstance(parameters, (list, tuple)):
+        return "(" + ", ".join("<{}>".format(type(value).__name__) for value in parameters) + ")"
+    return "<{}>".format(type(parameters).__name__)
+
+
+def shorten(statement:str) -> str:
+    """ Returns a statement on one line, cut to STATEMENT_LENGTH """
+    statement = " ".join(statement.split())
+    if len(statement) > STATEMENT_LENGTH:
+        statement = statement[:STATEMENT_LENGTH] + "..."
+    return statement
+
+
+######################################################################
+#  E N G I N E   E V E N T S
+######################################################################
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    operation = operation_of(statement)
+    duration = _durations.get(operation)
+    if duration is None:
+        duration = _durations[operation] = QUERY_DURATION.labels(operation)
+    duration.observe(elapsed)
+    stats = current_stats()
+    if stats is not None:
+        stats.add(statement, elapsed, app.config["QUERY_COUNT_LIMIT"])
+    if elapsed * 1e3 >= app.config["SLOW_QUERY_MS"]:
+        logger.warning(
+            "Slow query took %.1f ms: %s parameters %s",
+            elapsed * 1e3, shorten(statement), redact(parameters, executemany),
+        )
+
+
+@event.listens_for(Engine, "handle_error")
+def _execute_failed(exception_context):
+    """ Forgets the start of a statement that failed, after_cursor_execute is not called """
+    connection = exception_context.connection
+    if connection is not None and exception_context.cursor is not None:
+        starts = connection.info.get("query_start")
+        if starts:
+            starts.pop()
+
+
+######################################################################
+#  R E Q U E S T   H O O K S
+######################################################################
+@app.before_request
+def start_query_stats():
+    """ Starts adding up the statements of the request """
+    _request_ctx_stack.top.query_stats = QueryStats()
+
+
+@app.after_request
+def report_query_stats(response):
+    """ Adds the Server-Timing header and records the statements of the request """
+    context = _request_ctx_stack.top
+    stats = getattr(context, "query_stats", None)
+    if stats is None:
+        return response
+    response.headers.add("Server-Timing", stats.server_timing())
+    resource = resource_of(context.request.endpoint)
+    QUERIES_PER_REQUEST.labels(resource).observe(stats.count)
+    limit = app.config["QUERY_COUNT_LIMIT"]
+    if stats.count > limit:
+        HEAVY_REQUESTS.labels(resource).inc()
+        logger.warning(
+            "%s %s ran %d queries, more than %d: %s",
+            context.request.method, context.request.path, stats.count, limit,
+            "; ".join(shorten(statement) for statement in stats.statements),
+        )
+    return response
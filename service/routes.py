@@ -3,20 +3,32 @@ Promotin Store Service
 
 Paths:
 ------
-GET /promotions - Returns a list all of the Promotions
+GET /promotions - Returns a list all of the Promotions, a page at a time with limit and cursor
 GET /promotions/{id} - Returns the Promotion with a given id number
 POST /promotions - creates a new Promotions record in the database
 PUT /promotions/{id} - updates a Promotions record in the database
 DELETE /promotions/{id} - deletes a Promotions record in the database
+POST /promotions/best - returns the best Promotion for many products
+POST /promotions/price - prices the lines of a cart with the best Promotion for each
+POST /promotions/bulk - creates many Promotions records in one transaction
+PUT /promotions/expire - expires every Promotion matching the filters
+DELETE /promotions - deletes every Promotion matching the filters
+GET /metrics - returns the metrics of the service for Prometheus
+
+GETs return an ETag and honor If-None-Match with a 304, PUT honors If-Match
+with a 412 when the Promotion was changed since the ETag was read
 """
 
 import os
 import sys
-import logging
-from flask import Flask, jsonify, request, url_for, make_response, abort
+import json
+import hashlib
+import operator
+from flask import Flask, Response, jsonify, request, url_for, make_response, abort, stream_with_context
 from flask_restx import Api, Resource, fields, reqparse, inputs
 from . import status  # HTTP Status Codes
 from werkzeug.exceptions import NotFound
+from werkzeug.http import quote_etag
 from datetime import datetime, timedelta
 from functools import wraps
 import secrets
@@ -24,7 +36,9 @@ import secrets
 # For this example we'll use SQLAlchemy, a popular ORM that supports a
 # variety of backends including SQLite, MySQL, and PostgreSQL
 from flask_sqlalchemy import SQLAlchemy
-from service.models import Promotion, DataValidationError
+from service.models import Promotion, DataValidationError, VersionConflictError, DATE_ATTRIBUTES, parse_date
+from service import metrics, pagination, pricing, serializer
+from service.query_cache import QueryCache
 
 # Import Flask application
 from . import app
@@ -80,6 +94,62 @@ promotion_model = api.inherit(
     }
 )
 
+best_request_model = api.model('BestRequest', {
+    "product_ids": fields.List(fields.Integer, required=True,
+                               description='The ids of the products to find the best promotion for'),
+})
+
+cart_line_model = api.model('CartLine', {
+    "product_id": fields.Integer(required=True, description='The id of the product in the cart'),
+    "quantity": fields.Integer(required=True, description='How many of the product are in the cart'),
+    "unit_price": fields.String(required=True, description='The price of one item (e.g., "19.99")'),
+})
+
+cart_model = api.model('Cart', {
+    "lines": fields.List(fields.Nested(cart_line_model), required=True,
+                         description='The lines of the cart, at most {}'.format(pricing.MAX_CART_LINES)),
+})
+
+# The most products that can be looked up in one batch
+BEST_BATCH_LIMIT = 1000
+
+# The number of rows fetched at a time when streaming a list of Promotions
+STREAM_BATCH_SIZE = 500
+
+# The most Promotions that can be created by one bulk request
+BULK_CREATE_LIMIT = 50000
+
+NDJSON = 'application/x-ndjson'
+
+# Results of GET /promotions, evicted when the Promotions they hold change
+query_cache = QueryCache(
+    Promotion.matches_multi_attributes,
+    maxsize=app.config["PROMOTION_CACHE_SIZE"],
+    ttl=app.config["PROMOTION_CACHE_TTL"],
+)
+Promotion.listeners.append(query_cache)
+
+
+# The fields of a Promotion that can be asked for with fields=
+PROMOTION_FIELDS = serializer.FIELDS
+
+fields_args = reqparse.RequestParser()
+fields_args.add_argument('fields', type=str, location='args', required=False,
+                         help='Comma separated fields to return, e.g. id,product_id,amount,category')
+
+# query string arguments of the best promotion lookups
+best_args = fields_args.copy()
+best_args.add_argument('at', type=str, location='args', required=False,
+                       help='The time the promotion must be available at, now by default')
+
+# query string arguments of cart pricing
+price_args = reqparse.RequestParser()
+price_args.add_argument('at', type=str, location='args', required=False,
+                        help='The time the promotions must be available at, now by default')
+
+bulk_args = reqparse.RequestParser()
+bulk_args.add_argument('atomic', type=inputs.boolean, location='args', required=False, default=True,
+                       help='Create nothing when any Promotion is not valid (default), or create the valid ones')
 
 # query string arguments
 pro_args = reqparse.RequestParser()
@@ -89,6 +159,31 @@ pro_args.add_argument('category', type=str, location='args', required=False, hel
 pro_args.add_argument('from_date', type=str, location='args', required=False, help='List Promotions by start date')
 pro_args.add_argument('to_date', type=str, location='args', required=False, help='List Promotions by end date')
 pro_args.add_argument('available', type=int, location='args', required=False, help='List Promotions by availability, (e.g. 1=available, 0=not_available')
+pro_args.add_argument('from_date_after', type=str, location='args', required=False, help='List Promotions starting on or after a date')
+pro_args.add_argument('from_date_before', type=str, location='args', required=False, help='List Promotions starting on or before a date')
+pro_args.add_argument('to_date_after', type=str, location='args', required=False, help='List Promotions ending on or after a date')
+pro_args.add_argument('to_date_before', type=str, location='args', required=False, help='List Promotions ending on or before a date')
+pro_args.add_argument('active_from', type=str, location='args', required=False, help='List Promotions active at any point from a date, with active_to')
+pro_args.add_argument('active_to', type=str, location='args', required=False, help='List Promotions active at any point until a date, with active_from')
+pro_args.add_argument('at', type=str, location='args', required=False, help='The time availability is checked at, now by default')
+
+# query string arguments of the bulk actions, which take the same filters
+filter_args = pro_args.copy()
+filter_args.add_argument('dry_run', type=inputs.boolean, location='args', required=False, default=False,
+                         help='Only count the Promotions that would be changed')
+FILTER_KEYS = (
+    'product_name', 'product_id', 'category', 'from_date', 'to_date', 'available',
+    'from_date_after', 'from_date_before', 'to_date_after', 'to_date_before', 'active_from', 'active_to',
+)
+
+pro_args.add_argument('limit', type=int, location='args', required=False, help='The most Promotions to return on a page')
+pro_args.add_argument('cursor', type=str, location='args', required=False, help='The cursor of the page to return, taken from the previous page')
+pro_args.add_argument('sort', type=str, location='args', required=False, default='id',
+                      choices=pagination.SORT_KEYS, help='The key pages are ordered by')
+pro_args.add_argument('stream', type=inputs.boolean, location='args', required=False, default=False,
+                      help='Stream every Promotion as newline delimited JSON, same as Accept: application/x-ndjson')
+pro_args.add_argument('fields', type=str, location='args', required=False,
+                      help='Comma separated fields to return, e.g. id,product_id,amount,category')
 
 ######################################################################
 # Special Error Handlers
@@ -104,6 +199,17 @@ def request_validation_error(error):
         'message': message
     }, status.HTTP_400_BAD_REQUEST
 
+@api.errorhandler(VersionConflictError)
+def version_conflict_error(error):
+    """ Handles changes made to a Promotion that changed since it was read """
+    message = str(error)
+    app.logger.warning(message)
+    return {
+        'status_code': status.HTTP_412_PRECONDITION_FAILED,
+        'error': 'Precondition Failed',
+        'message': message
+    }, status.HTTP_412_PRECONDITION_FAILED
+
 ######################################################################
 #  PATH: /promotions/{id}
 ######################################################################
@@ -122,8 +228,10 @@ class PromotionResource(Resource):
     # RETRIEVE A PROMOTION
     #------------------------------------------------------------------
     @api.doc('get_promotions')
+    @api.expect(fields_args, validate=True)
     @api.response(404, 'Promotion not found')
-    @api.marshal_with(promotion_model)
+    @api.response(304, 'Promotion not modified since the ETag in If-None-Match')
+    @api.response(200, 'Success', promotion_model)
     def get(self, promotion_id):
         """
         Retrieve a single promotion
@@ -131,12 +239,20 @@ class PromotionResource(Resource):
         This endpoint will return a promotion based on it's id
         """
         app.logger.info("Request for promotion with id: %s", promotion_id)
-        promotion = Promotion.find(promotion_id)
+        fields = parse_fields(fields_args.parse_args()["fields"])
+        # the id and version are always read as the ETag is made from them
+        columns = None if fields is None else set(fields).union(("id", "version"))
+        promotion = Promotion.find_record(promotion_id, columns)
         if not promotion:
             abort(status.HTTP_404_NOT_FOUND, "Promotion with id '{}' was not found.".format(promotion_id))
 
-        app.logger.info("Returning promotion: %s", promotion.product_name)
-        return promotion.serialize(), status.HTTP_200_OK
+        etag = promotion.etag(fields)
+        if not_modified(etag):
+            app.logger.info("Promotion with id: %s not modified", promotion_id)
+            return not_modified_response(etag)
+        app.logger.info("Returning promotion with id: %s", promotion_id)
+        body = serializer.dumps(serializer.to_dict(promotion, fields))
+        return json_response(body, status.HTTP_200_OK, etag_header(etag))
 
     #------------------------------------------------------------------
     # UPDATE AN EXISTING PROMOTION
@@ -144,8 +260,9 @@ class PromotionResource(Resource):
     @api.doc('update_promotions')
     @api.response(404, 'Promotion not found')
     @api.response(400, 'The posted Promotion data was not valid')
+    @api.response(412, 'The Promotion changed since the ETag in If-Match')
+    @api.response(200, 'Success', promotion_model)
     @api.expect(create_model)
-    @api.marshal_with(promotion_model)
     def put(self, promotion_id):
         """
         Update a Promotion
@@ -156,12 +273,17 @@ class PromotionResource(Resource):
         promotion = Promotion.find(promotion_id)
         if not promotion:
             abort(status.HTTP_404_NOT_FOUND, "Promotion with id '{}' was not found.".format(promotion_id))
+        if request.if_match and not matches(promotion.etag()):
+            raise VersionConflictError(
+                "Promotion with id '{}' does not match If-Match".format(promotion_id)
+            )
         promotion.deserialize(api.payload)
         promotion.id = promotion_id
         promotion.update()
 
         app.logger.info("Promotion with ID [%s] updated.", promotion.id)
-        return promotion.serialize(), status.HTTP_200_OK
+        body = serializer.dumps(serializer.to_dict(promotion))
+        return json_response(body, status.HTTP_200_OK, etag_header(promotion.etag()))
 
     #------------------------------------------------------------------
     # DELETE A PROMOTION
@@ -193,29 +315,99 @@ class PromotionCollection(Resource):
     #------------------------------------------------------------------
     @api.doc('list_promotions')
     @api.expect(pro_args, validate=True)
-    @api.marshal_list_with(promotion_model)
+    @api.response(304, 'No Promotion in the list changed since the ETag in If-None-Match')
+    @api.response(200, 'Success', [promotion_model])
     def get(self):
         """Returns all of the promotions"""
         app.logger.info("Request for promotion list")
         promotions = []
-        args = pro_args.parse_args()
-        app.logger.info(args)
-        app.logger.info('Filtering list')
-        promotions = Promotion.find_by_multi_attributes(args)
+        args = parse_date_args(pro_args.parse_args())
+        if args["category"]:
+            args["category"] = args["category"].split('.')[-1]
+        app.logger.info("Filtering list with %s", args)
+        fields = parse_fields(args["fields"])
+        # the id and sort key are always read as the cursor is made from them
+        columns = None if fields is None else set(fields).union(("id", args["sort"]))
+        # every query of the request checks availability with the same clock
+        now = args["at"] or datetime.now()
+        promotions = Promotion.select_by_multi_attributes(dict(args, at=now), columns)
+        if args["stream"] or request.accept_mimetypes.best_match(['application/json', NDJSON]) == NDJSON:
+            return stream_promotions(promotions, args["sort"], fields)
+
+        key = QueryCache.key(args)
+        cached = query_cache.get(key)
+        metrics.count_cache_lookup(cached is not None)
+        if cached is not None:
+            body, headers, etag = cached
+            if not_modified(etag):
+                app.logger.info("Promotion list not modified")
+                return not_modified_response(etag)
+            app.logger.info("Returning cached promotions")
+            return json_response(body, status.HTTP_200_OK, headers)
+        # a change made while the page is read keeps it out of the cache
+        generation = query_cache.generation
+        # the promotions available now are read from the active set in memory
+        hot = args["available"] is not None and args["available"] > 0 and args["at"] is None
+        # results that depend on availability change when it next changes,
+        # unless it was checked at a fixed time
+        changes_at = None
+        if hot:
+            records = Promotion.find_available_records(args)
+            etag = collection_etag(args, now, records=records)
+        else:
+            if args["available"] is not None and args["at"] is None:
+                changes_at = Promotion.next_availability_change(args, now)
+            # tagged before the page is read so a change in between is never missed
+            etag = collection_etag(args, now, changes_at)
+        if not_modified(etag):
+            app.logger.info("Promotion list not modified")
+            return not_modified_response(etag)
+        if hot:
+            promotions, next_cursor = pagination.paginate_records(
+                records, args["sort"], args["cursor"], args["limit"]
+            )
+        else:
+            promotions, next_cursor = pagination.paginate(
+                promotions, args["sort"], args["cursor"], args["limit"]
+            )
+
+        body = serializer.to_json(promotions, fields)
+        app.logger.info("Returning %d promotions", len(promotions))
+
+        headers = etag_header(etag)
+        if next_cursor:
+            params = request.args.to_dict()
+            params["cursor"] = next_cursor
+            next_url = api.url_for(PromotionCollection, _external=True, **params)
+            headers.update({'Link': '<{}>; rel="next"'.format(next_url), 'X-Next-Cursor': next_cursor})
+        stale_at = Promotion.scheduler.next_transition() if hot else changes_at
+        query_cache.put(key, dict(args), (body, headers, etag), generation, stale_at)
+        return json_response(body, status.HTTP_200_OK, headers)
 
-        results = [promotion.serialize() for promotion in promotions]
-        app.logger.info("Returning %d promotions", len(results))
-        app.logger.info((results))
-
-        return results, status.HTTP_200_OK
+    #------------------------------------------------------------------
+    # DELETE PROMOTIONS BY FILTER
+    #------------------------------------------------------------------
+    @api.doc('delete_promotions_by_filter')
+    @api.expect(filter_args, validate=True)
+    @api.response(400, 'No filter was given')
+    def delete(self):
+        """
+        Delete every Promotion matching the filters
+        This endpoint deletes them with one statement and returns how many were deleted
+        """
+        args = parse_filter_args()
+        app.logger.info("Request to delete promotions matching %s", args)
+        count = Promotion.delete_by_multi_attributes(args, args["dry_run"])
+        app.logger.info("Deleted %d promotions, dry run %s", count, args["dry_run"])
+        return {'affected': count, 'dry_run': args["dry_run"]}, status.HTTP_200_OK
 
     #------------------------------------------------------------------
     # ADD A NEW PROMOTION
     #------------------------------------------------------------------
     @api.doc('create_promotions')
     @api.response(400, 'The posted data was not valid')
+    @api.response(201, 'Promotion created', promotion_model)
     @api.expect(create_model)
-    @api.marshal_with(promotion_model, code=201)
     def post(self):
         """
         Creates a Promotion
@@ -223,13 +415,70 @@ class PromotionCollection(Resource):
         """
         app.logger.info("Request to create a promotion")
         promotion = Promotion()
-        logging.debug('Payload = %s', api.payload)
+        app.logger.debug('Payload = %s', api.payload)
         promotion.deserialize(api.payload)
         promotion.create()
         location_url = api.url_for(PromotionResource, promotion_id=promotion.id, _external=True)
 
-        logging.info("Promotion with ID [%s] created.", promotion.id)
-        return promotion.serialize(), status.HTTP_201_CREATED, {'Location': location_url}
+        app.logger.info("Promotion with ID [%s] created.", promotion.id)
+        headers = etag_header(promotion.etag())
+        headers['Location'] = location_url
+        body = serializer.dumps(serializer.to_dict(promotion))
+        return json_response(body, status.HTTP_201_CREATED, headers)
+
+######################################################################
+# PATH: /promotions/bulk
+######################################################################
+@api.route('/promotions/bulk')
+class BulkResource(Resource):
+    """ Handles creating many Promotions at once """
+    @api.doc('create_promotions_bulk')
+    @api.response(201, 'All Promotions created')
+    @api.response(207, 'Some Promotions created, see the results of each item')
+    @api.response(400, 'No Promotions created, see the results of each item')
+    @api.expect(bulk_args, [create_model])
+    def post(self):
+        """
+        Creates many Promotions
+        This endpoint takes a JSON array, or newline delimited JSON, of Promotions
+        and inserts them in one transaction. It returns a result for every item
+        """
+        args = bulk_args.parse_args()
+        items = read_bulk_items()
+        app.logger.info("Request to create %d promotions", len(items))
+        promotions = []
+        results = []
+        for position, data in enumerate(items):
+            try:
+                if isinstance(data, DataValidationError):
+                    raise data
+                promotion = Promotion().deserialize(data)
+                promotion.validate()
+            except DataValidationError as error:
+                results.append({'index': position, 'status': status.HTTP_400_BAD_REQUEST, 'message': str(error)})
+                continue
+            promotions.append(promotion)
+            results.append({'index': position, 'status': status.HTTP_201_CREATED, 'promotion': promotion})
+
+        invalid = len(items) - len(promotions)
+        created = bool(promotions) and not (args["atomic"] and invalid)
+        if created:
+            Promotion.create_many(promotions)
+        for result in results:
+            promotion = result.pop('promotion', None)
+            if promotion is None:
+                continue
+            if created:
+                result['promotion'] = serializer.to_dict(promotion)
+            else:
+                result.update(status=status.HTTP_424_FAILED_DEPENDENCY, message='Not created, other items were not valid')
+
+        if not created:
+            app.logger.info("Created no promotions, %d not valid", invalid)
+            return {'created': 0, 'results': results}, status.HTTP_400_BAD_REQUEST
+        app.logger.info("Created %d promotions, %d not valid", len(promotions), invalid)
+        code = status.HTTP_207_MULTI_STATUS if invalid else status.HTTP_201_CREATED
+        return json_response(serializer.dumps({'created': len(promotions), 'results': results}), code)
 
 ######################################################################
 # PATH: /promotions/{id}/expire
@@ -257,7 +506,29 @@ class ExpireResource(Resource):
         promotion.update()
 
         app.logger.info("Promotion with ID [%s] expired.", promotion.id)
-        return promotion.serialize(), status.HTTP_200_OK
+        body = serializer.dumps(serializer.to_dict(promotion))
+        return json_response(body, status.HTTP_200_OK, etag_header(promotion.etag()))
+
+######################################################################
+# PATH: /promotions/expire
+######################################################################
+@api.route("/promotions/expire")
+class ExpireCollection(Resource):
+    """Expire actions on many promotions"""
+    @api.doc('expire_promotions_by_filter')
+    @api.expect(filter_args, validate=True)
+    @api.response(400, 'No filter was given')
+    def put(self):
+        """
+        Set every Promotion matching the filters to expired
+
+        This endpoint expires them with one statement and returns how many were expired
+        """
+        args = parse_filter_args()
+        app.logger.info("Request to expire promotions matching %s", args)
+        count = Promotion.expire_by_multi_attributes(args, args["dry_run"])
+        app.logger.info("Expired %d promotions, dry run %s", count, args["dry_run"])
+        return {'affected': count, 'dry_run': args["dry_run"]}, status.HTTP_200_OK
 
 ######################################################################
 # FIND THE BEST PROMOTION FOR A PRODUCT
@@ -267,6 +538,7 @@ class ExpireResource(Resource):
 class BestResource(Resource):
     """Get Best Promotion actions on a product"""
     @api.doc('find_best_promotions')
+    @api.expect(best_args, validate=True)
     @api.response(404, 'Promotion not found')
     def get(self, product_id):
         """
@@ -274,15 +546,64 @@ class BestResource(Resource):
         This endpoint will get the best promotion based the product's id specified in the path
         """
         app.logger.info("Request to get the best promotion with product: %s", product_id)
-        promotion = Promotion.find_best_promotion_for_product(int(product_id))
+        args = parse_date_args(best_args.parse_args())
+        fields = parse_fields(args["fields"])
+        promotion = Promotion.find_best_in_index(int(product_id), args["at"])
 
         if not promotion:
             abort(status.HTTP_404_NOT_FOUND, "Promotion with product id '{}' was not found.".format(product_id))
 
-        app.logger.info("Returning best promotion: %s", promotion.product_name)
-        return promotion.serialize(), status.HTTP_200_OK
+        app.logger.info("Returning best promotion: %s", promotion["id"])
+        return json_response(serializer.dumps(project(promotion, fields)), status.HTTP_200_OK)
+
+
+######################################################################
+# FIND THE BEST PROMOTIONS FOR MANY PRODUCTS
+######################################################################
+@api.route("/promotions/best")
+class BestCollection(Resource):
+    """Get Best Promotion actions on many products"""
+    @api.doc('find_best_promotions_batch')
+    @api.response(400, 'The posted product ids were not valid')
+    @api.expect(best_args, best_request_model)
+    def post(self):
+        """
+        Get the best promotion for many products
+        This endpoint will return a map of product id to its best promotion, null when there is none
+        """
+        args = parse_date_args(best_args.parse_args())
+        fields = parse_fields(args["fields"])
+        product_ids = parse_product_ids(api.payload)
+        app.logger.info("Request to get the best promotion for %d products", len(product_ids))
+        promotions = Promotion.find_best_many_in_index(product_ids, args["at"])
+
+        app.logger.info("Returning best promotions, %d misses", list(promotions.values()).count(None))
+        body = serializer.dumps({
+            str(product_id): project(promotion, fields) for product_id, promotion in promotions.items()
+        })
+        return json_response(body, status.HTTP_200_OK)
+
+
+######################################################################
+# PRICE A CART
+######################################################################
+@api.route("/promotions/price")
+class PriceResource(Resource):
+    """Price actions on a cart"""
+    @api.doc('price_cart')
+    @api.response(400, 'The posted cart was not valid')
+    @api.expect(price_args, cart_model)
+    def post(self):
+        """
+        Price the lines of a cart
+        This endpoint will apply the best available promotion to each line and return the price of every line and the total
+        """
+        args = parse_date_args(price_args.parse_args())
+        lines = pricing.parse_lines(api.payload)
+        app.logger.info("Request to price a cart of %d lines", len(lines))
+        cart = pricing.price_cart(lines, args["at"])
+        return json_response(serializer.dumps(cart), status.HTTP_200_OK)
 
-    
 
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
@@ -293,7 +614,159 @@ def abort(error_code: int, message: str):
     app.logger.error(message)
     api.abort(error_code, message)
 
-@app.before_first_request
+def stream_promotions(promotions, sort:str, fields=None):
+    """Streams Promotions as newline delimited JSON while they are read
+
+    Rows are fetched STREAM_BATCH_SIZE at a time through a server-side
+    cursor, so memory use does not grow with the number of Promotions
+    """
+    app.logger.info("Streaming promotions ordered by %s", sort)
+    records = Promotion.stream_records(
+        promotions.order_by(*pagination.order_by(sort)), STREAM_BATCH_SIZE
+    )
+
+    serialize = serializer.serializer(fields)
+
+    def generate():
+        count = 0
+        for record in records:
+            count += 1
+            yield serializer.dumps(serialize(record)) + b"\n"
+        app.logger.info("Streamed %d promotions", count)
+
+    return Response(stream_with_context(generate()), status.HTTP_200_OK, mimetype=NDJSON)
+
+def etag_header(etag:str) -> dict:
+    """ Returns the headers that send a strong ETag """
+    return {'ETag': quote_etag(etag)}
+
+def not_modified(etag:str) -> bool:
+    """ Tells if the ETag is one the client sent in If-None-Match """
+    return request.if_none_match.contains_weak(etag)
+
+def matches(etag:str) -> bool:
+    """Tells if the ETag is one the client sent in If-Match
+
+    An ETag of the Promotion read with fields matches it too, as it is the
+    same version of the Promotion with the names of the fields after it
+    """
+    if request.if_match.star_tag:
+        return True
+    return any(
+        tag == etag or tag.startswith(etag + "-") for tag in request.if_match.as_set()
+    )
+
+def not_modified_response(etag:str):
+    """ Returns a 304 Not Modified, without a body to serialize """
+    return Response(status=status.HTTP_304_NOT_MODIFIED, headers=etag_header(etag))
+
+def collection_etag(args, at:datetime, changes_at:datetime=None, records=None) -> str:
+    """Returns the strong ETag of a list of Promotions
+
+    When the records were already read it digests the query and the id and
+    version of every one of them. Otherwise it digests the query, the
+    version aggregate of the Promotions matching the filters at a time and
+    when their availability next changes: a list filtered on availability
+    now gets other members at that time without any version changing
+    """
+    digest = hashlib.sha1(repr(QueryCache.key(args)).encode("utf-8"))
+    if records is None:
+        version = Promotion.version_of_multi_attributes(dict(args, at=at))
+        digest.update(repr((version, changes_at)).encode("utf-8"))
+    else:
+        for record in sorted(records, key=operator.attrgetter("id")):
+            digest.update(b"%d-%d," % (record.id, record.version))
+    return digest.hexdigest()
+
+def parse_fields(value:str):
+    """Returns the fields asked for with fields=, None when all of them are
+
+    Raises:
+        DataValidationError: if a field is not in the promotion_model
+    """
+    if not value:
+        return None
+    fields = list(dict.fromkeys(field.strip() for field in value.split(",") if field.strip()))
+    unknown = [field for field in fields if field not in PROMOTION_FIELDS]
+    if unknown or not fields:
+        raise DataValidationError(
+            "Invalid fields: must be some of " + ", ".join(PROMOTION_FIELDS)
+        )
+    return fields
+
+def project(promotion:dict, fields=None):
+    """ Keeps only the requested fields of a serialized Promotion """
+    if promotion is None or fields is None:
+        return promotion
+    return {field: promotion[field] for field in fields}
+
+def json_response(body:bytes, code:int, headers=None):
+    """Returns JSON already encoded by the serializer
+
+    The response skips the marshalling and encoding Flask-RESTX would do,
+    the promotion_model still documents it in Swagger
+    """
+    return Response(body, code, headers, mimetype=serializer.JSON_MIMETYPE)
+
+def parse_filter_args():
+    """Returns the filters of a bulk action, at least one must be given"""
+    args = parse_date_args(filter_args.parse_args())
+    if all(args[key] is None for key in FILTER_KEYS):
+        raise DataValidationError(
+            "Invalid request: filter by at least one of " + ", ".join(FILTER_KEYS)
+        )
+    return args
+
+def parse_date_args(args):
+    """Parses the dates of query string arguments once, for every query of the request
+
+    Raises:
+        DataValidationError: if a date is not valid
+    """
+    for name in DATE_ATTRIBUTES + ('at',):
+        if name in args:
+            args[name] = parse_date(args[name])
+    return args
+
+def read_bulk_items() -> list:
+    """Returns the items of a bulk request posted as a JSON array or as NDJSON
+
+    Lines of NDJSON that are not valid JSON are returned as a
+    DataValidationError so they are reported with the other items
+    """
+    if request.mimetype == NDJSON:
+        items = []
+        for line in request.get_data(as_text=True).splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                items.append(DataValidationError("Invalid Promotion: line is not valid JSON"))
+    else:
+        items = request.get_json(silent=True)
+        if not isinstance(items, list):
+            raise DataValidationError("Invalid request: body must be a JSON array of Promotions")
+    if len(items) > BULK_CREATE_LIMIT:
+        raise DataValidationError(
+            "Invalid request: at most {} Promotions can be created at once".format(BULK_CREATE_LIMIT)
+        )
+    return items
+
+def parse_product_ids(data) -> list:
+    """Returns the unique product ids of a batch request in the order posted"""
+    try:
+        product_ids = list(dict.fromkeys(int(product_id) for product_id in data["product_ids"]))
+    except (KeyError, TypeError, ValueError):
+        raise DataValidationError("Invalid request: product_ids must be a list of integers")
+    if not product_ids:
+        raise DataValidationError("Invalid request: product_ids must not be empty")
+    if len(product_ids) > BEST_BATCH_LIMIT:
+        raise DataValidationError(
+            "Invalid request: at most {} product_ids are allowed".format(BEST_BATCH_LIMIT)
+        )
+    return product_ids
+
 def init_db():
     """ Initialies the SQLAlchemy app """
     global app
@@ -0,0 +1,312 @@
+"""
+Promotion Scheduler
+
+An in-process schedule of the Promotions that have not ended yet. It keeps
+the set of Promotions active right now, and a heap of the next start and
+end dates, so the set is brought up to date by popping the transitions
+that are due instead of comparing the dates of every Promotion.
+
+Listeners are told about every Promotion that is activated or expired. A
+Promotion is activated when it enters the active set, at its start date or
+when it is created or changed to be active, and expired when it leaves it.
+
+The schedule is loaded lazily on first use and kept current by the model,
+like the promotion index. Transitions are applied on every read, and also
+every ``interval`` seconds by a background thread once start() is called.
+Writes made by other workers are picked up when it is reloaded, every
+``ttl`` seconds.
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+from service.promotion_index import rank
+
+logger = logging.getLogger("flask.app")
+
+# A Promotion is still active at its end date and expires right after it
+_EXPIRY_DELAY = timedelta(microseconds=1)
+
+
+class PromotionScheduler:
+    """
+    Class that represents the schedule of the active and upcoming Promotions
+    """
+
+    def __init__(self, loader, ttl=None):
+        """
+        Args:
+            loader (callable): returns the Promotions that have not ended at a time
+            ttl (int): seconds before the schedule is reloaded, None to never reload
+        """
+        self._loader = loader
+        self.ttl = ttl
+        self.listeners = []  # told activated(records) and expired(records)
+        self._records = {}  # promotion id -> record of every scheduled Promotion
+        self._active = {}  # promotion id -> record of the active Promotions
+        self._by_product = {}  # product_id -> {promotion id: record} of the active ones
+        self._heap = []  # (time, sequence, promotion id, record) of the next transitions
+        self._sequence = itertools.count()
+        self._loaded_at = None
+        self._stale = False  # reload on the next read, set by bulk changes
+        self._pending = None  # (before, after) changes told while loading, None when not loading
+        self._lock = threading.RLock()
+        self._load_lock = threading.Lock()  # one load at a time, without blocking the reads
+        self._thread = None
+        self._stop = threading.Event()
+
+    def active(self) -> list:
+        """ Returns the records of the Promotions active now """
+        self.advance()
+        with self._lock:
+            return list(self._active.values())
+
+    def best(self, product_id:int):
+        """ Returns the serialized best active Promotion for a product """
+        return self.best_many([product_id])[product_id]
+
+    def best_many(self, product_ids) -> dict:
+        """Returns the serialized best active Promotion for many products
+
+        Promotions are ranked like in the promotion index
+
+        :return: a map of product id to serialized Promotion, or None on a miss
+        :rtype: dict
+        """
+        self.advance()
+        with self._lock:
+            best = {}
+            for product_id in product_ids:
+                records = [
+                    record
+                    for record in self._by_product.get(product_id, {}).values()
+                    if record.score() > 0
+                ]
+                winner = min(records, key=_rank, default=None)
+                best[product_id] = None if winner is None else winner.serialize()
+            return best
+
+    def active_by_product(self, product_ids) -> dict:
+        """ Returns the records of the Promotions active now for each product, empty on a miss """
+        self.advance()
+        with self._lock:
+            return {
+                product_id: list(self._by_product.get(product_id, {}).values())
+                for product_id in product_ids
+            }
+
+    def next_transition(self):
+        """ Returns when a Promotion is next activated or expired, None if never """
+        self.advance()
+        with self._lock:
+            while self._heap and not self._is_current(self._heap[0]):
+                heapq.heappop(self._heap)
+            return self._heap[0][0] if self._heap else None
+
+    def advance(self, at:datetime=None):
+        """Applies the transitions due by a time, now when None
+
+        The schedule is loaded first if it was never loaded or is older than
+        the ttl. Time only moves forward: a transition that was applied is
+        not undone by advancing to an earlier time
+        """
+        at = at or datetime.now()
+        activated, expired = [], []
+        if self._is_due():
+            activated, expired = self._load(at)
+        with self._lock:
+            while self._heap and self._heap[0][0] <= at:
+                entry = heapq.heappop(self._heap)
+                if not self._is_current(entry):
+                    continue
+                record = entry[3]
+                if record.id in self._active:
+                    self._untrack(record.id)
+                    expired.append(record)
+                else:
+                    self._activate(record)
+                    activated.append(record)
+        self._notify(activated, expired)
+
+    def changed(self, changes):
+        """ Applies the (before, after) records of changed Promotions """
+        at = datetime.now()
+        activated, expired = [], []
+        with self._lock:
+            if self._pending is not None:
+                self._pending.extend(changes)  # applied again once loaded
+            if self._stale or self._loaded_at is None:
+                return  # the next read loads them
+            for before, after in changes:
+                was_active = before is not None and before.id in self._active
+                if before is not None:
+                    self._untrack(before.id)
+                if after is not None:
+                    self._track(after, at)
+                is_active = after is not None and after.id in self._active
+                if was_active and not is_active:
+                    expired.append(before)
+                elif is_active and not was_active:
+                    activated.append(after)
+        self._notify(activated, expired)
+
+    def changed_in_bulk(self, product_ids=None):
+        """ Reloads the schedule on its next read, as any Promotion could have changed """
+        with self._lock:
+            self._stale = True
+
+    def clear(self):
+        """ Forgets every Promotion, without telling the listeners """
+        with self._lock:
+            self._reset()
+            self._loaded_at = None
+            self._stale = False
+
+    def start(self, interval:float, context=None):
+        """Applies the transitions every interval seconds in a background thread
+
+        Args:
+            interval (float): the seconds between two runs
+            context (callable): returns the context manager each run is made in,
+                such as app.app_context, so the loader can reach the database
+        """
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, args=(interval, context), name="promotion-scheduler", daemon=True
+        )
+        self._thread.start()
+        logger.info("Promotion scheduler started, every %s seconds", interval)
+
+    def stop(self):
+        """ Stops the background thread """
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    ######################################################################
+    #  P R I V A T E   M E T H O D S
+    ######################################################################
+
+    def _run(self, interval, context):
+        while not self._stop.wait(interval):
+            try:
+                if context is None:
+                    self.advance()
+                else:
+                    with context():
+                        self.advance()
+            except Exception:  # keep the schedule running, the next read retries
+                logger.exception("Promotion scheduler failed to advance")
+
+    def _is_due(self) -> bool:
+        """ Tells if the schedule must be loaded before it is read """
+        with self._lock:
+            return self._stale or self._loaded_at is None or (
+                self.ttl is not None and time.monotonic() - self._loaded_at > self.ttl
+            )
+
+    def _load(self, at):
+        """Replaces the schedule with a fresh copy from the loader
+
+        The new schedule is built without holding the lock, reads go on with
+        the current one meanwhile, and swapped in once it is complete. The
+        changes told while it loads are applied to it again, as the loader
+        may have read the Promotions before them
+
+        :return: the records activated and expired since the last load, none on the first
+        :rtype: tuple
+        """
+        with self._load_lock:
+            if not self._is_due():
+                return [], []  # loaded by another thread meanwhile
+            logger.info("Loading the promotion schedule")
+            with self._lock:
+                self._pending = []
+                self._stale = False  # a bulk change told while loading sets it again
+            fresh = PromotionScheduler(self._loader)
+            try:
+                for record in self._loader(at):
+                    fresh._track(record, at)
+            except Exception:
+                with self._lock:
+                    self._pending = None
+                    self._stale = True
+                raise
+            with self._lock:
+                for before, after in self._pending:
+                    if before is not None:
+                        fresh._untrack(before.id)
+                    if after is not None:
+                        fresh._track(after, at)
+                self._pending = None
+                previous = None if self._loaded_at is None else self._active
+                self._records, self._active = fresh._records, fresh._active
+                self._by_product, self._heap = fresh._by_product, fresh._heap
+                self._sequence = fresh._sequence
+                self._loaded_at = time.monotonic()
+                if previous is None:
+                    return [], []
+                activated = [record for id_, record in self._active.items() if id_ not in previous]
+                expired = [record for id_, record in previous.items() if id_ not in self._active]
+                return activated, expired
+
+    def _reset(self):
+        self._records = {}
+        self._active = {}
+        self._by_product = {}
+        self._heap = []
+
+    def _track(self, record, at):
+        """ Schedules a Promotion that has not ended, activating it when it has started """
+        self._untrack(record.id)
+        if record.to_date < at or record.to_date < record.from_date:
+            return  # it has ended, or it ends before it starts and is never active
+        self._records[record.id] = record
+        if record.from_date <= at:
+            self._activate(record)
+        else:
+            self._push(record.from_date, record)
+
+    def _activate(self, record):
+        self._active[record.id] = record
+        self._by_product.setdefault(record.product_id, {})[record.id] = record
+        self._push(record.to_date + _EXPIRY_DELAY, record)
+
+    def _untrack(self, promotion_id):
+        record = self._records.pop(promotion_id, None)
+        if record is None:
+            return
+        if self._active.pop(promotion_id, None) is not None:
+            products = self._by_product[record.product_id]
+            del products[promotion_id]
+            if not products:
+                del self._by_product[record.product_id]
+
+    def _push(self, when, record):
+        heapq.heappush(self._heap, (when, next(self._sequence), record.id, record))
+
+    def _is_current(self, entry) -> bool:
+        """ Tells if a heap entry is for the scheduled version of its Promotion """
+        return self._records.get(entry[2]) is entry[3]
+
+    def _notify(self, activated, expired):
+        if activated:
+            logger.info("Activated %d promotions", len(activated))
+        if expired:
+            logger.info("Expired %d promotions", len(expired))
+        for listener in self.listeners:
+            if activated:
+                listener.activated(activated)
+            if expired:
+                listener.expired(expired)
+
+
+def _rank(record):
+    """ Ranks a record like the promotion index does """
+    return rank(record.score(), record.id)
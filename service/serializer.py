@@ -0,0 +1,71 @@
+"""
+Promotion Serializer
+
+Writes Promotions out as the JSON of the promotion_model in one pass. For
+each set of fields a function is compiled from FIELD_EXPRESSIONS in
+service.models that reads them straight off a Promotion or PromotionRecord
+into a dict ready for the JSON encoder, so responses no longer go through
+marshal() field by field. Promotion.serialize() returns the same dict.
+orjson is used to encode when it is installed, the json module otherwise.
+"""
+import json
+from functools import lru_cache
+from service.models import FIELD_EXPRESSIONS
+
+try:
+    import orjson
+except ImportError:  # the standard library encoder is the fallback
+    orjson = None
+
+# The fields of a Promotion in the order they are written out
+FIELDS = tuple(FIELD_EXPRESSIONS)
+
+JSON_MIMETYPE = "application/json"
+
+
+@lru_cache(maxsize=None)
+def compile_serializer(fields:tuple=FIELDS):
+    """Returns a function that turns a Promotion into the dict of some of its fields
+
+    The function is built from source once per set of fields, so writing a
+    Promotion out is a single dict display with no loop or lookups by name
+
+    Args:
+        fields (tuple): the fields to write out, in order
+    """
+    unknown = set(fields).difference(FIELD_EXPRESSIONS)
+    if unknown:
+        raise ValueError("Unknown fields: " + ", ".join(sorted(unknown)))
+    items = ", ".join("{!r}: {}".format(name, FIELD_EXPRESSIONS[name]) for name in fields)
+    namespace = {}
+    exec("def serialize(promotion):\n    return {" + items + "}\n", namespace)
+    return namespace["serialize"]
+
+
+def serializer(fields=None):
+    """Returns the compiled serializer for the fields of a request
+
+    Args:
+        fields (list): the fields asked for, all of them when None
+    """
+    if fields is None:
+        return compile_serializer(FIELDS)
+    return compile_serializer(tuple(name for name in FIELDS if name in fields))
+
+
+def to_dict(promotion, fields=None) -> dict:
+    """ Returns the promotion_model dict of a Promotion """
+    return serializer(fields)(promotion)
+
+
+def dumps(data) -> bytes:
+    """ Encodes serialized Promotions, or any JSON data, as compact JSON """
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+
+def to_json(promotions, fields=None) -> bytes:
+    """ Returns the JSON array of a list of Promotions """
+    serialize = serializer(fields)
+    return dumps([serialize(promotion) for promotion in promotions])
@@ -0,0 +1,78 @@
+"""
+Test cases for the Gunicorn Configuration
+
+"""
+import os
+import runpy
+import tempfile
+import unittest
+from unittest.mock import patch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+######################################################################
+#  G U N I C O R N   C O N F I G U R A T I O N   T E S T   C A S E S
+######################################################################
+class TestGunicornConf(unittest.TestCase):
+    """ Test Cases for the worker and pool sizing """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        """ This runs after each test """
+        self.directory.cleanup()
+
+    def start(self, cores:int, **env) -> tuple:
+        """ Returns the gunicorn settings and the engine options of a worker under env """
+        env = dict(
+            {"DATABASE_URI": "postgresql://localhost/promotions",
+             "PROMETHEUS_MULTIPROC_DIR": self.directory.name}, **env
+        )
+        with patch.dict(os.environ, env), patch("os.sched_getaffinity", return_value=set(range(cores))):
+            for name in ("WEB_CONCURRENCY", "GUNICORN_THREADS"):
+                if name not in env:
+                    os.environ.pop(name, None)
+            settings = runpy.run_path(os.path.join(ROOT, "gunicorn.conf.py"))
+            # the workers load the configuration after the master set their numbers
+            config = runpy.run_path(os.path.join(ROOT, "config.py"))
+        return settings, config["SQLALCHEMY_ENGINE_OPTIONS"]
+
+    def connections(self, settings, options) -> int:
+        """ Returns the most connections all the workers may open """
+        return settings["workers"] * (options["pool_size"] + options["max_overflow"])
+
+    ######################################################################
+    #  T E S T   C A S E S
+    ######################################################################
+
+    def test_connections_within_limit(self):
+        """Keep the connections of every worker within DB_MAX_CONNECTIONS"""
+        for cores in (1, 4, 19, 32, 64):
+            for worker_class in ("sync", "gthread"):
+                for limit in (1, 5, 20, 100):
+                    settings, options = self.start(
+                        cores, GUNICORN_WORKER_CLASS=worker_class, DB_MAX_CONNECTIONS=str(limit)
+                    )
+                    self.assertLessEqual(settings["workers"], limit)
+                    self.assertLessEqual(self.connections(settings, options), limit)
+                    self.assertGreaterEqual(options["pool_size"], 1)
+
+    def test_default_workers(self):
+        """Size the workers from the cores"""
+        settings, options = self.start(4, GUNICORN_WORKER_CLASS="gthread")
+        self.assertEqual((settings["workers"], settings["threads"]), (5, 4))
+        # a connection per thread and one for the scheduler, within 20 // 5
+        self.assertEqual(options["pool_size"], 4)
+        self.assertEqual(options["max_overflow"], 0)
+        settings, options = self.start(64, GUNICORN_WORKER_CLASS="sync")
+        self.assertEqual(settings["workers"], 20)
+
+    def test_too_many_workers(self):
+        """Refuse more workers than database connections"""
+        with self.assertRaises(RuntimeError):
+            self.start(4, WEB_CONCURRENCY="21", DB_MAX_CONNECTIONS="20")
+        settings, options = self.start(4, WEB_CONCURRENCY="20", DB_MAX_CONNECTIONS="20")
+        self.assertEqual(self.connections(settings, options), 20)
@@ -6,8 +6,11 @@ import logging
 import unittest
 import os
 import json
+import random
+from unittest.mock import patch
 from werkzeug.exceptions import NotFound
-from service.models import Promotion, TypeOfPromo, DataValidationError, db
+from service.models import Promotion, PromotionRecord, TypeOfPromo, DataValidationError, VersionConflictError, db
+from service.models import upgrade_schema
 from service import app
 from .factories import PromotionFactory
 from datetime import datetime, timedelta
@@ -42,6 +45,9 @@ class TestPromotion(unittest.TestCase):
     def tearDownClass(cls):
         """ This runs once after the entire test suite """
         db.session.close()
+        # leave an empty database, the next run migrates it from the start
+        db.drop_all()
+        db.engine.execute("DROP TABLE IF EXISTS alembic_version")
 
     def setUp(self):
         """ This runs before each test """
@@ -119,6 +125,51 @@ class TestPromotion(unittest.TestCase):
         promotions = promotion.all()
         self.assertEqual(len(promotions), 1)
 
+    def test_create_many_promotions(self):
+        """Create many promotions in one transaction"""
+        promotions = PromotionFactory.create_batch(5)
+        Promotion.create_many(promotions)
+        self.assertEqual(len(Promotion.all()), 5)
+        # given ids in the order of the list
+        self.assertEqual([promotion.id for promotion in promotions], [1, 2, 3, 4, 5])
+        for promotion in promotions:
+            found = Promotion.find(promotion.id)
+            self.assertEqual(found.serialize(), promotion.serialize())
+        # nothing is created when any promotion is not valid
+        promotions = PromotionFactory.create_batch(3)
+        promotions[1].amount = 0
+        self.assertRaises(DataValidationError, Promotion.create_many, promotions)
+        self.assertEqual(len(Promotion.all()), 5)
+
+    def test_validate_a_promotion(self):
+        """Validate the amount of a promotion"""
+        promotion = PromotionFactory(category=TypeOfPromo.Discount, amount=100)
+        promotion.validate()
+        for amount in [0, -1, "10"]:
+            promotion.amount = amount
+            self.assertRaises(DataValidationError, promotion.validate)
+        promotion.amount = 101
+        self.assertRaises(DataValidationError, promotion.validate)
+        promotion.category = TypeOfPromo.BOGOF
+        promotion.validate()
+
+    def test_validate_types(self):
+        """Validate the required fields and types of a promotion"""
+        for field, value in [("product_name", None), ("product_name", 5), ("product_id", None),
+                             ("product_id", "1"), ("product_id", True), ("amount", True),
+                             ("description", 5), ("from_date", None), ("from_date", 5),
+                             ("to_date", ""), ("to_date", "2021-01-01"), ("category", None),
+                             ("category", "Discount"), ("category", TypeOfPromo),
+                             ("product_name", "x" * 64), ("description", "x" * 64)]:
+            promotion = PromotionFactory(amount=10)
+            setattr(promotion, field, value)
+            with self.assertRaises(DataValidationError, msg="{}={!r}".format(field, value)):
+                promotion.validate()
+        promotion = PromotionFactory(amount=10, description=None)
+        promotion.validate()
+        promotion = PromotionFactory(amount=10, product_name="x" * 63, description="x" * 63)
+        promotion.validate()
+
     def test_update_a_promotion(self):
         """Update a promotion"""
         promotion = PromotionFactory()
@@ -139,6 +190,25 @@ class TestPromotion(unittest.TestCase):
         self.assertEqual(promotions[0].id, 1)
         self.assertEqual(promotions[0].amount, 15)
 
+    def test_update_bumps_the_version(self):
+        """Update a promotion only from the version that was read"""
+        promotion = PromotionFactory(amount=10)
+        promotion.create()
+        self.assertEqual(promotion.version, 1)
+        self.assertEqual(promotion.etag(), "{}-1".format(promotion.id))
+        self.assertEqual(promotion.etag(["id", "amount"]), "{}-1-id-amount".format(promotion.id))
+        promotion.amount = 15
+        promotion.update()
+        self.assertEqual(promotion.version, 2)
+        self.assertEqual(Promotion.find_record(promotion.id).etag(), promotion.etag())
+        # another writer changes it before this one saves
+        db.session.execute(
+            Promotion.__table__.update().values(version=Promotion.version + 1)
+        )
+        promotion.amount = 20
+        self.assertRaises(VersionConflictError, promotion.update)
+        self.assertEqual(Promotion.find(promotion.id).amount, 15)
+
     def test_delete_a_promotion(self):
         """Delete a promotion"""
         promotion = PromotionFactory()
@@ -400,6 +470,63 @@ class TestPromotion(unittest.TestCase):
         self.assertEqual(promotions[0].from_date, datetime(2021, 10, 14)) 
         self.assertEqual(promotions[0].to_date, datetime(2021, 10, 20))
 
+    def test_find_available_at(self):
+        """Find promotions available at a given time"""
+        at = datetime(2021, 11, 28, 12, 0, 0)
+        today = PromotionFactory(
+            category=TypeOfPromo.Discount, amount=10, product_id=1,
+            from_date=at - timedelta(days=1), to_date=at,
+        )
+        tomorrow = PromotionFactory(
+            category=TypeOfPromo.Discount, amount=20, product_id=1,
+            from_date=at + timedelta(microseconds=1), to_date=at + timedelta(days=1),
+        )
+        Promotion.create_many([today, tomorrow])
+        self.assertTrue(today.is_available(at))
+        self.assertFalse(tomorrow.is_available(at))
+        self.assertFalse(today.is_available())
+        later = at + timedelta(hours=1)
+        for when, expected in [(at, today), (later, tomorrow)]:
+            self.assertEqual([p.id for p in Promotion.find_by_availability(True, when)], [expected.id])
+            self.assertEqual(
+                [p.id for p in Promotion.find_by_multi_attributes({"available": 1, "at": when})],
+                [expected.id],
+            )
+            self.assertEqual(Promotion.find_best_promotion_for_product(1, when).id, expected.id)
+            self.assertEqual(Promotion.find_best_promotions_for_products([1], when)[1].id, expected.id)
+            self.assertEqual(Promotion.find_best_in_index(1, when)["id"], expected.id)
+            self.assertEqual(Promotion.find_best_many_in_index([1], when)[1]["id"], expected.id)
+        self.assertEqual(len(Promotion.find_by_availability(False, later).all()), 1)
+        self.assertIsNone(Promotion.find_best_promotion_for_product(1))
+
+    def test_find_by_date_ranges(self):
+        """Find promotions by ranges of their dates"""
+        for days in [(1, 5), (3, 10), (8, 12)]:
+            PromotionFactory(
+                from_date=datetime(2021, 10, days[0]), to_date=datetime(2021, 10, days[1])
+            ).create()
+
+        def starts(promotions):
+            return sorted(promotion.from_date.day for promotion in promotions)
+
+        self.assertEqual(starts(Promotion.find_by_from_date_range("2021-10-03", "2021-10-08")), [3, 8])
+        self.assertEqual(starts(Promotion.find_by_from_date_range(end="2021-10-02T23:00:00")), [1])
+        self.assertEqual(starts(Promotion.find_by_to_date_range(start="2021/10/10")), [3, 8])
+        self.assertEqual(starts(Promotion.find_by_to_date_range("2021-10-06", "2021-10-11")), [3])
+        # overlaps
+        self.assertEqual(starts(Promotion.find_active_between("2021-10-05", "2021-10-07")), [1, 3])
+        self.assertEqual(starts(Promotion.find_active_between("2021-10-11")), [8])
+        self.assertEqual(starts(Promotion.find_active_between(end="2021-10-02")), [1])
+        self.assertEqual(starts(Promotion.find_active_between()), [1, 3, 8])
+        self.assertRaises(DataValidationError, Promotion.find_active_between, "someday")
+        # the predicate used by caches agrees with the queries
+        args = {"active_from": "2021-10-05", "active_to": "2021-10-07", "to_date_before": "2021-10-05"}
+        for promotion in Promotion.all():
+            self.assertEqual(
+                Promotion.matches_multi_attributes(args, promotion),
+                promotion in Promotion.find_by_multi_attributes(args).all(),
+            )
+
     def test_find_by_availability(self):
         """Find promotions by Availability"""
         current_date = datetime.now()
@@ -487,6 +614,146 @@ class TestPromotion(unittest.TestCase):
         self.assertEqual(best_promotion.from_date, current_date - timedelta(days=1)) 
         self.assertEqual(best_promotion.to_date, current_date + timedelta(days=5))  
 
+    def test_find_best_in_index(self):
+        """find the best promotion for a product through the index"""
+        current_date = datetime.now()
+        self.assertEqual(Promotion.find_best_in_index(11111), None)
+        promotion = Promotion(
+            product_name="Macbook", 
+            category=TypeOfPromo.Discount, 
+            product_id=11111, amount=10, 
+            description="Gread Deal", 
+            from_date=current_date - timedelta(days=1), 
+            to_date=current_date + timedelta(days=5)
+        )
+        promotion.create()
+        self.assertEqual(Promotion.find_best_in_index(11111)["id"], promotion.id)
+        # updates and expiry are reflected without reloading the product
+        promotion.amount = 30
+        promotion.update()
+        self.assertEqual(Promotion.find_best_in_index(11111)["amount"], 30)
+        promotion.to_date = promotion.from_date - timedelta(days=1)
+        promotion.update()
+        self.assertEqual(Promotion.find_best_in_index(11111), None)
+        promotion.to_date = current_date + timedelta(days=5)
+        promotion.update()
+        promotion.delete()
+        self.assertEqual(Promotion.find_best_in_index(11111), None)
+
+    def test_find_best_promotions_for_products(self):
+        """find the best available promotion for many products"""
+        current_date = datetime.now()
+        for product_id, category, amount in [
+            (11111, TypeOfPromo.Discount, 10),
+            (11111, TypeOfPromo.BOGOF, 2),
+            (11112, TypeOfPromo.Discount, 40),
+            (11113, TypeOfPromo.Unknown, 40),
+        ]:
+            Promotion(
+                product_name="Macbook", 
+                category=category, 
+                product_id=product_id, amount=amount, 
+                description="Gread Deal", 
+                from_date=current_date - timedelta(days=1), 
+                to_date=current_date + timedelta(days=5)
+            ).create()
+        best = Promotion.find_best_promotions_for_products([11111, 11112, 11113, 11114])
+        self.assertEqual(best[11111].category, TypeOfPromo.BOGOF)
+        self.assertEqual(best[11112].amount, 40)
+        self.assertEqual(best[11113], None)
+        self.assertEqual(best[11114], None)
+
+    def test_best_promotion_sql_matches_index(self):
+        """rank promotions the same way in the database, the index and the scheduler"""
+        current_date = datetime.now()
+        rng = random.Random(2021)
+        product_ids = list(range(1, 31))
+        for _ in range(300):
+            # amounts are picked so discounts and BOGOF often tie
+            Promotion(
+                product_name="Macbook",
+                category=rng.choice(list(TypeOfPromo)),
+                product_id=rng.choice(product_ids),
+                amount=rng.choice([1, 2, 4, 5, 10, 20, 25, 50, 100]),
+                description="Gread Deal",
+                # an hour away from now, which the scheduler reads a little later
+                from_date=current_date + timedelta(days=rng.randint(-5, 1), hours=-1),
+                to_date=current_date + timedelta(days=rng.randint(-1, 5), hours=1),
+            ).create()
+        Promotion.index.clear()
+        Promotion.scheduler.clear()
+        in_index = Promotion.find_best_many_in_index(product_ids, current_date)
+        in_scheduler = Promotion.find_best_many_in_index(product_ids)
+        in_sql = Promotion.find_best_promotions_for_products(product_ids, current_date)
+        for product_id in product_ids:
+            # the best score wins, the lowest id breaks ties
+            available = [
+                promotion
+                for promotion in Promotion.find_by_product_id(product_id)
+                if promotion.is_available(current_date) and promotion.score() > 0
+            ]
+            best = min(available, key=lambda promotion: (-promotion.score(), promotion.id), default=None)
+            in_sql_one = Promotion.find_best_promotion_for_product(product_id, current_date)
+            if best is None:
+                self.assertEqual(in_index[product_id], None)
+                self.assertEqual(in_scheduler[product_id], None)
+                self.assertEqual(in_sql[product_id], None)
+                self.assertEqual(in_sql_one, None)
+            else:
+                self.assertEqual(in_index[product_id]["id"], best.id)
+                self.assertEqual(in_scheduler[product_id]["id"], best.id)
+                self.assertEqual(in_sql[product_id].id, best.id)
+                self.assertEqual(in_sql_one.id, best.id)
+            # the index is loaded with the promotions ranked by the database
+            ranked = [promotion.id for promotion in Promotion.find_ranked_by_product_ids([product_id])]
+            expected = sorted(
+                (promotion for promotion in Promotion.find_by_product_id(product_id) if promotion.score() > 0),
+                key=lambda promotion: (-promotion.score(), promotion.id),
+            )
+            self.assertEqual(ranked, [promotion.id for promotion in expected])
+
+    def test_expire_by_multi_attributes(self):
+        """expire every promotion matching the attributes"""
+        current_date = datetime.now()
+        for product_id, category in [(11111, TypeOfPromo.Discount),
+                                     (11111, TypeOfPromo.BOGOF),
+                                     (11112, TypeOfPromo.Discount)]:
+            Promotion(
+                product_name="Macbook",
+                category=category,
+                product_id=product_id, amount=10,
+                description="Gread Deal",
+                from_date=current_date - timedelta(days=1, microseconds=5),
+                to_date=current_date + timedelta(days=5)
+            ).create()
+        self.assertEqual(Promotion.find_best_in_index(11111)["product_id"], 11111)
+        args = {"product_id": 11111, "available": 1}
+        self.assertEqual(Promotion.expire_by_multi_attributes(args, dry_run=True), 2)
+        self.assertEqual(len(Promotion.find_by_availability(True).all()), 3)
+        self.assertEqual(Promotion.expire_by_multi_attributes(args), 2)
+        self.assertEqual(Promotion.expire_by_multi_attributes(args), 0)
+        for promotion in Promotion.find_by_product_id(11111):
+            self.assertFalse(promotion.is_available())
+            self.assertEqual(promotion.to_date, promotion.from_date - timedelta(days=1))
+        self.assertEqual(Promotion.find_best_in_index(11111), None)
+        self.assertEqual(len(Promotion.find_by_availability(True).all()), 1)
+        self.assertEqual(
+            sorted(promotion.version for promotion in Promotion.all()), [1, 2, 2]
+        )
+
+    def test_delete_by_multi_attributes(self):
+        """delete every promotion matching the attributes"""
+        for promotion in PromotionFactory.create_batch(3, category=TypeOfPromo.Discount):
+            promotion.create()
+        for promotion in PromotionFactory.create_batch(2, category=TypeOfPromo.BOGOF):
+            promotion.create()
+        args = {"category": "BOGOF"}
+        self.assertEqual(Promotion.delete_by_multi_attributes(args, dry_run=True), 2)
+        self.assertEqual(len(Promotion.all()), 5)
+        self.assertEqual(Promotion.delete_by_multi_attributes(args), 2)
+        self.assertEqual(len(Promotion.all()), 3)
+        self.assertRaises(DataValidationError, Promotion.delete_by_multi_attributes, {"category": "bogof"})
+
     def test_find_by_multi_attributes(self):
         """find the promotions with multiple attributes"""
         current_date = datetime.now()
@@ -519,3 +786,70 @@ class TestPromotion(unittest.TestCase):
             result = Promotion.find_by_multi_attributes(args)
             self.assertEqual(promotion.id, result[0].id)
 
+    def test_version_of_multi_attributes(self):
+        """aggregate the versions of the promotions matching the attributes"""
+        self.assertEqual(Promotion.version_of_multi_attributes({}), (0, 0, 0))
+        promotions = PromotionFactory.create_batch(3, category=TypeOfPromo.Discount)
+        Promotion.create_many(promotions)
+        version = Promotion.version_of_multi_attributes({"category": "Discount"})
+        self.assertEqual(version, (3, sum(promotion.id for promotion in promotions), 3))
+        promotion = Promotion.find(promotions[0].id)
+        promotion.amount = 1
+        promotion.update()
+        self.assertEqual(Promotion.version_of_multi_attributes({"category": "Discount"})[2], 4)
+        self.assertEqual(Promotion.version_of_multi_attributes({"category": "BOGOF"}), (0, 0, 0))
+
+    def test_fetch_records(self):
+        """read promotions as records without building ORM instances"""
+        for promotion in PromotionFactory.create_batch(6):
+            promotion.create()
+        for args in [{}, {"available": 1}, {"available": 0}, {"category": "Discount"}]:
+            statement = Promotion.select_by_multi_attributes(args).order_by(Promotion.id)
+            records = Promotion.fetch_records(statement)
+            promotions = Promotion.find_by_multi_attributes(args).order_by(Promotion.id).all()
+            self.assertEqual(
+                [record.serialize() for record in records],
+                [promotion.serialize() for promotion in promotions],
+            )
+            for record in records:
+                self.assertIsInstance(record, PromotionRecord)
+            streamed = list(Promotion.stream_records(statement, 4))
+            self.assertEqual(streamed, records)
+
+    def test_next_availability_change(self):
+        """find when the availability of the matching promotions next changes"""
+        now = datetime(2021, 11, 28, 12, 0, 0)
+        self.assertIsNone(Promotion.next_availability_change({}, now))
+        for days, category in [((-10, -5), TypeOfPromo.Discount),
+                               ((-1, 3), TypeOfPromo.Discount),
+                               ((2, 4), TypeOfPromo.BOGOF)]:
+            PromotionFactory(
+                category=category,
+                from_date=now + timedelta(days=days[0]),
+                to_date=now + timedelta(days=days[1]),
+            ).create()
+        self.assertEqual(
+            Promotion.next_availability_change({"available": 1}, now),
+            now + timedelta(days=2),
+        )
+        self.assertEqual(
+            Promotion.next_availability_change({"category": "Discount"}, now),
+            now + timedelta(days=3, microseconds=1),
+        )
+        self.assertIsNone(Promotion.next_availability_change({}, now + timedelta(days=5)))
+
+    def test_init_db_once(self):
+        """Bind the engine and check the schema once"""
+        with patch("service.models.upgrade_schema") as check:
+            Promotion.init_db(app)
+            check.assert_not_called()
+
+    def test_upgrade_schema(self):
+        """Upgrade the schema only when it is behind the migrations"""
+        upgrade_schema()  # an earlier test class may have dropped the revision
+        with patch("service.models.upgrade") as upgrade:
+            upgrade_schema()
+            upgrade.assert_not_called()
+            with patch("service.models.latest_revisions", return_value={"next"}):
+                upgrade_schema()
+            upgrade.assert_called_once_with()
@@ -0,0 +1,152 @@
+"""
+Test cases for the Promotion Index
+
+"""
+import threading
+import unittest
+from datetime import datetime, timedelta
+from service.models import TypeOfPromo
+from service.promotion_index import PromotionIndex, rank
+from .factories import PromotionFactory
+
+NOW = datetime(2021, 11, 28, 12, 0, 0)
+
+
+######################################################################
+#  P R O M O T I O N   I N D E X   T E S T   C A S E S
+######################################################################
+class TestPromotionIndex(unittest.TestCase):
+    """ Test Cases for the in-memory Promotion Index """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.promotions = []
+        self.loads = []
+        self.index = PromotionIndex(self._loader)
+
+    def _loader(self, product_ids):
+        """ Stands in for the database, which ranks the promotions """
+        self.loads.append(sorted(product_ids))
+        return sorted(
+            (p for p in self.promotions if p.product_id in product_ids),
+            key=lambda promotion: rank(promotion.score(), promotion.id),
+        )
+
+    def _promotion(self, category, amount, product_id=1, days=(-1, 1)):
+        promotion = PromotionFactory(
+            category=category,
+            amount=amount,
+            product_id=product_id,
+            from_date=NOW + timedelta(days=days[0]),
+            to_date=NOW + timedelta(days=days[1]),
+        )
+        self.promotions.append(promotion)
+        return promotion
+
+    ######################################################################
+    #  T E S T   C A S E S
+    ######################################################################
+
+    def test_best_promotion(self):
+        """Find the best active promotion for a product"""
+        self._promotion(TypeOfPromo.Discount, 10)
+        best = self._promotion(TypeOfPromo.Discount, 40)
+        self._promotion(TypeOfPromo.Discount, 90, days=(-10, -5))  # expired
+        self._promotion(TypeOfPromo.BOGOF, 5)
+        self._promotion(TypeOfPromo.Unknown, 50)
+        self.assertEqual(self.index.best(1, NOW)["id"], best.id)
+        self.assertIsNone(self.index.best(2, NOW))
+
+    def test_best_promotion_at_time(self):
+        """Find the best promotion active at a given time"""
+        self._promotion(TypeOfPromo.Discount, 10, days=(-1, 10))
+        later = self._promotion(TypeOfPromo.Discount, 50, days=(5, 10))
+        self.assertEqual(self.index.best(1, NOW)["amount"], 10)
+        self.assertEqual(self.index.best(1, NOW + timedelta(days=6))["id"], later.id)
+        self.assertIsNone(self.index.best(1, NOW + timedelta(days=11)))
+
+    def test_ties_go_to_lowest_id(self):
+        """Break ties between equal promotions by id"""
+        first = self._promotion(TypeOfPromo.Discount, 50)
+        self._promotion(TypeOfPromo.BOGOF, 2)
+        self.assertEqual(self.index.best(1, NOW)["id"], first.id)
+
+    def test_products_are_loaded_once(self):
+        """Load each product only on its first lookup"""
+        self._promotion(TypeOfPromo.Discount, 10, product_id=1)
+        self._promotion(TypeOfPromo.Discount, 10, product_id=2)
+        self.index.best_many([1, 2, 3], NOW)
+        self.index.best_many([1, 2, 3], NOW)
+        self.index.best(1, NOW)
+        self.assertEqual(self.loads, [[1, 2, 3]])
+
+    def test_products_are_reloaded_after_ttl(self):
+        """Reload products that are older than the ttl"""
+        self.index.ttl = 0
+        self.index.best(1, NOW)
+        self.index.best(1, NOW)
+        self.assertEqual(len(self.loads), 2)
+
+    def test_add_and_discard(self):
+        """Keep the index current as promotions change"""
+        promotion = self._promotion(TypeOfPromo.Discount, 10)
+        self.assertEqual(self.index.best(1, NOW)["amount"], 10)
+        promotion.amount = 30
+        self.index.add(promotion)
+        self.assertEqual(self.index.best(1, NOW)["amount"], 30)
+        promotion.product_id = 2
+        self.index.add(promotion)
+        self.assertIsNone(self.index.best(1, NOW))
+        self.index.discard(promotion.id)
+        self.assertIsNone(self.index.best(1, NOW))
+        self.assertEqual(self.loads, [[1]])
+
+    def test_add_ignores_products_not_loaded(self):
+        """Leave products that were never looked up to their first lookup"""
+        promotion = self._promotion(TypeOfPromo.Discount, 10)
+        self.index.add(promotion)
+        self.assertEqual(self.index.best(1, NOW)["id"], promotion.id)
+        self.assertEqual(self.loads, [[1]])
+
+    def test_invalidate(self):
+        """Reload products after they are invalidated"""
+        self.index.best_many([1, 2], NOW)
+        self.index.invalidate([1])
+        self.index.best_many([1, 2], NOW)
+        self.index.invalidate()
+        self.index.best(2, NOW)
+        self.assertEqual(self.loads, [[1, 2], [1], [2]])
+
+    def test_lookups_while_loading(self):
+        """Look up loaded products while others load, and keep the changes told meanwhile"""
+        loaded = self._promotion(TypeOfPromo.Discount, 10, product_id=2)
+        self.index.best(2, NOW)
+        lookups, created = [], []
+
+        def load(product_ids):
+            promotions = self._loader(product_ids)
+            # a request looks up a loaded product from another thread
+            reader = threading.Thread(target=lambda: lookups.append(self.index.best(2, NOW)))
+            reader.start()
+            reader.join(5)
+            # and a change is told after the loader read the promotions
+            created.append(self._promotion(TypeOfPromo.Discount, 50))
+            self.index.changed([(None, created[0])])
+            return promotions
+
+        self.index._loader = load
+        self._promotion(TypeOfPromo.Discount, 20)
+        self.assertEqual(self.index.best(1, NOW)["id"], created[0].id)
+        self.assertEqual([best["id"] for best in lookups], [loaded.id])
+
+    def test_invalidate_while_loading(self):
+        """Load products again when they are invalidated while they load"""
+        def load(product_ids):
+            promotions = self._loader(product_ids)
+            if len(self.loads) == 1:
+                self.index.invalidate([1])  # a bulk action changed it after it was read
+            return promotions
+
+        self.index._loader = load
+        self.assertIsNone(self.index.best(1, NOW))
+        self.assertEqual(self.loads, [[1], [1]])
@@ -0,0 +1,119 @@
+"""
+Test cases for the Query Cache
+
+"""
+import unittest
+from unittest.mock import patch
+from datetime import datetime, timedelta
+from service.models import Promotion, TypeOfPromo
+from service.query_cache import QueryCache
+from .factories import PromotionFactory
+
+
+######################################################################
+#  Q U E R Y   C A C H E   T E S T   C A S E S
+######################################################################
+class TestQueryCache(unittest.TestCase):
+    """ Test Cases for the Query Cache """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.cache = QueryCache(Promotion.matches_multi_attributes, maxsize=3)
+
+    def _put(self, args, value="result", **kwargs):
+        key = QueryCache.key(args)
+        self.cache.put(key, args, value, self.cache.generation, **kwargs)
+        return key
+
+    ######################################################################
+    #  T E S T   C A S E S
+    ######################################################################
+
+    def test_key_ignores_unset_arguments(self):
+        """Make the same key for the same arguments"""
+        self.assertEqual(
+            QueryCache.key({"product_id": 1, "category": None, "available": 1}),
+            QueryCache.key({"available": 1, "product_id": 1}),
+        )
+        self.assertNotEqual(QueryCache.key({"product_id": 1}), QueryCache.key({"product_id": 2}))
+
+    def test_get_and_put(self):
+        """Cache and return a result"""
+        key = self._put({"product_id": 1})
+        self.assertEqual(self.cache.get(key), "result")
+        self.assertIsNone(self.cache.get(QueryCache.key({})))
+
+    def test_least_recently_used_are_evicted(self):
+        """Keep at most maxsize entries"""
+        keys = [self._put({"product_id": product_id}) for product_id in range(3)]
+        self.cache.get(keys[0])
+        self._put({"product_id": 3})
+        self.assertEqual(len(self.cache), 3)
+        self.assertIsNone(self.cache.get(keys[1]))
+        self.assertEqual(self.cache.get(keys[0]), "result")
+
+    def test_disabled(self):
+        """Cache nothing when maxsize is 0"""
+        self.cache.maxsize = 0
+        key = self._put({})
+        self.assertIsNone(self.cache.get(key))
+
+    def test_ttl(self):
+        """Expire entries after the ttl"""
+        self.cache.ttl = 10
+        with patch("service.query_cache.time.monotonic", return_value=100):
+            key = self._put({})
+        with patch("service.query_cache.time.monotonic", return_value=109):
+            self.assertEqual(self.cache.get(key), "result")
+        with patch("service.query_cache.time.monotonic", return_value=110):
+            self.assertIsNone(self.cache.get(key))
+
+    def test_stale_at(self):
+        """Expire entries once they go stale"""
+        key = self._put({"available": 1}, stale_at=datetime.now() + timedelta(days=1))
+        self.assertEqual(self.cache.get(key), "result")
+        key = self._put({"available": 1}, stale_at=datetime.now())
+        self.assertIsNone(self.cache.get(key))
+
+    def test_changes_evict_matching_entries(self):
+        """Evict the entries a change could affect"""
+        promotion = PromotionFactory(product_id=1, category=TypeOfPromo.Discount)
+        discounts = self._put({"category": "Discount"})
+        product_1 = self._put({"product_id": 1})
+        product_2 = self._put({"product_id": 2})
+        self.cache.changed([(None, promotion.to_record())])
+        self.assertIsNone(self.cache.get(discounts))
+        self.assertIsNone(self.cache.get(product_1))
+        self.assertEqual(self.cache.get(product_2), "result")
+        # the values before a change count too
+        product_3 = self._put({"product_id": 3})
+        promotion.product_id = 2
+        before = promotion.to_record()
+        promotion.product_id = 3
+        self.cache.changed([(before, promotion.to_record())])
+        self.assertIsNone(self.cache.get(product_2))
+        self.assertIsNone(self.cache.get(product_3))
+
+    def test_bulk_changes_empty_the_cache(self):
+        """Evict everything after a bulk action"""
+        key = self._put({"product_id": 1})
+        self.cache.changed_in_bulk([2])
+        self.assertIsNone(self.cache.get(key))
+
+    def test_changes_during_a_read_are_not_cached(self):
+        """Drop a result read before a change that came in meanwhile"""
+        promotion = PromotionFactory(product_id=1)
+        args = {"product_id": 1}
+        key = QueryCache.key(args)
+        # the change lands between the read of the result and its put
+        generation = self.cache.generation
+        self.cache.changed([(None, promotion.to_record())])
+        self.cache.put(key, args, "before the change", generation)
+        self.assertIsNone(self.cache.get(key))
+        generation = self.cache.generation
+        self.cache.changed_in_bulk()
+        self.cache.put(key, args, "before the bulk change", generation)
+        self.assertIsNone(self.cache.get(key))
+        # a read that started after them is kept
+        self.cache.put(key, args, "after the changes", self.cache.generation)
+        self.assertEqual(self.cache.get(key), "after the changes")
@@ -13,7 +13,8 @@ from unittest import TestCase
 from unittest.mock import MagicMock, patch
 from service import status  # HTTP Status Codes
 from service.models import db, Promotion, TypeOfPromo
-from service.routes import app, init_db
+from service import serializer
+from service.routes import app, init_db, collection_etag
 from urllib.parse import quote_plus
 from .factories import PromotionFactory
 from datetime import datetime, timedelta
@@ -48,6 +49,9 @@ class TestYourResourceServer(TestCase):
     def tearDownClass(cls):
         """ This runs once after the entire test suite """
         db.session.close()
+        # leave an empty database, the next run migrates it from the start
+        db.drop_all()
+        db.engine.execute("DROP TABLE IF EXISTS alembic_version")
 
     def setUp(self):
         """ This runs before each test """
@@ -169,6 +173,8 @@ class TestYourResourceServer(TestCase):
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
         data = resp.get_json()
         app.logger.info(data)
+        # written by the serializer, not the encoder of Flask-RESTX
+        self.assertEqual(resp.get_data(), serializer.dumps(data))
         self.assertEqual(data["category"], TypeOfPromo.Discount.name)
         self.assertEqual(data["product_name"], "Macbook")
         self.assertEqual(data["product_id"], 11111)
@@ -181,6 +187,94 @@ class TestYourResourceServer(TestCase):
         resp = self.app.get(BASE_URL + "/11112/best", content_type=CONTENT_TYPE_JSON)
         self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_get_best_promotions_batch(self):
+        """Get the best promotion for many products at once"""
+        current_date = datetime.now()
+        promotions = [
+            Promotion(
+                product_name="Macbook", category=TypeOfPromo.Discount,
+                product_id=11111, amount=10, description="Gread Deal",
+                from_date=current_date - timedelta(days=1),
+                to_date=current_date + timedelta(days=5)
+            ),
+            Promotion(
+                product_name="Macbook", category=TypeOfPromo.Discount,
+                product_id=11111, amount=20, description="Gread Deal",
+                from_date=current_date - timedelta(days=1),
+                to_date=current_date + timedelta(days=5)
+            ),
+            Promotion(
+                product_name="iwatch", category=TypeOfPromo.BOGOF,
+                product_id=11112, amount=2, description="Gread Deal",
+                from_date=current_date - timedelta(days=1),
+                to_date=current_date + timedelta(days=5)
+            ),
+            Promotion(
+                product_name="iphone", category=TypeOfPromo.Discount,
+                product_id=11113, amount=30, description="Gread Deal",
+                from_date=datetime(2021, 10, 7),
+                to_date=datetime(2021, 10, 13)
+            ), # invalid promotion
+        ]
+        for promotion in promotions:
+            resp = self.app.post(
+                BASE_URL, json=promotion.serialize(), content_type=CONTENT_TYPE_JSON
+            )
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        resp = self.app.post(
+            BASE_URL + "/best",
+            json={"product_ids": [11111, 11112, 11113, 11114, 11111]},
+            content_type=CONTENT_TYPE_JSON,
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(resp.get_data(), serializer.dumps(data))
+        self.assertEqual(len(data), 4)
+        self.assertEqual(data["11111"]["amount"], 20)
+        self.assertEqual(data["11112"]["product_name"], "iwatch")
+        self.assertEqual(data["11113"], None)
+        self.assertEqual(data["11114"], None)
+
+    def test_get_best_promotions_batch_bad_request(self):
+        """Get the best promotions with bad product ids"""
+        for body in [{}, {"product_ids": []}, {"product_ids": ["abc"]},
+                     {"product_ids": list(range(1001))}]:
+            resp = self.app.post(
+                BASE_URL + "/best", json=body, content_type=CONTENT_TYPE_JSON
+            )
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_price_cart(self):
+        """Price the lines of a cart with their best promotions"""
+        current_date = datetime.now()
+        promotion = PromotionFactory(
+            category=TypeOfPromo.Discount, product_id=11111, amount=20,
+            from_date=current_date - timedelta(days=1),
+            to_date=current_date + timedelta(days=5),
+        )
+        resp = self.app.post(BASE_URL, json=promotion.serialize(), content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        promotion_id = resp.get_json()["id"]
+        cart = {"lines": [
+            {"product_id": 11111, "quantity": 2, "unit_price": "12.50"},
+            {"product_id": 11112, "quantity": 1, "unit_price": 3},
+        ]}
+        resp = self.app.post(BASE_URL + "/price", json=cart, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data["lines"][0]["promotion_id"], promotion_id)
+        self.assertEqual(data["lines"][0]["price"], "20.00")
+        self.assertEqual(data["lines"][1]["promotion_id"], None)
+        self.assertEqual((data["subtotal"], data["discount"], data["total"]), ("28.00", "5.00", "23.00"))
+        resp = self.app.post(
+            BASE_URL + "/price", query_string={"at": (current_date + timedelta(days=6)).isoformat()},
+            json=cart, content_type=CONTENT_TYPE_JSON,
+        )
+        self.assertEqual(resp.get_json()["total"], "28.00")
+        resp = self.app.post(BASE_URL + "/price", json={"lines": [{"product_id": 1}]},
+                             content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     ######################################################################
     # Test quey promotion list
     ######################################################################
@@ -269,6 +363,90 @@ class TestYourResourceServer(TestCase):
         for promotion in data:
             self.assertEqual(promotion["to_date"], test_to_date.isoformat())
 
+    def test_query_promotions_available_at(self):
+        """Query promotions and best promotions available at a given time"""
+        at = datetime.now() + timedelta(days=30)
+        tomorrow = PromotionFactory(
+            category=TypeOfPromo.Discount, amount=10, product_id=1,
+            from_date=at - timedelta(days=1), to_date=at + timedelta(days=1),
+        )
+        resp = self.app.post(BASE_URL, json=tomorrow.serialize(), content_type=CONTENT_TYPE_JSON)
+        test_id = resp.get_json()["id"]
+        query_string = {"available": 1, "at": at.isoformat()}
+        for _ in range(2):  # from the database, then from the cache
+            resp = self.app.get(BASE_URL, query_string=query_string)
+            self.assertEqual([promotion["id"] for promotion in resp.get_json()], [test_id])
+        self.assertEqual(self.app.get(BASE_URL, query_string="available=1").get_json(), [])
+        resp = self.app.get(BASE_URL + "/1/best", query_string={"at": at.isoformat()})
+        self.assertEqual(resp.get_json()["id"], test_id)
+        resp = self.app.get(BASE_URL + "/1/best")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.post(
+            BASE_URL + "/best", query_string={"at": at.isoformat()}, json={"product_ids": [1, 2]}
+        )
+        self.assertEqual(resp.get_json()["1"]["id"], test_id)
+        self.assertIsNone(resp.get_json()["2"])
+        resp = self.app.get(BASE_URL + "/1/best", query_string="at=never")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_query_available_promotions_from_active_set(self):
+        """Page through the available promotions read from the active set"""
+        current_date = datetime.now()
+        promotions = []
+        for day in range(12):
+            promotion = PromotionFactory(
+                from_date=current_date + timedelta(days=day % 3 - 1),
+                to_date=current_date + timedelta(days=day % 4 + 1),
+            )
+            resp = self.app.post(BASE_URL, json=promotion.serialize(), content_type=CONTENT_TYPE_JSON)
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+            promotions.append(promotion)
+        now = datetime.now().isoformat()
+        expected = self.app.get(
+            BASE_URL, query_string={"available": 1, "at": now, "sort": "to_date"}
+        ).get_json()
+        self.assertTrue(expected)
+        results = []
+        query_string = {"available": 1, "sort": "to_date", "limit": 2, "fields": "id,to_date"}
+        while True:
+            resp = self.app.get(BASE_URL, query_string=query_string)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            results.extend(resp.get_json())
+            if "X-Next-Cursor" not in resp.headers:
+                break
+            query_string["cursor"] = resp.headers["X-Next-Cursor"]
+        self.assertEqual(results, [{"id": p["id"], "to_date": p["to_date"]} for p in expected])
+        # the active set follows the writes
+        resp = self.app.put(BASE_URL + "/{}/expire".format(expected[0]["id"]), content_type=CONTENT_TYPE_JSON)
+        resp = self.app.get(BASE_URL, query_string={"available": 1, "category": promotions[0].category.name})
+        self.assertNotIn(expected[0]["id"], [p["id"] for p in resp.get_json()])
+        resp = self.app.get(BASE_URL, query_string="available=1&category=nothing")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_query_promotion_list_by_date_range(self):
+        """Query promotions by ranges of dates"""
+        promotions = self._create_promotions(10)
+        start = promotions[2].from_date
+        end = promotions[5].from_date
+        resp = self.app.get(
+            BASE_URL, query_string={"from_date_after": start.isoformat(), "from_date_before": end.isoformat()}
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([promotion["id"] for promotion in resp.get_json()], [p.id for p in promotions[2:6]])
+        # active at any point in [start, end]
+        resp = self.app.get(
+            BASE_URL, query_string={"active_from": start.isoformat(), "active_to": end.isoformat(), "sort": "from_date"}
+        )
+        expected = [p.id for p in promotions if p.from_date <= end and p.to_date >= start]
+        self.assertEqual([promotion["id"] for promotion in resp.get_json()], expected)
+        resp = self.app.get(BASE_URL, query_string={"to_date_before": promotions[0].to_date.isoformat()})
+        self.assertEqual([promotion["id"] for promotion in resp.get_json()], [promotions[0].id])
+        resp = self.app.get(BASE_URL, query_string="active_from=tomorrow")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        # the bulk actions take the same filters
+        resp = self.app.delete(BASE_URL, query_string={"to_date_after": promotions[8].to_date.isoformat()})
+        self.assertEqual(resp.get_json(), {"affected": 2, "dry_run": False})
+
     def test_query_promotion_list_by_availability(self):
         """Query promotions by Availability"""
         promotions = self._create_promotions(10)
@@ -307,6 +485,191 @@ class TestYourResourceServer(TestCase):
             self.assertEqual(data[0]["id"], promotion.id)
     
     
+    def test_query_promotion_list_by_page(self):
+        """Query promotions a page at a time"""
+        promotions = self._create_promotions(7)
+        for sort in ["id", "from_date", "to_date", "product_id"]:
+            ids = []
+            query_string = "limit=3&sort={}".format(sort)
+            while True:
+                resp = self.app.get(BASE_URL, query_string=query_string)
+                self.assertEqual(resp.status_code, status.HTTP_200_OK)
+                data = resp.get_json()
+                self.assertLessEqual(len(data), 3)
+                ids.extend(promotion["id"] for promotion in data)
+                cursor = resp.headers.get("X-Next-Cursor")
+                if cursor is None:
+                    self.assertNotIn("Link", resp.headers)
+                    break
+                self.assertIn('rel="next"', resp.headers["Link"])
+                self.assertIn(quote_plus(cursor), resp.headers["Link"])
+                query_string = "limit=3&sort={}&cursor={}".format(sort, cursor)
+            expected = sorted(promotions, key=lambda p: (getattr(p, sort), p.id))
+            self.assertEqual(ids, [promotion.id for promotion in expected])
+
+    def test_query_promotion_list_by_page_with_filter(self):
+        """Query a filtered list of promotions a page at a time"""
+        current_date = datetime.now()
+        available = []
+        for days in [-1, 3, -1, 2, -1]:
+            test_promotion = PromotionFactory(
+                from_date=current_date + timedelta(days=days),
+                to_date=current_date + timedelta(days=days + 2),
+            )
+            resp = self.app.post(
+                BASE_URL, json=test_promotion.serialize(), content_type=CONTENT_TYPE_JSON
+            )
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+            if days < 0:
+                available.append(resp.get_json()["id"])
+        resp = self.app.get(BASE_URL, query_string="available=1&limit=1")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([p["id"] for p in resp.get_json()], available[:1])
+        resp = self.app.get(resp.headers["Link"].split(">")[0].lstrip("<"))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([p["id"] for p in resp.get_json()], available[1:2])
+
+    def test_query_promotion_list_bad_page(self):
+        """Query promotions with a bad page"""
+        self._create_promotions(2)
+        resp = self.app.get(BASE_URL, query_string="limit=1")
+        cursor = resp.headers["X-Next-Cursor"]
+        for query_string in ["limit=0", "limit=1001", "cursor=abc", "sort=amount",
+                             "sort=from_date&cursor={}".format(cursor)]:
+            resp = self.app.get(BASE_URL, query_string=query_string)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_stream_promotion_list(self):
+        """Stream a list of promotions as newline delimited JSON"""
+        promotions = self._create_promotions(5)
+        for kwargs in [{"query_string": "stream=1"},
+                       {"headers": {"Accept": "application/x-ndjson"}}]:
+            resp = self.app.get(BASE_URL, **kwargs)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual(resp.mimetype, "application/x-ndjson")
+            lines = resp.get_data(as_text=True).splitlines()
+            data = [json.loads(line) for line in lines]
+            self.assertEqual([p["id"] for p in data], [p.id for p in promotions])
+            self.assertEqual(data[0], promotions[0].serialize())
+
+    def test_stream_promotion_list_with_filter(self):
+        """Stream a filtered list of promotions"""
+        promotions = self._create_promotions(5)
+        test_product_id = promotions[2].product_id
+        resp = self.app.get(
+            BASE_URL, query_string="stream=true&sort=to_date&product_id={}".format(test_product_id)
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        lines = resp.get_data(as_text=True).splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(json.loads(lines[0])["product_id"], test_product_id)
+
+    def test_query_promotion_list_with_fields(self):
+        """Query promotions returning only some fields"""
+        promotions = self._create_promotions(5)
+        resp = self.app.get(BASE_URL, query_string="fields=id,amount,category&limit=2&sort=to_date")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(len(data), 2)
+        self.assertEqual(data[0], {
+            "id": promotions[0].id,
+            "amount": promotions[0].amount,
+            "category": promotions[0].category.name,
+        })
+        resp = self.app.get(resp.headers["Link"].split(">")[0].lstrip("<"))
+        self.assertEqual(resp.get_json()[0]["id"], promotions[2].id)
+        resp = self.app.get(BASE_URL, query_string="fields=from_date&stream=1")
+        lines = resp.get_data(as_text=True).splitlines()
+        self.assertEqual(json.loads(lines[4]), {"from_date": promotions[4].from_date.isoformat()})
+
+    def test_query_promotion_list_is_cached(self):
+        """Cache promotion lists until the promotions in them change"""
+        promotions = self._create_promotions(2)
+        query_string = "product_id={}".format(promotions[0].product_id)
+        resp = self.app.get(BASE_URL, query_string=query_string)
+        self.assertEqual(len(resp.get_json()), 1)
+        # a write that bypasses the model is not seen
+        values = promotions[0].to_record()._asdict()
+        del values["id"], values["version"]
+        db.session.execute(Promotion.__table__.insert().values(values))
+        db.session.commit()
+        self.assertEqual(len(self.app.get(BASE_URL, query_string=query_string).get_json()), 1)
+        # an update of another product keeps the cached result
+        promotions[1].amount = 1
+        resp = self.app.put(
+            BASE_URL + "/{}".format(promotions[1].id),
+            json=promotions[1].serialize(),
+            content_type=CONTENT_TYPE_JSON,
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(self.app.get(BASE_URL, query_string=query_string).get_json()), 1)
+        # an update of the product evicts it
+        resp = self.app.put(
+            BASE_URL + "/{}/expire".format(promotions[0].id),
+            content_type=CONTENT_TYPE_JSON,
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(self.app.get(BASE_URL, query_string=query_string).get_json()), 2)
+
+    def test_query_promotion_list_changed_while_read(self):
+        """Keep a promotion list out of the cache when it changes while it is read"""
+        promotion = self._create_promotions(1)[0]
+        query_string = "product_id={}".format(promotion.product_id)
+        serialize = serializer.to_json
+        amount = 1 if promotion.amount != 1 else 2
+
+        def update_then_serialize(promotions, fields):
+            """ Serializes the page after another request updated the promotion """
+            body = serialize(promotions, fields)
+            stored = Promotion.find(promotion.id)
+            stored.amount = amount
+            stored.update()
+            return body
+
+        with patch("service.routes.serializer.to_json", side_effect=update_then_serialize):
+            resp = self.app.get(BASE_URL, query_string=query_string)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        # the next request reads the update instead of the page read before it
+        resp = self.app.get(BASE_URL, query_string=query_string)
+        self.assertEqual(resp.get_json()[0]["amount"], amount)
+
+    def test_get_promotion_with_fields(self):
+        """Get a single Promotion returning only some fields"""
+        test_promotion = self._create_promotions(1)[0]
+        resp = self.app.get(
+            BASE_URL + "/{}".format(test_promotion.id), query_string="fields=product_id,to_date"
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {
+            "product_id": test_promotion.product_id,
+            "to_date": test_promotion.to_date.isoformat(),
+        })
+        resp = self.app.get(BASE_URL + "/{}".format(test_promotion.id), query_string="fields=price")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get(BASE_URL + "/abc")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_get_best_promotion_with_fields(self):
+        """Get the best promotion returning only some fields"""
+        test_promotion = PromotionFactory(
+            category=TypeOfPromo.Discount,
+            from_date=datetime.now() - timedelta(days=1),
+            to_date=datetime.now() + timedelta(days=1),
+        )
+        resp = self.app.post(BASE_URL, json=test_promotion.serialize(), content_type=CONTENT_TYPE_JSON)
+        test_promotion.id = resp.get_json()["id"]
+        url = BASE_URL + "/{}/best".format(test_promotion.product_id)
+        resp = self.app.get(url, query_string="fields=id,amount")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"id": test_promotion.id, "amount": test_promotion.amount})
+        resp = self.app.post(
+            BASE_URL + "/best", query_string="fields=id",
+            json={"product_ids": [test_promotion.product_id, 0]}, content_type=CONTENT_TYPE_JSON
+        )
+        self.assertEqual(resp.get_json(), {str(test_promotion.product_id): {"id": test_promotion.id}, "0": None})
+        resp = self.app.get(url, query_string="fields=id,,bad")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     ######################################################################
     # END
     ######################################################################
@@ -342,6 +705,71 @@ class TestYourResourceServer(TestCase):
         self.assertEqual(new_promotion["product_name"], test_promotion.product_name, "Name does not match")
         self.assertEqual(new_promotion["to_date"], test_promotion.to_date.isoformat(), "To date does not match")
 
+    def test_create_promotions_bulk(self):
+        """Create many Promotions at once"""
+        promotions = [promotion.serialize() for promotion in PromotionFactory.create_batch(4)]
+        resp = self.app.post(BASE_URL + "/bulk", json=promotions, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        data = resp.get_json()
+        self.assertEqual(data["created"], 4)
+        for position, result in enumerate(data["results"]):
+            self.assertEqual(result["index"], position)
+            self.assertEqual(result["status"], status.HTTP_201_CREATED)
+            self.assertEqual(result["promotion"]["product_name"], promotions[position]["product_name"])
+            resp = self.app.get(BASE_URL + "/{}".format(result["promotion"]["id"]))
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_create_promotions_bulk_ndjson(self):
+        """Create many Promotions from newline delimited JSON"""
+        promotions = [promotion.serialize() for promotion in PromotionFactory.create_batch(3)]
+        body = "\n".join(json.dumps(promotion) for promotion in promotions) + "\n"
+        resp = self.app.post(BASE_URL + "/bulk", data=body, content_type="application/x-ndjson")
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(resp.get_json()["created"], 3)
+        resp = self.app.post(BASE_URL + "/bulk?atomic=false", data="{not json}\n" + body,
+                             content_type="application/x-ndjson")
+        self.assertEqual(resp.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual(resp.get_json()["results"][0]["status"], status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(len(self.app.get(BASE_URL).get_json()), 6)
+
+    def test_create_promotions_bulk_not_valid(self):
+        """Create many Promotions when some are not valid"""
+        promotions = [promotion.serialize() for promotion in PromotionFactory.create_batch(3)]
+        promotions[1]["amount"] = 0
+        del promotions[2]["product_name"]
+        # all or nothing by default
+        resp = self.app.post(BASE_URL + "/bulk", json=promotions, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        data = resp.get_json()
+        self.assertEqual(data["created"], 0)
+        self.assertEqual([result["status"] for result in data["results"]], [424, 400, 400])
+        self.assertEqual(len(self.app.get(BASE_URL).get_json()), 0)
+        # partial success
+        resp = self.app.post(BASE_URL + "/bulk?atomic=false", json=promotions, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_207_MULTI_STATUS)
+        data = resp.get_json()
+        self.assertEqual(data["created"], 1)
+        self.assertEqual([result["status"] for result in data["results"]], [201, 400, 400])
+        self.assertEqual(len(self.app.get(BASE_URL).get_json()), 1)
+        # not an array
+        resp = self.app.post(BASE_URL + "/bulk", json=promotions[0], content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_create_promotions_bulk_bad_types(self):
+        """Reject the items of a bulk create with missing values or bad types one by one"""
+        promotions = [promotion.serialize() for promotion in PromotionFactory.build_batch(6)]
+        promotions[1]["product_name"] = None
+        promotions[2]["from_date"] = 5
+        promotions[3]["amount"] = True
+        promotions[4]["category"] = "__class__"
+        promotions[5]["description"] = "x" * 64
+        resp = self.app.post(BASE_URL + "/bulk?atomic=false", json=promotions, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_207_MULTI_STATUS)
+        data = resp.get_json()
+        self.assertEqual(data["created"], 1)
+        self.assertEqual([result["status"] for result in data["results"]], [201, 400, 400, 400, 400, 400])
+        self.assertEqual(len(self.app.get(BASE_URL).get_json()), 1)
+
     def test_expire_promotion(self):
         """Expire an existing Promotion"""
         # create a promotion to update
@@ -368,6 +796,43 @@ class TestYourResourceServer(TestCase):
 
         self.assertEqual(test_promotion.is_available(), False)
 
+    def test_expire_promotions_by_filter(self):
+        """Expire every Promotion matching the filters"""
+        promotions = self._create_promotions(6)
+        test_category = promotions[0].category
+        count = len([promotion for promotion in promotions if promotion.category == test_category])
+        query_string = "category={}".format(test_category.name)
+        resp = self.app.put(BASE_URL + "/expire", query_string=query_string + "&dry_run=true")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"affected": count, "dry_run": True})
+        resp = self.app.put(BASE_URL + "/expire", query_string=query_string)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"affected": count, "dry_run": False})
+        resp = self.app.get(BASE_URL, query_string=query_string + "&available=1")
+        self.assertEqual(resp.get_json(), [])
+        # a filter is required
+        resp = self.app.put(BASE_URL + "/expire")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_delete_promotions_by_filter(self):
+        """Delete every Promotion matching the filters"""
+        promotions = self._create_promotions(4)
+        test_product_id = promotions[0].product_id
+        query_string = "product_id={}".format(test_product_id)
+        resp = self.app.delete(BASE_URL, query_string=query_string + "&dry_run=1")
+        self.assertEqual(resp.get_json(), {"affected": 1, "dry_run": True})
+        self.assertEqual(len(self.app.get(BASE_URL).get_json()), 4)
+        resp = self.app.delete(BASE_URL, query_string=query_string)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"affected": 1, "dry_run": False})
+        self.assertEqual(len(self.app.get(BASE_URL).get_json()), 3)
+        # a filter is required
+        resp = self.app.delete(BASE_URL)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(len(self.app.get(BASE_URL).get_json()), 3)
+        resp = self.app.delete(BASE_URL, query_string="category=nothing")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_update_promotion(self):
         """Update an existing Promotion"""
         # create a promotion to update
@@ -390,6 +855,96 @@ class TestYourResourceServer(TestCase):
         updated_promotion = resp.get_json()
         self.assertEqual(updated_promotion["category"], "Unknown")
 
+    def test_get_promotion_not_modified(self):
+        """Get a Promotion only when it changed since its ETag"""
+        test_promotion = self._create_promotions(1)[0]
+        url = BASE_URL + "/{}".format(test_promotion.id)
+        resp = self.app.get(url)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        etag = resp.headers["ETag"]
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(resp.get_data(), b"")
+        self.assertEqual(resp.headers["ETag"], etag)
+        # another representation has another ETag
+        resp = self.app.get(url, query_string="fields=id", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.app.put(url + "/expire", content_type=CONTENT_TYPE_JSON)
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+
+    def test_query_promotion_list_not_modified(self):
+        """Get a list of Promotions only when one of them changed since its ETag"""
+        promotions = self._create_promotions(3)
+        resp = self.app.get(BASE_URL, query_string="limit=2")
+        etag = resp.headers["ETag"]
+        for _ in range(2):  # from the database, then from the cache
+            resp = self.app.get(BASE_URL, query_string="limit=2", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        resp = self.app.get(BASE_URL, query_string="limit=1", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        # a change to any of them, even off the page, changes the ETag
+        self.app.put(BASE_URL + "/{}/expire".format(promotions[2].id), content_type=CONTENT_TYPE_JSON)
+        resp = self.app.get(BASE_URL, query_string="limit=2", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 2)
+        etag = resp.headers["ETag"]
+        self.app.delete(BASE_URL + "/{}".format(promotions[2].id))
+        resp = self.app.get(BASE_URL, query_string="limit=2", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_promotion_list_etag_follows_the_members(self):
+        """Tag lists of other Promotions differently, even when their ids and versions add up the same"""
+        now = datetime.now()
+        args = {"available": 1}
+        # 1 and 4 are available now, 2 and 3 once they ended
+        for promotion_id, days in ((1, (-1, 1)), (2, (2, 3)), (3, (2, 3)), (4, (-1, 1))):
+            PromotionFactory(
+                id=promotion_id,
+                from_date=now + timedelta(days=days[0]),
+                to_date=now + timedelta(days=days[1]),
+            ).create()
+        later = now + timedelta(days=2, hours=12)
+        self.assertEqual(
+            Promotion.version_of_multi_attributes(dict(args, at=now)),
+            Promotion.version_of_multi_attributes(dict(args, at=later)),
+        )
+        self.assertNotEqual(
+            collection_etag(args, now, Promotion.next_availability_change(args, now)),
+            collection_etag(args, later, Promotion.next_availability_change(args, later)),
+        )
+        records = [Promotion.find(promotion_id).to_record() for promotion_id in (1, 2, 3, 4)]
+        self.assertNotEqual(
+            collection_etag(args, now, records=[records[0], records[3]]),
+            collection_etag(args, now, records=[records[1], records[2]]),
+        )
+
+    def test_update_promotion_if_match(self):
+        """Update a Promotion only when it did not change since its ETag"""
+        test_promotion = self._create_promotions(1)[0]
+        url = BASE_URL + "/{}".format(test_promotion.id)
+        etag = self.app.get(url).headers["ETag"]
+        data = test_promotion.serialize()
+        data["amount"] = 1
+        resp = self.app.put(url, json=data, headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+        # the ETag read before the update is out of date
+        data["amount"] = 2
+        resp = self.app.put(url, json=data, headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.assertEqual(self.app.get(url).get_json()["amount"], 1)
+        resp = self.app.put(url, json=data, headers={"If-Match": "*"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        # the ETag of some of the fields is the one of the same version
+        etag = self.app.get(url, query_string="fields=id,amount").headers["ETag"]
+        data["amount"] = 3
+        resp = self.app.put(url, json=data, headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.put(url, json=data, headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+
     def test_delete_promotion(self):
         """Delete a Promotion"""
         test_promotion = self._create_promotions(1)[0]
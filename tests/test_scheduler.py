@@ -0,0 +1,193 @@
+"""
+Test cases for the Promotion Scheduler
+
+"""
+import threading
+import unittest
+from datetime import datetime, timedelta
+from service.models import TypeOfPromo
+from service.scheduler import PromotionScheduler
+from .factories import PromotionFactory
+
+NOW = datetime.now()
+
+
+class Recorder:
+    """ Records the events of the scheduler """
+
+    def __init__(self):
+        self.events = []
+
+    def activated(self, records):
+        self.events.append(("activated", sorted(record.id for record in records)))
+
+    def expired(self, records):
+        self.events.append(("expired", sorted(record.id for record in records)))
+
+
+######################################################################
+#  P R O M O T I O N   S C H E D U L E R   T E S T   C A S E S
+######################################################################
+class TestPromotionScheduler(unittest.TestCase):
+    """ Test Cases for the Promotion Scheduler """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.promotions = []
+        self.loads = []
+        self.scheduler = PromotionScheduler(self._loader)
+        self.recorder = Recorder()
+        self.scheduler.listeners.append(self.recorder)
+
+    def tearDown(self):
+        """ This runs after each test """
+        self.scheduler.stop()
+
+    def _loader(self, at):
+        """ Stands in for the database """
+        self.loads.append(at)
+        return [p.to_record() for p in self.promotions if p.to_date >= at]
+
+    def _promotion(self, days, amount=10, product_id=1, category=TypeOfPromo.Discount):
+        promotion = PromotionFactory(
+            category=category,
+            amount=amount,
+            product_id=product_id,
+            from_date=NOW + timedelta(days=days[0]),
+            to_date=NOW + timedelta(days=days[1]),
+            version=1,
+        )
+        self.promotions.append(promotion)
+        return promotion
+
+    def _active(self):
+        return sorted(record.id for record in self.scheduler.active())
+
+    ######################################################################
+    #  T E S T   C A S E S
+    ######################################################################
+
+    def test_active_set(self):
+        """Keep the promotions active now"""
+        active = self._promotion((-1, 1))
+        self._promotion((-10, -5))  # ended
+        self._promotion((2, 4))  # not started
+        self.assertEqual(self._active(), [active.id])
+        self.assertEqual(self.recorder.events, [])
+
+    def test_transitions(self):
+        """Activate and expire promotions at their dates"""
+        first = self._promotion((-1, 1))
+        second = self._promotion((2, 4))
+        self.scheduler.advance(NOW)
+        self.assertEqual(self.scheduler.next_transition(), first.to_date + timedelta(microseconds=1))
+        self.scheduler.advance(NOW + timedelta(days=3))
+        self.assertEqual(
+            self.recorder.events, [("activated", [second.id]), ("expired", [first.id])]
+        )
+        # still active at its end date
+        self.scheduler.advance(second.to_date)
+        self.assertEqual(len(self.recorder.events), 2)
+        self.assertEqual(self.scheduler.next_transition(), second.to_date + timedelta(microseconds=1))
+        self.scheduler.advance(second.to_date + timedelta(microseconds=1))
+        self.assertEqual(self.recorder.events[-1], ("expired", [second.id]))
+        self.assertIsNone(self.scheduler.next_transition())
+        self.assertEqual(len(self.loads), 1)
+
+    def test_never_active(self):
+        """Leave out the promotions that end before they start or have ended"""
+        backwards = self._promotion((3, 2))  # would be activated then expired at once
+        ended = self._promotion((-10, -5))
+        active = self._promotion((-1, 1))
+        self.scheduler.advance(NOW)
+        self.assertEqual(self.scheduler.next_transition(), active.to_date + timedelta(microseconds=1))
+        # created or changed to such dates, they are left out too
+        self.scheduler.changed([(None, backwards.to_record()), (None, ended.to_record())])
+        self.assertEqual(self._active(), [active.id])
+        self.assertEqual(self.scheduler.next_transition(), active.to_date + timedelta(microseconds=1))
+        self.scheduler.advance(NOW + timedelta(days=4))
+        self.assertEqual(self.recorder.events, [("expired", [active.id])])
+        self.assertIsNone(self.scheduler.next_transition())
+
+    def test_best(self):
+        """Find the best active promotion for a product"""
+        self._promotion((-1, 1), amount=10)
+        best = self._promotion((-1, 1), amount=40)
+        self._promotion((-1, 1), amount=90, category=TypeOfPromo.Unknown)
+        self._promotion((2, 4), amount=90)
+        other = self._promotion((-1, 1), product_id=2)
+        self.assertEqual(self.scheduler.best(1)["id"], best.id)
+        self.assertEqual(
+            self.scheduler.best_many([1, 2, 3]),
+            {1: best.serialize(), 2: other.serialize(), 3: None},
+        )
+
+    def test_changes(self):
+        """Keep the schedule current as promotions change"""
+        promotion = self._promotion((-1, 1))
+        self.assertEqual(self._active(), [promotion.id])
+        before = promotion.to_record()
+        promotion.from_date = NOW + timedelta(days=1)
+        promotion.to_date = NOW + timedelta(days=2)
+        self.scheduler.changed([(before, promotion.to_record())])
+        self.assertEqual(self._active(), [])
+        self.assertEqual(self.scheduler.next_transition(), promotion.from_date)
+        created = self._promotion((-1, 1))
+        self.scheduler.changed([(None, created.to_record())])
+        self.scheduler.changed([(created.to_record(), None)])
+        self.assertEqual(
+            self.recorder.events,
+            [("expired", [promotion.id]), ("activated", [created.id]), ("expired", [created.id])],
+        )
+        self.assertEqual(len(self.loads), 1)
+
+    def test_bulk_changes_reload(self):
+        """Reload after a bulk change and tell what it changed"""
+        first = self._promotion((-1, 1))
+        self.assertEqual(self._active(), [first.id])
+        second = self._promotion((-1, 1))
+        self.promotions.remove(first)
+        self.scheduler.changed_in_bulk([1])
+        self.assertEqual(self._active(), [second.id])
+        self.assertEqual(
+            self.recorder.events, [("activated", [second.id]), ("expired", [first.id])]
+        )
+        self.assertEqual(len(self.loads), 2)
+
+    def test_reads_while_loading(self):
+        """Read the current schedule while it reloads, and keep the changes told meanwhile"""
+        first = self._promotion((-1, 1))
+        self.assertEqual(self._active(), [first.id])
+        reads, created = [], []
+
+        def load(at):
+            records = self._loader(at)
+            # a request reads from another thread while it loads
+            reader = threading.Thread(target=lambda: reads.append(self._active()))
+            reader.start()
+            reader.join(5)
+            # and a change is told after the loader read the promotions
+            created.append(self._promotion((-1, 1)))
+            self.scheduler.changed([(None, created[0].to_record())])
+            return records
+
+        self.scheduler._loader = load
+        self.scheduler.changed_in_bulk()
+        self.assertEqual(self._active(), [first.id, created[0].id])
+        self.assertEqual(reads, [[first.id]])
+
+    def test_ttl(self):
+        """Reload once the schedule is older than the ttl"""
+        self.scheduler.ttl = 0
+        self.scheduler.active()
+        self.scheduler.active()
+        self.assertEqual(len(self.loads), 2)
+
+    def test_background_thread(self):
+        """Advance in a background thread"""
+        ran = threading.Event()
+        self.scheduler.advance = lambda: ran.set()
+        self.scheduler.start(0.01)
+        self.assertTrue(ran.wait(5))
+        self.scheduler.stop()
+        self.assertIsNone(self.scheduler._thread)
@@ -0,0 +1,58 @@
+"""
+Test cases for the Promotion Serializer
+
+"""
+import json
+import unittest
+from unittest.mock import patch
+from service import serializer
+from service.routes import api, promotion_model, PROMOTION_FIELDS
+from .factories import PromotionFactory
+
+
+######################################################################
+#  S E R I A L I Z E R   T E S T   C A S E S
+######################################################################
+class TestSerializer(unittest.TestCase):
+    """ Test Cases for the Promotion Serializer """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.promotions = PromotionFactory.build_batch(5)
+        self.promotions[0].description = None
+
+    ######################################################################
+    #  T E S T   C A S E S
+    ######################################################################
+
+    def test_fields_follow_the_model(self):
+        """Write the fields of the promotion_model in its order"""
+        self.assertEqual(serializer.FIELDS, tuple(promotion_model.resolved))
+        self.assertEqual(PROMOTION_FIELDS, serializer.FIELDS)
+
+    def test_same_as_marshal(self):
+        """Write the same JSON as serialize() then marshal()"""
+        for promotion in self.promotions:
+            for record in (promotion, promotion.to_record()):
+                self.assertEqual(
+                    serializer.to_dict(record),
+                    api.marshal(promotion.serialize(), promotion_model),
+                )
+
+    def test_some_fields(self):
+        """Write only the fields asked for, in the order of the model"""
+        record = self.promotions[1].to_record()
+        data = serializer.to_dict(record, ["to_date", "id"])
+        self.assertEqual(list(data), ["id", "to_date"])
+        self.assertEqual(data, {"id": record.id, "to_date": record.to_date.isoformat()})
+        self.assertIs(serializer.serializer(["id", "to_date"]), serializer.serializer(["to_date", "id"]))
+        self.assertRaises(ValueError, serializer.compile_serializer, ("id", "version"))
+
+    def test_to_json(self):
+        """Encode a list of Promotions the same with or without orjson"""
+        expected = [promotion.serialize() for promotion in self.promotions]
+        self.assertEqual(json.loads(serializer.to_json(self.promotions)), expected)
+        with patch("service.serializer.orjson", None):
+            body = serializer.to_json(self.promotions)
+            self.assertIsInstance(body, bytes)
+            self.assertEqual(json.loads(body), expected)